@@ -0,0 +1,149 @@
+"""
+Equivalence check of the NumPy backend with the offset tables of the ImageJ backend (geometry.OffsetTable)
+
+Run it in CPython without Fiji (python backend_check.py, numpy needed): the radial profiles of random cubes computed
+by NumpyBackend.radial_profile (whole and band profiles) are compared shell by shell with the means over the voxels of
+geometry.shell_offsets and geometry.sphere_offsets, the tables visited by rad3d.RadialProfile, together with the
+local means and the radius (shells.radius_thresh) derived from them. The watershed of the segmentation mode must split
+two identical touching blobs in two mirrored regions, whatever the order of the seeds. The exit status is 1 if anything
+differs
+"""
+
+from __future__ import print_function
+import math
+import random
+import sys
+
+import numpy as np
+
+from geometry import shell_offsets, sphere_offsets
+from npbackend import ArrayImage, NumpyBackend
+from shells import profile_local_mean, radius_thresh
+
+n_cubes = 4
+cube_shape = (11, 40, 40)  # depth, height, width
+scaleZ = 0.4
+max_rad = 16
+band = (4, 9)  # min_rad and max_rad of the band profiles
+local_mean_radii = [(3, 5, 12), (6, 8, 16)]  # r0, r1, r2
+tolerance = 1e-6
+blob_shape = (21, 41, 61)  # depth, height, width of the watershed check
+blob_sigma = 4.
+blob_gap = 16  # distance between the centers of the two blobs
+blob_thresh = 60
+
+
+def table_mean(array, table, center):
+    # type: (np.ndarray, OffsetTable, list) -> float
+    """
+Mean of the voxels of array at the offsets of the table around center that are inside the cube (NaN if none)
+    """
+    d, h, w = array.shape
+    total = 0.
+    n = 0
+    for dx, dy, dz in zip(table.dx, table.dy, table.dz):
+        x, y, z = center[0] + dx, center[1] + dy, center[2] + dz
+        if 0 <= x < w and 0 <= y < h and 0 <= z < d:
+            total += float(array[z, y, x])
+            n += 1
+    return total / n if n > 0 else float('nan')
+
+
+def same(a, b):
+    # type: (float, float) -> bool
+    if math.isnan(a) or math.isnan(b):
+        return math.isnan(a) and math.isnan(b)
+    return abs(a - b) <= tolerance * max(1., abs(a), abs(b))
+
+
+def check_cube(backend, array, center):
+    # type: (NumpyBackend, np.ndarray, list) -> list
+    """
+    :return: Messages about the values of the NumPy profile that differ from the offset tables
+    """
+    d, h, w = array.shape
+    shape = (w, h, d)
+    image = ArrayImage(array)
+    # a single cube covering the whole array, centered on center
+    cell = next(backend.cells(image, [center], 2 * max(w, h) + 1, scaleZ))
+    cell.center = list(center)
+
+    messages = []
+    profile = backend.radial_profile(cell, max_rad)
+    reference = [table_mean(array, shell_offsets(r, r + 1, scaleZ, shape), center) for r in range(max_rad + 1)]
+    for r, (v, ref) in enumerate(zip(profile.means(), reference)):
+        if not same(v, ref):
+            messages.append('shell {}: {} instead of {}'.format(r, v, ref))
+    for r in range(max_rad + 1):
+        v, ref = profile.sphere_mean(r), table_mean(array, sphere_offsets(r, scaleZ, shape), center)
+        if not same(v, ref):
+            messages.append('sphere {}: {} instead of {}'.format(r, v, ref))
+
+    for r0, r1, r2 in local_mean_radii:
+        loc_mean = profile_local_mean(profile, r0, r1, r2)
+        ref = 0.5 * table_mean(array, sphere_offsets(r0, scaleZ, shape), center) + \
+            0.5 * table_mean(array, shell_offsets(r1, r2, scaleZ, shape), center)
+        if not same(loc_mean, ref):
+            messages.append('local mean {}: {} instead of {}'.format((r0, r1, r2), loc_mean, ref))
+        radius, ref_radius = radius_thresh(profile.iter_means(), loc_mean), radius_thresh(reference, loc_mean)
+        if radius != ref_radius:
+            messages.append('radius {}: {} instead of {}'.format((r0, r1, r2), radius, ref_radius))
+
+    lo, hi = band
+    band_profile = backend.radial_profile(cell, hi, min_rad=lo)
+    for r in range(lo, hi + 1):
+        if not same(band_profile.shell_mean(r), reference[r]):
+            messages.append('band shell {}: {} instead of {}'.format(r, band_profile.shell_mean(r), reference[r]))
+    return messages
+
+
+def check_watershed(backend):
+    # type: (NumpyBackend) -> list
+    """
+    :return: Messages about the regions of two identical touching gaussian blobs that are not mirrored
+    """
+    d, h, w = blob_shape
+    z, y, x = np.mgrid[0:d, 0:h, 0:w]
+    seeds = [[w // 2 - blob_gap // 2, h // 2, d // 2], [w // 2 + blob_gap // 2, h // 2, d // 2]]
+    array = np.zeros(blob_shape)
+    for sx, sy, sz in seeds:
+        array += 200 * np.exp(-((x - sx) ** 2 + (y - sy) ** 2 + (z - sz) ** 2) / (2 * blob_sigma ** 2))
+    image = ArrayImage(array)
+
+    messages = []
+    above = int((array >= blob_thresh).sum())
+    for order in (seeds, seeds[::-1]):
+        (n0, c0), (n1, c1) = backend.watershed(image, order, [blob_thresh, blob_thresh])
+        if n0 != n1 or n0 + n1 != above:
+            messages.append('seeds {}: {} and {} voxels of {}'.format(order, n0, n1, above))
+        if n0 and n1 and not (same(c0[0] + c1[0], w - 1) and same(c0[1], c1[1]) and same(c0[2], c1[2])):
+            messages.append('seeds {}: centroids {} and {} not mirrored'.format(order, c0, c1))
+    return messages
+
+
+def main():
+    rnd = random.Random(0)
+    np_rnd = np.random.RandomState(0)
+    backend = NumpyBackend()
+    d, h, w = cube_shape
+    all_ok = True
+    for k in range(n_cubes):
+        array = np_rnd.randint(0, 4096, cube_shape).astype(np.uint16)
+        # inside the cube and close to its borders (clipped shells)
+        for center in [[w // 2, h // 2, d // 2], [rnd.randint(0, 3), rnd.randint(0, h - 1), rnd.randint(0, d - 1)]]:
+            messages = check_cube(backend, array, center)
+            all_ok = all_ok and not messages
+            print('cube {} center {}: {}'.format(k, center, 'OK' if not messages else 'FAILED'))
+            for m in messages:
+                print('  ' + m)
+    messages = check_watershed(backend)
+    all_ok = all_ok and not messages
+    print('watershed of two touching blobs: {}'.format('OK' if not messages else 'FAILED'))
+    for m in messages:
+        print('  ' + m)
+    print('Equivalence: ' + ('OK' if all_ok else 'FAILED'))
+    return all_ok
+
+
+if __name__ in ['__builtin__', '__main__']:
+    sys.exit(0 if main() else 1)
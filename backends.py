@@ -0,0 +1,146 @@
+"""
+Compute backends of the measure pipeline (see pipeline.py)
+
+A backend reads the voxels of the cells and runs the voxel-level operations; everything else (stage order, caching,
+metrics, local mean and radius arithmetic on the shell sums) is shared. Available backends:
+
+    'ij': ImageJ and mcib3d (Jython in Fiji), cells are stacks.CellStack
+    'numpy': NumPy arrays (CPython), cells are npbackend.ArrayCell, whole-array operations on every cube
+
+Cells of both backends expose the same attributes: seed, center (relative to roi3D), roi3D, dim, scaleZ,
+onBorder, marker, neighbors, crowded, t_crop, contains(pos) and grow(dim)
+"""
+
+# module and class of every backend, imported only when requested (ij is not available in CPython, numpy in Jython)
+BACKENDS = {
+    'ij': ('ijbackend', 'IJBackend'),
+    'numpy': ('npbackend', 'NumpyBackend')
+}
+
+_instances = {}
+
+
+class Backend(object):
+    """
+    Operations a backend has to provide. Positions are [x, y, z] lists relative to the cell (see roi.relative_center)
+    """
+    name = None
+
+    def open_image(self, img_path, mode='full', cache_slices=64):
+        """
+    Open the image (mode and cache_slices as in sources.open_source, ignored by backends loading the whole volume)
+        """
+        raise NotImplementedError
+
+    def image_height(self, image):
+        # type: (object) -> int
+        raise NotImplementedError
+
+    def close_image(self, image):
+        pass
+
+    def cells(self, image, seeds, cube_dim, scaleZ, order='file', dims=None):
+        """
+    Crop the cube of every seed (generator, see stacks.gen_cell_stacks for order and dims)
+        """
+        raise NotImplementedError
+
+    def grow_cell(self, cell, dim):
+        # type: (object, int) -> None
+        """
+    Crop the cell again with a cube of side dim (see stacks.CellStack.grow)
+        """
+        cell.grow(dim)
+
+    def close_cell(self, cell):
+        pass
+
+    def prepare(self, cell):
+        """
+    Called once before measuring a cell
+        """
+        pass
+
+    def get_voxel(self, cell, pos):
+        # type: (object, list) -> float
+        """
+    :raise: IndexError if pos is outside the cell
+        """
+        raise NotImplementedError
+
+    def filter(self, cell, method, sigma, engine='ij'):
+        # type: (object, str, float, str) -> None
+        """
+    Filter the voxels of the cell in place (see filters.filter_cellstack)
+        """
+        raise NotImplementedError
+
+    def local_max(self, cell, seed):
+        # type: (object, list) -> list
+        """
+    Steepest ascent from seed over the 26 neighbors (see utils.local_max)
+        """
+        raise NotImplementedError
+
+    def radial_profile(self, cell, max_rad, center=None, lazy=False, min_rad=0):
+        # type: (object, int, list, bool, int) -> ShellSums
+        """
+    Shell sums around center (cell.center if None) from min_rad to max_rad, see shells.ShellSums (the shells below
+    min_rad are left empty). If lazy the backend may compute a shell only when it is read
+        """
+        raise NotImplementedError
+
+    def find_maxima(self, cell, rad, thresh):
+        # type: (object, float, float) -> list
+        """
+    Maxima of the cell above thresh, followed by the cell center (see utils.find_maxima)
+        """
+        raise NotImplementedError
+
+    def mean_shift(self, cell, radius, peaks, sigma, thresh, log=None):
+        # type: (object, int, list, float, float, callable) -> list
+        """
+    Centroid closest to the cell center after the mean shift of the peaks, logged with log if given
+    (see mean_shift.ms_center)
+        """
+        raise NotImplementedError
+
+    def downsample(self, image, factor, z_factor):
+        # type: (object, int, int) -> object
+        """
+    Copy of the image binned by factor along x and y and by z_factor along z (mean of every bin, the remainder of
+    the dimensions is dropped, as ImageJ Binner), an image of the same backend
+
+        :return: Binned image
+        """
+        raise NotImplementedError
+
+    def watershed(self, image, seeds, thresholds):
+        # type: (object, list, list) -> list
+        """
+    Seeded watershed of the whole image (see segment.py): the voxels above the lowest threshold are split among the
+    seeds ([x, y, z] image coordinates), the region of a seed keeps the voxels above its own threshold
+
+        :return: (number of voxels, centroid [x, y, z] in image coordinates or None if empty) for every seed
+        """
+        raise NotImplementedError
+
+
+def get_backend(name):
+    # type: (str) -> Backend
+    """
+    :param name: Key of BACKENDS
+
+    :return: Shared instance of the backend
+
+    :raise: ValueError for an unknown backend, ImportError if its libraries are missing
+    """
+    if name not in BACKENDS:
+        raise ValueError('Unknown backend: {} (available: {})'.format(name, ', '.join(sorted(BACKENDS))))
+    backend = _instances.get(name)
+    if backend is None:
+        module_name, class_name = BACKENDS[name]
+        module = __import__(module_name)
+        backend = getattr(module, class_name)()
+        _instances[name] = backend
+    return backend
@@ -0,0 +1,204 @@
+"""
+Offline benchmark of the measure pipeline on synthetic cells (see synth.py)
+
+Run it in Fiji (Jython, also headless): the synthetic dataset is created in bench_dir the first time, then every
+cell is measured with main.measure_cell (current parameters of main.py). The script logs the time of each stage,
+the cells per second and the errors of radius and center with respect to the ground truth, and saves them in
+bench_dir/bench_results.json. If baseline_path exists, the results are compared with it to spot regressions.
+With compare_algorithms = True the per-cell pipeline, the whole-image segmentation (see segment.py) and the coarse to
+fine estimate (see pyramid.py) are also measured on a crowded dataset (mostly touching pairs) in crowded_dir, with
+their accuracy delta with respect to the per-cell pipeline, results in crowded_dir/algorithms.json
+"""
+
+from __future__ import with_statement, print_function
+import json
+import math
+import os
+import tempfile
+import time
+
+from ij import IJ
+
+import main
+from backends import get_backend
+from instrument import ImageMetrics
+from pyramid import pyramid_image
+from segment import segment_image
+from sources import open_source
+from stacks import gen_cell_stacks
+from synth import make_dataset, read_truth, truth_path_of
+
+bench_dir = os.path.join(tempfile.gettempdir(), 'bcmeasure_bench')
+n_images = 2
+shape = 'ellipsoid'  # or 'gauss'
+layout = {'n_cells': 20, 'radius_range': (5, 10), 'n_touching': 3, 'n_border': 3}
+baseline_path = os.path.join(bench_dir, 'bench_baseline.json')
+slowdown_tolerance = 0.2  # stages slower than the baseline by more than this fraction are reported
+compare_algorithms = False
+crowded_dir = os.path.join(bench_dir, 'crowded')
+crowded_layout = {'n_cells': 10, 'radius_range': (5, 10), 'n_touching': 25, 'n_border': 3}
+
+STAGES = ['t_crop', 't_filter', 't_local_max', 't_rad3d', 't_local_mean', 't_maxima', 't_mean_shift',
+          't_new_rad3d', 't_new_local_mean']
+COUNTERS = ['voxels', 'ms_iterations', 'ms_seed_iterations']
+
+
+def _mean(values):
+    values = [v for v in values if v is not None and not math.isnan(v)]
+    return sum(values) / len(values) if values else float('nan')
+
+
+def measure_image(img_path, algorithm='cells'):
+    # type: (str, str) -> list
+    """
+Measure every cell of a synthetic image
+
+    :param algorithm: 'cells' (main.measure_cell on every cube), 'segment' (segment.segment_image) or 'pyramid'
+    (pyramid.pyramid_image)
+
+    :return: List of (cell record, ground truth Blob)
+    """
+    truth = read_truth(truth_path_of(img_path))
+    source = open_source(img_path, mode='full')
+    markers = main.load_markers(img_path, source.height)
+    pairs = []
+    if algorithm in ['segment', 'pyramid']:
+        measure = segment_image if algorithm == 'segment' else pyramid_image
+        records = measure(source, get_backend('ij'), markers, main.cell_params(), main.cube_roi_dim, main.scaleZ,
+                          metrics=ImageMetrics(os.path.basename(img_path)))
+        pairs = list(zip(records, truth))
+    else:
+        for cs in gen_cell_stacks(source, markers, main.cube_roi_dim, main.scaleZ, view=main.view_stacks):
+            pairs.append((main.measure_cell(cs, log=main.quiet), truth[cs.marker]))
+            cs.close()
+    source.close()
+    return pairs
+
+
+def summarize(pairs, elapsed):
+    # type: (list, float) -> dict
+    scaleZ = main.scaleZ
+    summary = {
+        'n_cells': len(pairs),
+        'cells_per_second': len(pairs) / elapsed if elapsed > 0 else float('nan'),
+        'stages': dict((stage, _mean([r.get(stage) for r, b in pairs])) for stage in STAGES),
+        'counters': dict((counter, _mean([r.get(counter) for r, b in pairs])) for counter in COUNTERS),
+        'accuracy': {}
+    }
+    for kind in ['all', 'isolated', 'touching', 'border']:
+        sel = [(r, b) for r, b in pairs if kind == 'all' or b.kind == kind]
+        if not sel:
+            continue
+        summary['accuracy'][kind] = {
+            'n_cells': len(sel),
+            'radius_error': _mean([abs(r['radius'] - b.radius) for r, b in sel]),
+            'new_radius_error': _mean([abs(r['new_radius'] - b.radius) if 'new_radius' in r else None
+                                       for r, b in sel]),
+            'center_error': _mean([math.sqrt((r['center_x'] - b.x) ** 2 + (r['center_y'] - b.y) ** 2 +
+                                             ((r['center_z'] - b.z) / scaleZ) ** 2) for r, b in sel])
+        }
+    return summary
+
+
+def compare(summary, baseline):
+    # type: (dict, dict) -> list
+    """
+    :return: Messages about the stages slower than the baseline and the errors larger than the baseline
+    """
+    messages = []
+    for stage, t in summary['stages'].items():
+        t0 = baseline['stages'].get(stage)
+        if t0 and t > t0 * (1 + slowdown_tolerance):
+            messages.append('{} slower: {:.4f} s (baseline {:.4f} s)'.format(stage, t, t0))
+    for kind, acc in summary['accuracy'].items():
+        for key, err in acc.items():
+            err0 = baseline['accuracy'].get(kind, {}).get(key)
+            if key.endswith('error') and err0 is not None and err > err0 + 1e-6:
+                messages.append('{} {} worse: {:.3f} (baseline {:.3f})'.format(kind, key, err, err0))
+    return messages
+
+
+def dataset(out_dir, cell_layout):
+    # type: (str, dict) -> list
+    """
+    :return: Paths of the synthetic images in out_dir, created with cell_layout the first time
+    """
+    paths = sorted(os.path.join(out_dir, f) for f in os.listdir(out_dir) if f.endswith('.tif')) \
+        if os.path.isdir(out_dir) else []
+    if not paths:
+        IJ.log('Creating synthetic dataset in {}...'.format(out_dir))
+        paths = make_dataset(out_dir, n_images=n_images, scaleZ=main.scaleZ, shape=shape, **cell_layout)
+    return paths
+
+
+def run_algorithms():
+    # type: () -> dict
+    """
+Every algorithm on the crowded dataset: cells per second, voxels per cell and errors, with the difference of the
+errors from those of the per-cell pipeline (accuracy_delta, positive if worse)
+
+    :return: Summary of every algorithm
+    """
+    paths = dataset(crowded_dir, crowded_layout)
+    summaries = {}
+    for algorithm in ['cells', 'segment', 'pyramid']:
+        t_start = time.time()
+        pairs = []
+        for img_path in paths:
+            pairs.extend(measure_image(img_path, algorithm))
+        summary = summarize(pairs, time.time() - t_start)
+        summaries[algorithm] = summary
+        IJ.log('{}: {} cells, {:.2f} cells/s, {:.0f} voxels per cell'.format(
+            algorithm, summary['n_cells'], summary['cells_per_second'], summary['counters']['voxels']))
+        # the best radius of the per-cell pipeline is the second one
+        reference = summaries['cells']['accuracy']
+        summary['accuracy_delta'] = {}
+        for kind, acc in sorted(summary['accuracy'].items()):
+            ref = reference.get(kind, {})
+            delta = {'radius_error': acc['radius_error'] - ref.get('new_radius_error', float('nan')),
+                     'center_error': acc['center_error'] - ref.get('center_error', float('nan'))}
+            summary['accuracy_delta'][kind] = delta
+            IJ.log('  {} ({} cells): radius error {:.2f} ({:+.2f}), center error {:.2f} ({:+.2f})'.format(
+                kind, acc['n_cells'], acc['radius_error'], delta['radius_error'], acc['center_error'],
+                delta['center_error']))
+
+    with open(os.path.join(crowded_dir, 'algorithms.json'), 'w') as f:
+        json.dump(summaries, f, indent=1)
+    return summaries
+
+
+def run():
+    # type: () -> dict
+    paths = dataset(bench_dir, layout)
+
+    t_start = time.time()
+    pairs = []
+    for img_path in paths:
+        pairs.extend(measure_image(img_path))
+    summary = summarize(pairs, time.time() - t_start)
+
+    IJ.log('{} cells, {:.2f} cells/s'.format(summary['n_cells'], summary['cells_per_second']))
+    for stage in STAGES:
+        IJ.log('  {}: {:.4f} s/cell'.format(stage, summary['stages'][stage]))
+    for counter in COUNTERS:
+        IJ.log('  {}: {:.1f} per cell'.format(counter, summary['counters'][counter]))
+    for kind, acc in sorted(summary['accuracy'].items()):
+        IJ.log('  {} ({} cells): radius error {:.2f}, new radius error {:.2f}, center error {:.2f}'.format(
+            kind, acc['n_cells'], acc['radius_error'], acc['new_radius_error'], acc['center_error']))
+
+    with open(os.path.join(bench_dir, 'bench_results.json'), 'w') as f:
+        json.dump(summary, f, indent=1)
+    if os.path.exists(baseline_path):
+        with open(baseline_path, 'r') as f:
+            messages = compare(summary, json.load(f))
+        for m in messages:
+            IJ.log('REGRESSION ' + m)
+        if not messages:
+            IJ.log('No regression with respect to ' + baseline_path)
+    if compare_algorithms:
+        run_algorithms()
+    return summary
+
+
+if __name__ in ['__builtin__', '__main__']:
+    run()
@@ -0,0 +1,152 @@
+from __future__ import with_statement
+import hashlib
+import json
+import os
+import threading
+
+# digests of the image files already hashed by this process, keyed by (path, size, mtime)
+_digests = {}
+
+
+def image_digest(img_path):
+    # type: (str) -> str
+    """
+md5 of the content of an image file (the same image moved or copied has the same digest)
+    """
+    stat = os.stat(img_path)
+    memo_key = (os.path.abspath(img_path), stat.st_size, stat.st_mtime)
+    if memo_key not in _digests:
+        md5 = hashlib.md5()
+        with open(img_path, 'rb') as f:
+            chunk = f.read(1 << 20)
+            while chunk:
+                md5.update(chunk)
+                chunk = f.read(1 << 20)
+        _digests[memo_key] = md5.hexdigest()
+    return _digests[memo_key]
+
+
+def stage_key(parent, name, params):
+    # type: (str, str, dict) -> str
+    """
+Key of a stage of the pipeline: it depends on the key of the previous stage and on the parameters of this one
+only, so changing a parameter invalidates its stage and the following ones
+    """
+    desc = '|'.join([parent, name] + ['{}={!r}'.format(k, params[k]) for k in sorted(params)])
+    return hashlib.md5(desc.encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, cache_dir, max_bytes=512 * 1024 * 1024):
+        # type: (str, int) -> ResultCache
+        """
+    Persistent cache of stage outputs (json values) under cache_dir, one file per key.
+    When the files exceed max_bytes the least recently used ones are removed (access time is the file mtime,
+    updated on every hit)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _entries(self):
+        for root, directories, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if filename.endswith('.json'):
+                    yield os.path.join(root, filename)
+
+    def get(self, key):
+        # type: (str) -> object
+        """
+    :return: Cached value of key, None if missing
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        # type: (str, object) -> None
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another thread
+                pass
+        # write and rename, a reader never finds a partial entry
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            json.dump(value, f)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, path)
+        with self.lock:
+            self.size += size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """
+    Remove the least recently used entries until the cache takes 90% of max_bytes
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self.size = sum(e[1] for e in entries)
+        target = 0.9 * self.max_bytes
+        for mtime, size, path in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                # removed by another process sharing the cache
+                pass
+
+    def stage(self, key, compute):
+        # type: (str, callable) -> tuple
+        """
+    Cached value of key, computed (and stored) with compute() if missing
+
+        :return: (value, True if it was cached)
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+        value = compute()
+        self.put(key, value)
+        return value, False
+
+
+# caches opened by this process, one per directory (shared by all the images and threads)
+_caches = {}
+
+
+def open_cache(cache_dir, max_bytes=512 * 1024 * 1024):
+    # type: (str, int) -> ResultCache
+    cache_dir = os.path.abspath(cache_dir)
+    if cache_dir not in _caches:
+        _caches[cache_dir] = ResultCache(cache_dir, max_bytes)
+    return _caches[cache_dir]
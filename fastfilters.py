@@ -0,0 +1,370 @@
+import math
+
+from ij import ImageStack
+from ij.plugin.filter import Convolver, GaussianBlur
+from ij.process import Blitter, FloatProcessor
+from jarray import array
+
+from geometry import LRUCache
+
+# kernels depend only on the filter parameters, shared by all the cells of a run
+_kernels = LRUCache(max_size=32)
+
+
+def gaussian_kernel(sigma, accuracy):
+    # type: (float, float) -> list
+    """
+Symmetric 1D gaussian kernel (length 2r+1) computed as in ImageJ GaussianBlur (same cut-off and edge smoothing)
+    """
+    def factory():
+        one_side = GaussianBlur().makeGaussianKernel(sigma, accuracy, 1 << 16)[0]
+        r = len(one_side) - 1
+        while r > 0 and one_side[r] == 0:
+            r -= 1
+        return [one_side[abs(i)] for i in range(-r, r + 1)]
+
+    return _kernels.get(('gauss', sigma, accuracy), factory)
+
+
+def ellipsoid_rows(rx, ry, rz):
+    # type: (float, float, float) -> list
+    """
+Ellipsoid kernel of the ImageJ 3D filters ((dx/rx)^2 + (dy/ry)^2 + (dz/rz)^2 <= 1) as x segments
+
+    :return: List of (dy, dz, a): the kernel contains the voxels -a <= dx <= a of the row (dy, dz)
+    """
+    def ratio2(d, r):
+        if r == 0:
+            return 0. if d == 0 else 2.
+        return float(d * d) / (r * r)
+
+    def factory():
+        rows = []
+        vy, vz = int(math.ceil(ry)), int(math.ceil(rz))
+        for dz in range(-vz, vz + 1):
+            for dy in range(-vy, vy + 1):
+                rest = 1. - ratio2(dy, ry) - ratio2(dz, rz)
+                if rest < 0:
+                    continue
+                a = int(math.floor(rx * math.sqrt(rest) + 1e-9)) if rx > 0 else 0
+                rows.append((dy, dz, a))
+        return rows
+
+    return _kernels.get(('ellipsoid', rx, ry, rz), factory)
+
+
+def _to_float(stack):
+    # type: (ImageStack) -> list
+    return [stack.getProcessor(n).convertToFloat().duplicate() for n in range(1, stack.getSize() + 1)]
+
+
+def _to_stack(fps, bit_depth):
+    # type: (list, int) -> ImageStack
+    """
+Back to the original bit depth, rounding and clamping without scaling (as the ImageJ filters do)
+    """
+    stack = ImageStack(fps[0].getWidth(), fps[0].getHeight())
+    for fp in fps:
+        if bit_depth == 8:
+            stack.addSlice(fp.convertToByteProcessor(False))
+        elif bit_depth == 16:
+            stack.addSlice(fp.convertToShortProcessor(False))
+        else:
+            stack.addSlice(fp)
+    return stack
+
+
+def _weighted_z_sum(fps, kernel):
+    # type: (list, list) -> list
+    """
+Convolution along z with a 1D kernel, whole slices at a time (Blitter), replicating the first and last slices
+    """
+    d = len(fps)
+    r = len(kernel) // 2
+    out = []
+    for z in range(d):
+        acc = FloatProcessor(fps[0].getWidth(), fps[0].getHeight())
+        for j in range(-r, r + 1):
+            term = fps[min(max(z + j, 0), d - 1)].duplicate()
+            term.multiply(kernel[j + r])
+            acc.copyBits(term, 0, 0, Blitter.ADD)
+        out.append(acc)
+    return out
+
+
+def gaussian(stack, sigma, scaleZ):
+    # type: (ImageStack, float, float) -> ImageStack
+    """
+Separable gaussian blur: the same 1D kernel on x and y (ImageJ Convolver, edges replicated) and a shorter one
+(sigma * scaleZ) on z
+    """
+    bit_depth = stack.getBitDepth()
+    kxy = gaussian_kernel(sigma, 0.002 if bit_depth == 8 else 0.0002)
+    kxy_arr = array(kxy, 'f')
+    conv = Convolver()
+    conv.setNormalize(False)
+
+    fps = _to_float(stack)
+    for fp in fps:
+        conv.convolve(fp, kxy_arr, len(kxy), 1)
+        conv.convolve(fp, kxy_arr, 1, len(kxy))
+
+    if sigma * scaleZ > 0:
+        fps = _weighted_z_sum(fps, gaussian_kernel(sigma * scaleZ, 0.01))
+    return _to_stack(fps, bit_depth)
+
+
+def _disk_kernel(rows, dz):
+    # type: (list, int) -> tuple
+    """
+In-plane section dz of an ellipsoid kernel as a 2D convolution kernel of ones
+    """
+    section = [(dy, a) for dy, kz, a in rows if kz == dz]
+    vx = max(a for dy, a in section)
+    vy = max(abs(dy) for dy, a in section)
+    kw, kh = 2 * vx + 1, 2 * vy + 1
+    kernel = [0.] * (kw * kh)
+    for dy, a in section:
+        for dx in range(-a, a + 1):
+            kernel[(dy + vy) * kw + dx + vx] = 1.
+    return array(kernel, 'f'), kw, kh, vx, vy
+
+
+def mean(stack, sigma, scaleZ):
+    # type: (ImageStack, float, float) -> ImageStack
+    """
+Mean over the ellipsoid of radii (sigma, sigma, sigma * scaleZ), voxels outside the stack excluded (as ImageJ
+Filters3D.MEAN). Every slice is summed once per section of the kernel with whole-slice operations, the sections are
+then accumulated along z
+    """
+    bit_depth = stack.getBitDepth()
+    w, h, d = stack.getWidth(), stack.getHeight(), stack.getSize()
+    rows = ellipsoid_rows(sigma, sigma, sigma * scaleZ)
+    sections = sorted(set(dz for dy, dz, a in rows))
+    conv = Convolver()
+    conv.setNormalize(False)
+
+    fps = _to_float(stack)
+    sums = {}
+    counts = {}
+    for dz in sections:
+        kernel, kw, kh, vx, vy = _disk_kernel(rows, dz)
+        # zero padding, so that the voxels outside the stack neither add to the sum nor to the count
+        ones = FloatProcessor(w + 2 * vx, h + 2 * vy)
+        ones.setValue(1.)
+        ones.setRoi(vx, vy, w, h)
+        ones.fill()
+        ones.resetRoi()
+        conv.convolve(ones, kernel, kw, kh)
+        ones.setRoi(vx, vy, w, h)
+        counts[dz] = ones.crop()
+
+        sums[dz] = []
+        for fp in fps:
+            padded = FloatProcessor(w + 2 * vx, h + 2 * vy)
+            padded.insert(fp, vx, vy)
+            conv.convolve(padded, kernel, kw, kh)
+            padded.setRoi(vx, vy, w, h)
+            sums[dz].append(padded.crop())
+
+    out = []
+    for z in range(d):
+        total = FloatProcessor(w, h)
+        count = FloatProcessor(w, h)
+        for dz in sections:
+            if 0 <= z + dz < d:
+                total.copyBits(sums[dz][z + dz], 0, 0, Blitter.ADD)
+                count.copyBits(counts[dz], 0, 0, Blitter.ADD)
+        total.copyBits(count, 0, 0, Blitter.DIVIDE)
+        out.append(total)
+    return _to_stack(out, bit_depth)
+
+
+class SlidingHistogram(object):
+    def __init__(self, bits):
+        # type: (int) -> SlidingHistogram
+        """
+    Histogram of integer values with a median that follows the updates (Huang's algorithm). A coarse level of
+    2^(bits/2) bins lets the median skip empty ranges of 16-bit data quickly
+        """
+        self.shift = bits // 2
+        self.block = 1 << self.shift
+        self.fine = [0] * (1 << bits)
+        self.coarse = [0] * (1 << (bits - self.shift))
+        self.n = 0
+        self.med = 0
+        # number of values < med
+        self.lt = 0
+
+    def add(self, v):
+        self.fine[v] += 1
+        self.coarse[v >> self.shift] += 1
+        self.n += 1
+        if v < self.med:
+            self.lt += 1
+
+    def remove(self, v):
+        self.fine[v] -= 1
+        self.coarse[v >> self.shift] -= 1
+        self.n -= 1
+        if v < self.med:
+            self.lt -= 1
+
+    def median(self):
+        # type: () -> int
+        """
+    Element of rank n // 2 of the sorted values
+        """
+        k = self.n // 2
+        fine, coarse, shift, block = self.fine, self.coarse, self.shift, self.block
+        m, lt = self.med, self.lt
+        while lt > k:
+            if m % block == 0 and lt - coarse[(m >> shift) - 1] > k:
+                # the whole previous block is above the median
+                m -= block
+                lt -= coarse[m >> shift]
+            else:
+                m -= 1
+                lt -= fine[m]
+        while lt + fine[m] <= k:
+            if m % block == 0 and lt + coarse[m >> shift] <= k:
+                # the whole block is below the median
+                lt += coarse[m >> shift]
+                m += block
+            else:
+                lt += fine[m]
+                m += 1
+        self.med, self.lt = m, lt
+        return m
+
+
+def kernel_steps(rx, ry, rz):
+    # type: (float, float, float) -> dict
+    """
+Voxels leaving and entering the ellipsoid kernel (see ellipsoid_rows) when its center moves by one voxel
+
+    :return: Dict (axis, sign) -> (leaving, entering), lists of (dx, dy, dz) offsets from the old and from the new
+    center respectively (axis 0, 1, 2 for x, y, z)
+    """
+    def factory():
+        kernel = set()
+        for dy, dz, a in ellipsoid_rows(rx, ry, rz):
+            for dx in range(-a, a + 1):
+                kernel.add((dx, dy, dz))
+        steps = {}
+        for axis in range(3):
+            for sign in (1, -1):
+                e = [0, 0, 0]
+                e[axis] = sign
+                leaving = [o for o in kernel if (o[0] - e[0], o[1] - e[1], o[2] - e[2]) not in kernel]
+                entering = [o for o in kernel if (o[0] + e[0], o[1] + e[1], o[2] + e[2]) not in kernel]
+                steps[(axis, sign)] = (sorted(leaving), sorted(entering))
+        return steps
+
+    return _kernels.get(('steps', rx, ry, rz), factory)
+
+
+def serpentine(w, h, d):
+    """
+Every voxel of a w x h x d stack once, each one next to the previous (rows back and forth, then slices back and
+forth)
+    """
+    x = y = 0
+    dir_x = dir_y = 1
+    for z in range(d):
+        for j in range(h):
+            for i in range(w):
+                yield x, y, z
+                if i < w - 1:
+                    x += dir_x
+            dir_x = -dir_x
+            if j < h - 1:
+                y += dir_y
+        dir_y = -dir_y
+
+
+def sliding_median(data, w, h, d, rx, ry, rz, bits):
+    # type: (list, int, int, int, float, float, float, int) -> list
+    """
+Median over the ellipsoid of radii (rx, ry, rz) of every voxel, voxels outside the stack excluded. A single
+histogram follows the kernel along a serpentine path through the stack: every step only removes the voxels
+leaving the kernel and adds those entering it (see kernel_steps)
+
+    :param data: Slices as lists of unsigned integer values (row by row)
+
+    :return: Filtered slices, as lists of unsigned integer values
+    """
+    steps = kernel_steps(rx, ry, rz)
+    hist = SlidingHistogram(bits)
+    out = [[0] * (w * h) for _ in range(d)]
+
+    def update(offsets, x, y, z, func):
+        for dx, dy, dz in offsets:
+            u, v, s = x + dx, y + dy, z + dz
+            if 0 <= u < w and 0 <= v < h and 0 <= s < d:
+                func(data[s][v * w + u])
+
+    for dy, dz, a in ellipsoid_rows(rx, ry, rz):
+        update([(dx, dy, dz) for dx in range(-a, a + 1)], 0, 0, 0, hist.add)
+    px = py = pz = 0
+    for x, y, z in serpentine(w, h, d):
+        if x != px:
+            leaving, entering = steps[(0, x - px)]
+        elif y != py:
+            leaving, entering = steps[(1, y - py)]
+        elif z != pz:
+            leaving, entering = steps[(2, z - pz)]
+        else:
+            leaving = entering = ()
+        update(leaving, px, py, pz, hist.remove)
+        update(entering, x, y, z, hist.add)
+        out[z][y * w + x] = hist.median()
+        px, py, pz = x, y, z
+    return out
+
+
+def median(stack, sigma, scaleZ):
+    # type: (ImageStack, float, float) -> ImageStack
+    """
+Median over the ellipsoid of radii (sigma, sigma, sigma * scaleZ), voxels outside the stack excluded (as ImageJ
+Filters3D.MEDIAN), with a sliding histogram (see sliding_median). Still a Python loop per voxel: under Jython it is
+slower than the Java median of ImageJ, so the fast engine of filters.filter_imp does not use it (see filter_bench.py)
+    """
+    bit_depth = stack.getBitDepth()
+    if bit_depth not in (8, 16):
+        raise ValueError('Sliding histogram median needs 8 or 16-bit data')
+    mask = 0xff if bit_depth == 8 else 0xffff
+    w, h, d = stack.getWidth(), stack.getHeight(), stack.getSize()
+    data = [[v & mask for v in stack.getPixels(n)] for n in range(1, d + 1)]
+    filtered = sliding_median(data, w, h, d, sigma, sigma, sigma * scaleZ, bit_depth)
+
+    # back to the signed values of java byte/short arrays
+    half = (mask + 1) // 2
+    out_stack = ImageStack(w, h)
+    for z in range(d):
+        out_ip = stack.getProcessor(z + 1).createProcessor(w, h)
+        out_ip.setPixels(array([v if v < half else v - mask - 1 for v in filtered[z]],
+                               'b' if bit_depth == 8 else 'h'))
+        out_stack.addSlice(out_ip)
+    return out_stack
+
+
+def filter_stack(stack, method, sigma, scaleZ):
+    # type: (ImageStack, str, float, float) -> ImageStack
+    """
+Filter a stack with the fast engine (same options and kernels of filters.filter_imp)
+
+    :param method: name of filter, can be 'gauss', 'mean' or 'median'
+
+    :param sigma: sigma value along xy axis (sigma * scaleZ on the z axis)
+
+    :return: New filtered stack with the same bit depth
+    """
+    if method == 'gauss':
+        return gaussian(stack, sigma, scaleZ)
+    elif method == 'mean':
+        return mean(stack, sigma, scaleZ)
+    elif method == 'median':
+        return median(stack, sigma, scaleZ)
+    else:
+        raise ValueError('Filter not valid: ' + method)
@@ -0,0 +1,139 @@
+"""
+Benchmark and equivalence check of the filter engines (filters.filter_imp with engine 'ij' and 'fast')
+
+Run it in Fiji (Jython): both engines filter the same cubes, the script logs the time taken by each one and the
+differences of the filtered voxels. With no image a synthetic stack is used. The fast engine uses the ImageJ median,
+so for the median the sliding histogram (fastfilters.median) is timed instead
+"""
+
+from __future__ import print_function
+import random
+import time
+
+from ij import IJ, ImagePlus, ImageStack
+from ij.process import ShortProcessor
+
+import fastfilters
+from filters import filter_imp
+
+img_path = None  # image to crop the cubes from (synthetic stack if None)
+n_cubes = 5
+cube_dim = 70
+scaleZ = 0.4
+sigmas = [1, 2, 3]
+methods = ['gauss', 'mean', 'median']
+
+# max abs difference (in grey levels) accepted per method: mean and median use the same kernel of ImageJ (only
+# rounding can differ), gauss differs where ImageJ downsamples or smooths the kernel edges
+tolerance = {'gauss': 2, 'mean': 1, 'median': 0}
+
+
+def synthetic_stack(w, h, d, seed=0):
+    # type: (int, int, int, int) -> ImageStack
+    """
+16-bit stack with gaussian noise over a few bright blobs
+    """
+    rnd = random.Random(seed)
+    blobs = [(rnd.uniform(0, w), rnd.uniform(0, h), rnd.uniform(0, d), rnd.uniform(4, 12)) for _ in range(6)]
+    stack = ImageStack(w, h)
+    for z in range(d):
+        pixels = []
+        for y in range(h):
+            for x in range(w):
+                v = 200 + rnd.gauss(0, 30)
+                for bx, by, bz, br in blobs:
+                    d2 = (x - bx) ** 2 + (y - by) ** 2 + ((z - bz) / scaleZ) ** 2
+                    if d2 < br * br:
+                        v += 1500
+                pixels.append(min(max(int(v), 0), 65535))
+        ip = ShortProcessor(w, h)
+        for i, v in enumerate(pixels):
+            ip.set(i, v)
+        stack.addSlice(ip)
+    return stack
+
+
+def cubes(n, dim):
+    # type: (int, int) -> list
+    """
+Cubes of dim x dim x dim*scaleZ voxels, cropped at random positions of the image (or synthetic)
+    """
+    depth = int(dim * scaleZ)
+    if img_path is None:
+        return [synthetic_stack(dim, dim, depth, seed=i) for i in range(n)]
+
+    imp = IJ.openImage(img_path)
+    rnd = random.Random(0)
+    stack = imp.getImageStack()
+    out = []
+    for _ in range(n):
+        x0 = rnd.randint(0, max(imp.getWidth() - dim, 0))
+        y0 = rnd.randint(0, max(imp.getHeight() - dim, 0))
+        z0 = rnd.randint(0, max(imp.getNSlices() - depth, 0))
+        out.append(stack.crop(x0, y0, z0, min(dim, imp.getWidth()), min(dim, imp.getHeight()),
+                              min(depth, imp.getNSlices())))
+    imp.close()
+    return out
+
+
+def run_engine(stack, method, sigma, engine):
+    # type: (ImageStack, str, float, str) -> tuple
+    """
+    :param engine: 'ij', 'fast' or 'sliding' (fastfilters.median, median only)
+
+    :return: (filtered stack, seconds)
+    """
+    imp = ImagePlus('cube', stack.duplicate())
+    t = time.time()
+    if engine == 'sliding':
+        imp.setStack(fastfilters.median(imp.getImageStack(), sigma, scaleZ))
+    else:
+        filter_imp(imp, method, sigma, scaleZ, engine)
+    return imp.getImageStack(), time.time() - t
+
+
+def compare(a, b):
+    # type: (ImageStack, ImageStack) -> tuple
+    """
+    :return: (max abs difference, mean abs difference) of the voxels of two stacks of the same shape
+    """
+    max_diff = 0.
+    total = 0.
+    n = 0
+    for s in range(1, a.getSize() + 1):
+        ipa, ipb = a.getProcessor(s), b.getProcessor(s)
+        for i in range(ipa.getPixelCount()):
+            diff = abs(ipa.getf(i) - ipb.getf(i))
+            max_diff = max(max_diff, diff)
+            total += diff
+            n += 1
+    return max_diff, total / n
+
+
+def main():
+    IJ.log('Filter engines on {} cubes of {} px (scaleZ {})'.format(n_cubes, cube_dim, scaleZ))
+    stacks = cubes(n_cubes, cube_dim)
+    all_ok = True
+    for method in methods:
+        for sigma in sigmas:
+            t_ij = t_fast = 0.
+            max_diff = mean_diff = 0.
+            for stack in stacks:
+                ref, t = run_engine(stack, method, sigma, 'ij')
+                t_ij += t
+                out, t = run_engine(stack, method, sigma, 'sliding' if method == 'median' else 'fast')
+                t_fast += t
+                mx, mn = compare(ref, out)
+                max_diff = max(max_diff, mx)
+                mean_diff += mn / len(stacks)
+            ok = max_diff <= tolerance[method]
+            all_ok = all_ok and ok
+            IJ.log('{} sigma {}: ij {:.3f}s, fast {:.3f}s (x{:.1f}), max diff {:.2f}, mean diff {:.4f} {}'.format(
+                method, sigma, t_ij, t_fast, t_ij / t_fast if t_fast > 0 else float('inf'), max_diff, mean_diff,
+                'OK' if ok else 'FAILED'))
+    IJ.log('Equivalence: ' + ('OK' if all_ok else 'FAILED'))
+    return all_ok
+
+
+if __name__ in ['__builtin__', '__main__']:
+    main()
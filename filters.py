@@ -1,39 +1,85 @@
+import math
+
 from ij import IJ
 from ij.plugin import GaussianBlur3D, Filters3D
+
+import fastfilters
 from stacks import CellStack
 
 
-def gaussianIJ(cs, xysigma):
-    # type: (CellStack, float) -> None
+def gaussianIJ(cs, xysigma, scaleZ=None):
+    # type: (CellStack, float, float) -> None
     """
 Perform ImageJ gaussian blur 3D with same sigma along x and y axes on a CellStack
+(or any ImagePlus if scaleZ is given)
     """
-    zsigma = cs.scaleZ * xysigma
+    if scaleZ is None:
+        scaleZ = cs.scaleZ
+    zsigma = scaleZ * xysigma
     GaussianBlur3D.blur(cs, xysigma, xysigma, zsigma)
 
 
-def medianIJ(cs, xysigma):
-    # type: (CellStack, float) -> None
+def medianIJ(cs, xysigma, scaleZ=None):
+    # type: (CellStack, float, float) -> None
     """
 Perform ImageJ median filter 3D with same sigma along x and y axes on a CellStack (locally)
+(or any ImagePlus if scaleZ is given)
     """
+    if scaleZ is None:
+        scaleZ = cs.scaleZ
     stack = cs.getImageStack()
-    new_stack = Filters3D.filter(stack, Filters3D.MEDIAN, xysigma, xysigma, xysigma * cs.scaleZ)
+    new_stack = Filters3D.filter(stack, Filters3D.MEDIAN, xysigma, xysigma, xysigma * scaleZ)
     cs.setStack(new_stack)
 
 
-def meanIJ(cs, xysigma):
-    # type: (CellStack, float) -> None
+def meanIJ(cs, xysigma, scaleZ=None):
+    # type: (CellStack, float, float) -> None
     """
 Perform ImageJ mean filter 3D with same sigma along x and y axes on a CellStack (locally)
+(or any ImagePlus if scaleZ is given)
     """
+    if scaleZ is None:
+        scaleZ = cs.scaleZ
     stack = cs.getImageStack()
-    new_stack = Filters3D.filter(stack, Filters3D.MEAN, xysigma, xysigma, xysigma * cs.scaleZ)
+    new_stack = Filters3D.filter(stack, Filters3D.MEAN, xysigma, xysigma, xysigma * scaleZ)
     cs.setStack(new_stack)
 
 
-def filter_cellstack(cs, method, sigma):
-    # type: (CellStack, str, float) -> None
+def filter_imp(imp, method, sigma, scaleZ, engine='ij'):
+    # type: (ImagePlus, str, float, float, str) -> None
+    """
+Perform the requested filter on any ImagePlus (see filter_cellstack)
+    """
+    if engine == 'fast' and method in ('gauss', 'mean'):
+        # the median stays the ImageJ one: the sliding histogram of fastfilters.median is a Python loop per voxel,
+        # slower than the Java median under Jython (see filter_bench.py)
+        imp.setStack(fastfilters.filter_stack(imp.getImageStack(), method, sigma, scaleZ))
+    elif method == 'gauss':
+        gaussianIJ(imp, sigma, scaleZ)
+    elif method == 'mean':
+        meanIJ(imp, sigma, scaleZ)
+    elif method == 'median':
+        medianIJ(imp, sigma, scaleZ)
+    else:
+        IJ.error('Filter not valid: ' + method + '\nImage not filtered')
+
+
+def filter_halo(method, sigma, scaleZ):
+    # type: (str, float, float) -> int
+    """
+Number of slices above and below a voxel that affect its filtered value
+
+    :return: Depth of the halo needed to filter a slab of slices as part of the whole volume
+    """
+    zsigma = sigma * scaleZ
+    if method == 'gauss':
+        # ImageJ gaussian kernels are cut where the tail is below 0.0002 (about 4.1 sigma)
+        return int(math.ceil(4.5 * zsigma)) + 1
+    return int(math.ceil(zsigma)) + 1
+
+
+def filter_cellstack(cs, method, sigma, engine='ij'):
+    # type: (CellStack, str, float, str) -> None
     """
 Perform the requested filter
 
@@ -42,12 +88,11 @@ Perform the requested filter
     :param method: name of filter, can be 'gauss', 'mean' or 'median'
 
     :param sigma: sigma value along xy axis (on the z axis it is self-computed using CellStack z scale value)
+
+    :param engine: 'ij' for the ImageJ filters, 'fast' for the separable gaussian and the sectioned mean of
+    fastfilters (same kernels, see filter_bench.py for speed and differences), the median is always the ImageJ one
     """
-    if method == 'gauss':
-        gaussianIJ(cs, sigma)
-    elif method == 'mean':
-        meanIJ(cs, sigma)
-    elif method == 'median':
-        medianIJ(cs, sigma)
-    else:
-        IJ.error('Filter not valid: ' + method + '\nImage not filtered')
+    # filters modify the voxels, a view needs its own copy first
+    cs.materialize()
+
+    filter_imp(cs, method, sigma, cs.scaleZ, engine)
@@ -0,0 +1,253 @@
+import math
+import threading
+from collections import OrderedDict
+
+import instrument
+
+
+class LRUCache(object):
+    def __init__(self, max_size=64):
+        # type: (int) -> LRUCache
+        """
+    Thread safe dict with bounded size: when full, the least recently used entry is evicted
+
+        :param max_size: Maximum number of entries
+        """
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory):
+        """
+    Return the value stored for key, computing it with factory() (and storing it) if missing
+        """
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = factory()
+
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class OffsetTable(object):
+    def __init__(self, offsets, scaleZ, sort=True):
+        # type: (list, float, bool) -> OffsetTable
+        """
+    Precomputed voxel offsets around a center.
+    The (anisotropic) squared distance is d2 = dx^2 + dy^2 + (dz / scaleZ)^2, as in the mcib3d layers
+
+        :param offsets: List of (dx, dy, dz) tuples
+
+        :param scaleZ: Depth of a voxel (1 if image is isotropic)
+
+        :param sort: Sort the offsets by distance from the center (otherwise the given order is kept)
+        """
+        ratio = 1. / scaleZ
+        if sort:
+            offsets = sorted(offsets, key=lambda o: (o[0] * o[0] + o[1] * o[1] + o[2] * o[2] * ratio * ratio,
+                                                     o[2], o[1], o[0]))
+
+        self.scaleZ = scaleZ
+        self.dx = [o[0] for o in offsets]
+        self.dy = [o[1] for o in offsets]
+        self.dz = [o[2] for o in offsets]
+        self.d2 = [o[0] * o[0] + o[1] * o[1] + o[2] * o[2] * ratio * ratio for o in offsets]
+        # shell index r of every offset, i.e. r <= d < r+1
+        self.shell = [int(math.sqrt(d2)) for d2 in self.d2]
+        self._dxy = {}
+
+        # half sizes of the bounding box
+        self.ext_x = max([abs(o[0]) for o in offsets] + [0])
+        self.ext_y = max([abs(o[1]) for o in offsets] + [0])
+        self.ext_z = max([abs(o[2]) for o in offsets] + [0])
+
+    def __len__(self):
+        return len(self.dx)
+
+    def dxy_for(self, stride):
+        # type: (int) -> list
+        """
+    Index displacement of every offset inside a slice of the given width (pixel index is y * stride + x)
+        """
+        dxy = self._dxy.get(stride)
+        if dxy is None:
+            dxy = [dy * stride + dx for dx, dy in zip(self.dx, self.dy)]
+            self._dxy[stride] = dxy
+        return dxy
+
+    def fits(self, pos, shape):
+        # type: (list, tuple) -> bool
+        """
+    True if every offset around pos falls inside a stack of the given shape (no bounds check needed)
+        """
+        return (self.ext_x <= pos[0] < shape[0] - self.ext_x and
+                self.ext_y <= pos[1] < shape[1] - self.ext_y and
+                self.ext_z <= pos[2] < shape[2] - self.ext_z)
+
+
+# shared by every stage (and thread) of a run, the keys depend only on the run parameters and on the extents of the
+# tables clipped to the cubes (not on the cube shapes: cubes of any size larger than a table share it)
+_tables = LRUCache(max_size=128)
+
+
+def _extents(radius, scaleZ, shape):
+    # type: (float, float, tuple) -> tuple
+    """
+Half sizes (x, y, z) of the bounding box of the ball of the given radius, clipped to the cube shape: an offset
+beyond shape - 1 voxels never falls inside the cube
+    """
+    vxy = int(math.ceil(radius))
+    # same rounding of the original bounds (radius / ratio, not radius * scaleZ)
+    vz = int(math.ceil(radius / (1. / scaleZ)))
+    if shape is None:
+        return vxy, vxy, vz
+    return min(vxy, shape[0] - 1), min(vxy, shape[1] - 1), min(vz, shape[2] - 1)
+
+
+def _ball(radius, scaleZ, extents, inclusive):
+    # type: (float, float, tuple, bool) -> list
+    """
+Offsets with d <= radius (d < radius if not inclusive) inside the extents (see _extents)
+    """
+    ratio = 1. / scaleZ
+    r2 = radius * radius
+    vx, vy, vz = extents
+
+    offsets = []
+    for dz in range(-vz, vz + 1):
+        dz2 = dz * dz * ratio * ratio
+        for dy in range(-vy, vy + 1):
+            for dx in range(-vx, vx + 1):
+                d2 = dx * dx + dy * dy + dz2
+                if d2 < r2 or (inclusive and d2 == r2):
+                    offsets.append((dx, dy, dz))
+    return offsets
+
+
+def sphere_offsets(radius, scaleZ, shape=None):
+    # type: (float, float, tuple) -> OffsetTable
+    """
+Offsets of the voxels at distance d <= radius (as ImageHandler.getNeighborhoodSphere)
+
+    :param shape: (width, height, depth) of the cell stacks where the table is used
+    """
+    extents = _extents(radius, scaleZ, shape)
+    key = ('sphere', radius, scaleZ, extents)
+    return _tables.get(key, lambda: OffsetTable(_ball(radius, scaleZ, extents, True), scaleZ))
+
+
+def shell_offsets(r0, r1, scaleZ, shape=None):
+    # type: (float, float, float, tuple) -> OffsetTable
+    """
+Offsets of the voxels at distance r0 <= d < r1 (as ImageHandler.getNeighborhoodLayer)
+
+    :param shape: (width, height, depth) of the cell stacks where the table is used
+    """
+    extents = _extents(r1, scaleZ, shape)
+
+    def factory():
+        ratio = 1. / scaleZ
+        r02 = r0 * r0
+        offsets = [o for o in _ball(r1, scaleZ, extents, False)
+                   if o[0] * o[0] + o[1] * o[1] + o[2] * o[2] * ratio * ratio >= r02]
+        return OffsetTable(offsets, scaleZ)
+
+    key = ('shell', r0, r1, scaleZ, extents)
+    return _tables.get(key, factory)
+
+
+def neighborhood_offsets(scaleZ=1.):
+    # type: (float) -> OffsetTable
+    """
+Offsets of the 26 nearest neighbors (center excluded), in the same order of neigh.nearest_neighborhood (not clipped,
+one table for every cube)
+    """
+    def factory():
+        interval = [-1, 0, 1]
+        offsets = [(dx, dy, dz) for dz in interval for dy in interval for dx in interval
+                   if not (dx == 0 and dy == 0 and dz == 0)]
+        return OffsetTable(offsets, scaleZ, sort=False)
+
+    key = ('neigh26', scaleZ)
+    return _tables.get(key, factory)
+
+
+def gather(buf, table, pos, shape, count=True):
+    # type: (VoxelBuffer, OffsetTable, list, tuple, bool) -> iter
+    """
+Generate the voxels of the table around pos which are inside the stack
+
+    :param buf: VoxelBuffer of the stack (see CellStack.voxels)
+
+    :param table: OffsetTable
+
+    :param pos: 3D coordinates of the center
+
+    :param shape: (width, height, depth) of the stack
+
+    :param count: Add the number of voxels generated to the 'voxels' counter (see instrument) once the generator is
+    exhausted, callers that may stop early count the voxels themselves
+
+    :return: Pairs (i, v) with i index of the offset in the table and v voxel value
+    """
+    x, y, z = pos
+    w, h, d = shape
+    slices, stride, mask = buf.slices, buf.stride, buf.mask
+    dx, dy, dz = table.dx, table.dy, table.dz
+    if table.fits(pos, shape):
+        base = (y + buf.y0) * stride + x + buf.x0
+        z += buf.z0
+        dxy = table.dxy_for(stride)
+        for i in range(len(table)):
+            v = slices[z + dz[i]][base + dxy[i]]
+            if mask is not None:
+                v &= mask
+            yield i, v
+        if count:
+            instrument.count('voxels', len(table))
+    else:
+        # offsets clipped by the border of the stack are not counted
+        n = 0
+        for i in range(len(table)):
+            xi = x + dx[i]
+            yi = y + dy[i]
+            zi = z + dz[i]
+            if 0 <= xi < w and 0 <= yi < h and 0 <= zi < d:
+                v = slices[zi + buf.z0][(yi + buf.y0) * stride + xi + buf.x0]
+                if mask is not None:
+                    v &= mask
+                n += 1
+                yield i, v
+        if count:
+            instrument.count('voxels', n)
+
+
+def stack_shape(cs):
+    # type: (CellStack) -> tuple
+    """
+Shape (width, height, depth) of a cell stack, clipping the offset tables (see _extents)
+    """
+    return cs.roi3D['width'], cs.roi3D['height'], cs.roi3D['depth']
+
+
+def cache_info():
+    # type: () -> dict
+    return {'size': len(_tables), 'hits': _tables.hits, 'misses': _tables.misses}
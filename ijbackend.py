@@ -0,0 +1,57 @@
+from backends import Backend
+from filters import filter_cellstack
+from mean_shift import ms_center
+from rad3d import RadialProfile
+from sources import open_source, binned_source
+from stacks import gen_cell_stacks
+from utils import local_max, find_maxima, image_watershed
+
+
+class IJBackend(Backend):
+    """
+    ImageJ/mcib3d backend: cells are CellStack (views of the source when possible), the voxels are read through
+    VoxelBuffer and the offset tables of geometry.py, filters and maxima are the ImageJ and mcib3d ones
+    """
+    name = 'ij'
+
+    def open_image(self, img_path, mode='full', cache_slices=64):
+        return open_source(img_path, mode=mode, cache_slices=cache_slices)
+
+    def image_height(self, image):
+        return image.height
+
+    def close_image(self, image):
+        image.close()
+
+    def cells(self, image, seeds, cube_dim, scaleZ, order='file', dims=None):
+        return gen_cell_stacks(image, seeds, cube_dim, scaleZ, view=True, order=order, dims=dims)
+
+    def close_cell(self, cell):
+        cell.close()
+
+    def prepare(self, cell):
+        cell.set_calibration()
+
+    def get_voxel(self, cell, pos):
+        return cell.get_voxel(pos)
+
+    def filter(self, cell, method, sigma, engine='ij'):
+        filter_cellstack(cell, method=method, sigma=sigma, engine=engine)
+
+    def local_max(self, cell, seed):
+        return local_max(cell, seed)
+
+    def radial_profile(self, cell, max_rad, center=None, lazy=False, min_rad=0):
+        return RadialProfile(cell, max_rad, center, lazy=lazy, min_rad=min_rad)
+
+    def find_maxima(self, cell, rad, thresh):
+        return find_maxima(cell, rad, thresh)
+
+    def mean_shift(self, cell, radius, peaks, sigma, thresh, log=None):
+        return ms_center(cell, radius, peaks, sigma, thresh, log=log)
+
+    def downsample(self, image, factor, z_factor):
+        return binned_source(image, factor, z_factor)
+
+    def watershed(self, image, seeds, thresholds):
+        return image_watershed(image, seeds, thresholds)
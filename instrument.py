@@ -0,0 +1,175 @@
+from __future__ import with_statement
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# metrics of the cell measured by the current thread (see Metrics.activate)
+_local = threading.local()
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+    Time spent in every stage and counters of one unit of work (a cell, or the image level operations of an image).
+    Stages entered more than once accumulate their time
+        """
+        self.times = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_time(self, name, seconds):
+        # type: (str, float) -> None
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.) + seconds
+
+    def count(self, name, n=1):
+        # type: (str, int) -> None
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def stage(self, name):
+        """
+    Time the block as stage name:
+
+        with metrics.stage('local_max'):
+            ...
+        """
+        t = time.time()
+        try:
+            yield self
+        finally:
+            self.add_time(name, time.time() - t)
+
+    def timed(self, name):
+        """
+    Decorator timing every call of a function as stage name
+        """
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def activate(self):
+        """
+    Make these the metrics of the current thread for the block, so that deep functions (e.g. geometry.gather) can
+    update the counters through instrument.count without receiving them as argument
+        """
+        previous = getattr(_local, 'metrics', None)
+        _local.metrics = self
+        try:
+            yield self
+        finally:
+            _local.metrics = previous
+
+    def as_record(self):
+        # type: () -> dict
+        """
+    Flat dict for the results file: t_<stage> for the times and the counters with their own name
+        """
+        record = dict(('t_' + k, v) for k, v in self.times.items())
+        record.update(self.counters)
+        return record
+
+
+def current():
+    # type: () -> Metrics
+    """
+    :return: Metrics active in this thread, None if there is none
+    """
+    return getattr(_local, 'metrics', None)
+
+
+def count(name, n=1):
+    # type: (str, int) -> None
+    """
+Update a counter of the metrics active in this thread (no-op if there are none)
+    """
+    metrics = getattr(_local, 'metrics', None)
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def percentile(sorted_values, p):
+    # type: (list, float) -> float
+    """
+Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return float('nan')
+    k = max(int(math.ceil(p / 100. * len(sorted_values))) - 1, 0)
+    return sorted_values[k]
+
+
+def stats(values):
+    # type: (list) -> dict
+    values = sorted(values)
+    return {
+        'n': len(values),
+        'total': sum(values),
+        'mean': float(sum(values)) / len(values) if values else float('nan'),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'max': values[-1] if values else float('nan')
+    }
+
+
+class ImageMetrics(object):
+    def __init__(self, name):
+        # type: (str) -> ImageMetrics
+        """
+    Metrics of an image: its own operations (open, prefilter, ...) and the values of every cell, which are
+    summarized as distributions (p50/p95/max per stage and counter)
+        """
+        self.name = name
+        self.image = Metrics()
+        self.cells = {}
+        self.lock = threading.Lock()
+
+    def add_cell(self, metrics):
+        # type: (Metrics) -> None
+        with self.lock:
+            for k, v in list(metrics.times.items()) + list(metrics.counters.items()):
+                self.cells.setdefault(k, []).append(v)
+
+    def to_dict(self):
+        # type: () -> dict
+        return {
+            'image': self.name,
+            'image_times': self.image.times,
+            'image_counters': self.image.counters,
+            'cell_values': self.cells,
+            'cells': dict((k, stats(v)) for k, v in self.cells.items())
+        }
+
+    def write(self, path):
+        # type: (str) -> None
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+
+def run_summary(image_dicts):
+    # type: (list) -> dict
+    """
+Summary of a whole run from the metrics of its images (ImageMetrics.to_dict, e.g. read back from their files):
+distributions of the cell values and of the image times (t_<stage>) and counters
+    """
+    cells = {}
+    images = {}
+    for d in image_dicts:
+        for k, v in d['cell_values'].items():
+            cells.setdefault(k, []).extend(v)
+        for k, v in d['image_times'].items():
+            images.setdefault('t_' + k, []).append(v)
+        for k, v in d.get('image_counters', {}).items():
+            images.setdefault(k, []).append(v)
+    return {
+        'n_images': len(image_dicts),
+        'cells': dict((k, stats(v)) for k, v in cells.items()),
+        'images': dict((k, stats(v)) for k, v in images.items())
+    }
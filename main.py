@@ -12,25 +12,50 @@ TODOs:
 """
 
 from __future__ import with_statement, print_function
+import json
 import os
+import time
 
 from java.awt import Color
 from ij import IJ, ImageJ
 from ij.gui import PointRoi
 
 import markers as mrk
-from rad3d import radius_thresh, radial_distribution_3D
-from stacks import gen_cell_stacks
-from utils import find_maxima, local_mean, local_max
+import pipeline
+from backends import get_backend
+from rad3d import RadialProfile
+from stacks import gen_cell_stacks, absolute_position
+from utils import local_max, image_maxima
 from filters import filter_cellstack
-from mean_shift import ms_center
 from display import apply_lut, circle_roi
+from results import ResultSink
+from parallel import map_cells, cell_pool
+from tiles import gen_tiles, gen_tiled_cell_stacks
+from scheduler import build_manifest, run_worker, all_done, merge_results, list_images
+from sweep import param_grid, write_sweep
+from sources import open_source
+from prefilter import prefiltered_source
+from cache import open_cache, image_digest
+from instrument import Metrics, ImageMetrics, run_summary
+from pyramid import pyramid_image
+from segment import segment_image
 
 # inputs
 source_dir = '/home/zemp/bcfind_GT'
 cube_roi_dim = 70  # dim of cube as region of interest (ROI) around every cell center
+# batch mode: cube of every cell sized on a first estimate of its radius (up to cube_roi_dim), see pipeline.crop_dims
+adaptive_crop = False
+crop_margin = 8  # voxels between the estimated radius and the edge of the cube, the cube grows within margin / 2
+min_crop_dim = 24
 scaleZ = 0.4  # approx proportion with xy axis
 
+# 'cells' measures every seed in its cube, 'segment' splits the whole image with one seeded watershed (batch mode only,
+# for dense regions, see segment.py), 'pyramid' estimates every cell on a binned copy of the image and refines the
+# radius in a band of shells at full resolution (batch mode only, see pyramid.py)
+algorithm = 'cells'
+pyramid_factor = 4  # xy binning of the coarse image (z binning follows scaleZ)
+pyramid_band = 2  # shells around the coarse radius computed at full resolution
+
 # recenter seed using local_mean
 recenter = True
 
@@ -43,13 +68,18 @@ meanw = 0.4
 # filter params
 method = 'none'
 sigma = 2
+filter_engine = 'ij'  # 'ij' (ImageJ filters) or 'fast' (fastfilters, see filter_bench.py)
 
 # 3d radial distribution
-max_rad = 40
+max_rad = 40  # shells from r2 to max_rad are computed only up to the crossing
+radius_confirm = 0  # shells after the crossing that must stay below the local mean (0: first crossing is the radius)
 plot_rad3d = True
 
 # maxima param
-noise_tol = 0
+noise_tol = 0  # noise tolerance of the image-wide maxima, keep 0: every cell applies its local mean afterwards
+global_maxima = False  # batch mode: find the maxima of the whole image once instead of in every cell cube
+maxima_rad = 2  # search radius of the image-wide maxima (the per cell radius // 2 is applied afterwards)
+maxima_slab_depth = None  # read the image in slabs of this many slices for the maxima (whole volume if None)
 
 # mean shift param
 ms_sigma = 10  # gaussian kernel param
@@ -60,52 +90,108 @@ cmap = 'fire'
 # display
 circle = True
 discard_margin_cells = False
+# records of the cells shown, appended as they are measured (cells already in the file are skipped when run again),
+# e.g. os.path.join(source_dir, 'bcmeasure_interactive.csv'). None: nothing is written, every cell is shown
+interactive_results_path = None
+
+# batch mode (no GUI, no prompts, one record per marker in results_path)
+headless = False
+results_path = os.path.join(source_dir, 'bcmeasure_results.csv')
+results_batch = 64  # cell records written to the results files in batches of this many rows (synced at every image)
+verbose = False  # log intermediate values of every cell also in batch mode (only with n_workers = 1)
+n_workers = 1  # threads measuring the cells of an image (e.g. parallel.default_workers())
+work_dir = os.path.join(source_dir, 'bcmeasure_work')  # manifest, leases, checkpoints (shared by all processes)
+n_shards = 1  # number of work units in which the dataset is split (used only when the manifest is created)
+lease_timeout = 3600  # seconds after which the shard of a crashed process can be taken over
+image_source = 'full'  # 'full' loads the whole volume, 'virtual' or 'mmap' read only the slices around the cells
+slice_cache = 64  # slices kept in memory by the 'virtual' and 'mmap' sources
+cell_order = 'morton'  # 'file' (marker order) or 'morton' (neighbor cells in a row, better slice cache reuse)
+tile_dim = None  # group the cells in blocks of tile_dim voxels read with one crop (each cell crops its cube if None)
+tile_budget = 256 * 1024 * 1024  # max bytes of a tile, larger groups of cells are split
+view_stacks = True  # cells read the voxels of the loaded image, the cube is copied only for filters and maxima
+prefilter = False  # filter the whole image once (cached in filter_cache_dir) instead of every cell cube
+filter_cache_dir = os.path.join(work_dir, 'filtered')
+use_cache = False  # cache the output of every stage of every cell, re-runs compute only what changed
+cache_dir = os.path.join(work_dir, 'cache')
+cache_max_bytes = 512 * 1024 * 1024  # least recently used entries are removed above this size
+filter_slab_depth = None  # stream the image filter in slabs of this many slices (whole volume at once if None)
+# stage times and counters of every image and of the whole run. None: work_dir/metrics in batch mode, nothing written
+# by the interactive mode
+metrics_dir = None
+
+# parameter sweep (headless): every combination is scored on the same radial profiles, one table per combination
+sweep = False
+sweep_r0 = [11, 13, 15]
+sweep_r1 = [15, 18, 20]
+sweep_r2 = [40, 50]
+sweep_meanw = [0.4, 0.5, 0.6]
+sweep_dir = os.path.join(work_dir, 'sweep')
+
+# markers
+marker_sidecar = False  # keep a binary copy of every csv (<name>.markers.bin), loaded through memory mapping
+
+
+def quiet(msg):
+    # type: (str) -> None
+    """
+Logger that drops every message (used in batch mode)
+    """
+    pass
 
 
-def process_cell(cs):
-    IJ.log('Cell at {}'.format(cs.center))
-    cs.set_calibration()
-
-    # filter the image
-    if method != 'none':
-        IJ.log('Applying ' + method + ' 3D filtering')
-        filter_cellstack(cs, method=method, sigma=sigma)
+def cell_params():
+    # type: () -> dict
+    """
+Parameters of the measure pipeline from the configuration above (see pipeline.DEFAULT_PARAMS)
+    """
+    return {
+        'algorithm': algorithm,
+        'method': method, 'sigma': sigma, 'filter_engine': filter_engine, 'prefilter': prefilter,
+        'recenter': recenter,
+        'r0': r0, 'r1': r1, 'r2': r2, 'meanw': meanw,
+        'max_rad': max_rad, 'radius_confirm': radius_confirm,
+        'maxima_rad': maxima_rad, 'noise_tol': noise_tol,
+        'ms_sigma': ms_sigma,
+        'pyramid_factor': pyramid_factor, 'pyramid_band': pyramid_band,
+        'adaptive_crop': adaptive_crop, 'crop_margin': crop_margin, 'min_crop_dim': min_crop_dim
+    }
+
+
+def measure_cell(cs, log=IJ.log, peak_index=None, cache=None, image_key=None, image_metrics=None, max_dim=None,
+                 metrics=None):
+    # type: (CellStack, callable, GridIndex, ResultCache, str, ImageMetrics, int, Metrics) -> dict
+    """
+Run the whole measure pipeline on a cell without any GUI interaction (see pipeline.measure_cell, ImageJ backend)
 
-    # cell stats
-    loc_max = local_max(cs, cs.center)
-    IJ.log('Local max in {}, value: {}'.format(loc_max, cs.get_voxel(loc_max)))
+    :param cs: CellStack of the cell
 
-    if recenter:
-        cs.center = loc_max
+    :param log: Function used to log intermediate values (e.g. IJ.log or quiet)
 
-    loc_mean = local_mean(cs, r0=r0, r1=r1, r2=r2, weight=meanw)
-    IJ.log('Local mean: ' + str(loc_mean))
+    :param peak_index: Maxima of the whole image (see utils.image_maxima), if None they are searched in the cell
 
-    tab = radial_distribution_3D(cs, max_rad=max_rad)
+    :param cache: If given, the output of every stage is cached (see cache.ResultCache)
 
-    radius = radius_thresh(tab, loc_mean)
-    IJ.log('Radius: ' + str(radius))
+    :param image_key: Digest of the image content (see cache.image_digest), required with cache
 
-    # find local maxima in the whole image, even those far from the cell center
-    peaks = find_maxima(cs, radius/2, loc_mean)
-    IJ.log('Peaks: ' + str(peaks))
+    :param image_metrics: If given, the metrics of the cell are added to it (see instrument.ImageMetrics)
 
-    # run mean shift with maxima that are closer to the cell center
-    IJ.log('Applying mean shift...')
-    centroid = ms_center(cs, radius, peaks, ms_sigma, loc_mean)
-    IJ.log('New center: ' + str(centroid))
+    :param max_dim: Largest cube of a cell with adaptive crops (see pipeline.measure_cell)
 
-    # update the centroid
-    cs.center = centroid
+    :param metrics: Metrics of the adaptive crop pass of the cell (see pipeline.crop_dims), new ones if None
 
-    # apply local_mean thresh to radial distribution
-    new_loc_mean = local_mean(cs, r0=radius - 2, r1=radius + 2, r2=r2, weight=meanw)
-    IJ.log('New local mean: ' + str(new_loc_mean))
+    :return: Cell record with seed, refined center (image coordinates), radii, local means, stage timings (t_*)
+    and counters (voxels visited, mean shift iterations)
+    """
+    return pipeline.measure_cell(cs, get_backend('ij'), cell_params(), log=log, peak_index=peak_index, cache=cache,
+                                 image_key=image_key, image_metrics=image_metrics, max_dim=max_dim, metrics=metrics)
 
-    new_tab = radial_distribution_3D(cs, max_rad=max_rad)
 
-    new_radius = radius_thresh(new_tab, new_loc_mean)
-    IJ.log('New radius: ' + str(new_radius))
+def show_cell(cs, record):
+    # type: (CellStack, dict) -> None
+    """
+Display the cell stack centered in the refined center, with the measured radius as circle roi
+    """
+    cs.materialize()
 
     # apply a different look up table for display
     if cmap != 'default':
@@ -115,8 +201,8 @@ def process_cell(cs):
     cs.setSlice(cs.center[2] + 1)
 
     if circle:
-        # circle_roi(cs, radius, Color.YELLOW)
-        circle_roi(cs, new_radius, Color.RED)
+        # circle_roi(cs, record['radius'], Color.YELLOW)
+        circle_roi(cs, record['new_radius'], Color.RED)
 
     # draw point for new centroid
     # point = PointRoi(cs.center[0], cs.center[1])
@@ -137,27 +223,43 @@ def process_cell(cs):
     #     plot.close()
 
 
-def process_img(img_path):
+def process_cell(cs, cache=None, image_key=None, image_metrics=None):
+    record = measure_cell(cs, cache=cache, image_key=image_key, image_metrics=image_metrics)
+    show_cell(cs, record)
+    return record
+
+
+def load_markers(img_path, height):
+    # type: (str, int) -> MarkerArray
+    """
+Read the coordinates of the cells in the image (see markers.image_markers)
+    """
+    return mrk.image_markers(img_path, height, sidecar=marker_sidecar)
+
+
+def process_img(img_path, sink=None):
     IJ.log('Processing {} ...'.format(img_path))
+    img_title = os.path.basename(img_path)
+    metrics = ImageMetrics(img_title)
 
     # open image
-    imp = IJ.openImage(img_path)
+    with metrics.image.stage('open'):
+        imp = IJ.openImage(img_path)
     imp.show()
     w_big = imp.getWindow()
     w_big.setLocationAndSize(1050, 400, 500, 500)
 
     # read relative csv file rows (coordinates of centers)
-    img_name, img_extension = os.path.splitext(img_path)
-    marker_path = img_name + '.csv'
+    with metrics.image.stage('markers'):
+        markers = load_markers(img_path, imp.height)
 
-    if not os.path.exists(marker_path):
-        root = os.path.dirname(marker_path)
-        IJ.log('Creating corrected CSV files in {}...'.format(root))
-        mrk.markers_to_csv(root, y_inv_height=imp.height)
-
-    markers = mrk.read_marker(marker_path, to_int=True)
+    cache = open_cache(cache_dir, cache_max_bytes) if use_cache else None
+    image_key = image_digest(img_path) if use_cache else None
 
     for cs in gen_cell_stacks(imp, markers, cube_roi_dim, scaleZ):
+        if sink is not None and sink.is_done(img_title, cs.seed):
+            cs.close()
+            continue
 
         # identify cell in original image
         imp.setSlice(cs.seed[2] + 1)
@@ -166,13 +268,15 @@ def process_img(img_path):
         point.setColor(Color.RED)
         imp.setRoi(point)
 
-        if discard_margin_cells:
-            if not cs.onBorder:
-                process_cell(cs)
-            else:
-                IJ.log('Skipped on border cell in seed ' + str(cs.seed))
+        record = None
+        if discard_margin_cells and cs.onBorder:
+            IJ.log('Skipped on border cell in seed ' + str(cs.seed))
         else:
-            process_cell(cs)
+            record = process_cell(cs, cache, image_key, metrics)
+        if sink is not None and record is not None:
+            record['image'] = img_title
+            record['marker'] = cs.marker
+            sink.append(record)
 
         c = raw_input("Press enter to show the next cell or 'n' to go to the next image\n")
 
@@ -181,18 +285,46 @@ def process_img(img_path):
             IJ.log("Skipped remaining cells")
             break
 
+    if sink is not None:
+        sink.sync()
+    if metrics_dir is not None:
+        write_metrics(metrics, os.path.splitext(os.path.basename(img_path))[0], metrics_dir)
+
+
+def batch_metrics_dir():
+    # type: () -> str
+    return metrics_dir if metrics_dir is not None else os.path.join(work_dir, 'metrics')
+
+
+def write_metrics(metrics, name, directory):
+    # type: (ImageMetrics, str, str) -> str
+    """
+Write the metrics of an image in directory/<name>.json (times per stage, counters and their p50/p95/max)
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, name + '.json')
+    metrics.write(path)
+    return path
+
 
 def full_process():
+    sink = None
+    if interactive_results_path is not None:
+        sink = ResultSink(interactive_results_path, batch_size=results_batch)
+        IJ.log('Cells already in {} are skipped'.format(interactive_results_path))
     for root, directories, filenames in os.walk(source_dir):
         for filename in filenames:
             if filename.endswith('.marker'):
                 tif_file = filename.replace('.marker', '')
                 img_path = os.path.join(root, tif_file)
 
-                process_img(img_path)
+                process_img(img_path, sink)
 
                 raw_input('Press enter to continue...')
                 IJ.run("Close All")
+    if sink is not None:
+        sink.close()
 
     IJ.log('Finish')
 
@@ -211,11 +343,260 @@ Particular images
     """
 
 
+def batch_process_img(img_path, metrics=None, sink=None):
+    # type: (str, ImageMetrics, ResultSink) -> list
+    """
+Headless version of process_img: every cell is measured without display nor user input
+(in parallel if n_workers > 1)
+
+    :param img_path: Absolute path to the tif image
+
+    :param metrics: If given, collects the time of the image operations and the metrics of every cell
+
+    :param sink: If given, every record is appended to it as soon as the cell is measured and the cells it already
+    contains are skipped (synced at the end of the image)
+
+    :return: List of cell records measured now (see measure_cell)
+    """
+    IJ.log('Processing {} ...'.format(img_path))
+    img_title = os.path.basename(img_path)
+    done = sink.done_seeds(img_title) if sink is not None else set()
+    log = IJ.log if verbose and n_workers == 1 else quiet
+    if metrics is None:
+        metrics = ImageMetrics(os.path.basename(img_path))
+
+    # only the slices needed by the cells are read if image_source is 'virtual' or 'mmap'
+    with metrics.image.stage('open'):
+        source = open_source(img_path, mode=image_source, cache_slices=slice_cache)
+    with metrics.image.stage('markers'):
+        markers = load_markers(img_path, source.height)
+
+    if method != 'none' and prefilter:
+        original = source
+        with metrics.image.stage('prefilter'):
+            source = prefiltered_source(img_path, original, method, sigma, scaleZ, filter_cache_dir,
+                                        slab_depth=filter_slab_depth, mode=image_source, cache_slices=slice_cache,
+                                        engine=filter_engine)
+        original.close()
+
+    peak_index = None
+    if global_maxima and algorithm == 'cells':
+        with metrics.image.stage('image_maxima'):
+            peak_index = image_maxima(source, maxima_rad, noise_tol, scaleZ, slab_depth=maxima_slab_depth)
+        IJ.log('{} maxima found in {}'.format(len(peak_index), img_path))
+
+    cache = open_cache(cache_dir, cache_max_bytes) if use_cache else None
+    image_key = image_digest(img_path) if use_cache else None
+
+    def store(record, marker):
+        record['image'] = img_title
+        record['marker'] = marker
+        if sink is not None:
+            sink.append(record)
+        return record
+
+    dims, max_dim, crop_metrics = None, None, None
+    if adaptive_crop and algorithm == 'cells':
+        crop_metrics = [Metrics() for _ in markers]
+        with metrics.image.stage('crop_dims'):
+            dims = pipeline.crop_dims(get_backend('ij'), source, markers, cell_params(), cube_roi_dim, scaleZ,
+                                      cell_order, crop_metrics)
+        max_dim = cube_roi_dim
+
+    def measure(cs):
+        if (discard_margin_cells and cs.onBorder) or tuple(cs.seed) in done:
+            return None
+        return store(measure_cell(cs, log=log, peak_index=peak_index, cache=cache, image_key=image_key,
+                                  image_metrics=metrics, max_dim=max_dim,
+                                  metrics=crop_metrics[cs.marker] if crop_metrics is not None else None), cs.marker)
+
+    t_cells = time.time()
+    if algorithm in ['segment', 'pyramid']:
+        if method != 'none' and not prefilter:
+            IJ.log('The {} algorithm reads the raw image: set prefilter = True to filter it'.format(algorithm))
+        measure_image = segment_image if algorithm == 'segment' else pyramid_image
+        cell_records = measure_image(source, get_backend('ij'), markers, cell_params(), cube_roi_dim, scaleZ,
+                                     order=cell_order, metrics=metrics)
+        cell_records = [None if (discard_margin_cells and r['on_border']) or tuple(markers[i]) in done
+                        else store(r, i) for i, r in enumerate(cell_records)]
+    elif tile_dim is not None:
+        cell_records = [None] * len(markers)
+        if n_workers > 1:
+            # one pool for all the tiles of the image
+            pool = cell_pool(n_workers)
+            try:
+                for tile, plan in gen_tiles(source, markers, cube_roi_dim, scaleZ, tile_dim, tile_budget,
+                                            cell_order):
+                    tile_records = map_cells(tile, markers, cube_roi_dim, scaleZ, measure, n_workers=n_workers,
+                                             view=view_stacks, plan=plan, dims=dims, pool=pool)
+                    for i, neighbors in plan:
+                        cell_records[i] = tile_records[i]
+            finally:
+                pool.shutdownNow()
+        else:
+            for cs in gen_tiled_cell_stacks(source, markers, cube_roi_dim, scaleZ, tile_dim, tile_budget,
+                                            view=view_stacks, order=cell_order, dims=dims):
+                cell_records[cs.marker] = measure(cs)
+                cs.close()
+    elif n_workers > 1:
+        cell_records = map_cells(source, markers, cube_roi_dim, scaleZ, measure, n_workers=n_workers,
+                                 view=view_stacks, order=cell_order, dims=dims)
+    else:
+        cell_records = [None] * len(markers)
+        for cs in gen_cell_stacks(source, markers, cube_roi_dim, scaleZ, view=view_stacks, order=cell_order,
+                                  dims=dims):
+            cell_records[cs.marker] = measure(cs)
+            cs.close()
+    metrics.image.add_time('cells', time.time() - t_cells)
+
+    records = []
+    for i, record in enumerate(cell_records):
+        if record is not None:
+            records.append(record)
+        elif tuple(markers[i]) not in done:
+            IJ.log('Skipped on border cell in seed ' + str(markers[i]))
+
+    source.close()
+    if sink is not None:
+        sink.sync()
+    IJ.log('Measured {} cells in {}'.format(len(records), img_path))
+    if done:
+        IJ.log('{} cells already in the results'.format(len(done)))
+    return records
+
+
+def batch_process(source_dir, results_path):
+    # type: (str, str) -> None
+    """
+Headless version of full_process: measure every image with a marker file in source_dir and write all the
+records in results_path (see results.RESULT_FIELDS).
+The images are listed once in a manifest in work_dir and split in n_shards: several processes (also on different
+machines sharing work_dir) can run this at the same time, every finished image is checkpointed and a restarted
+run skips it. The process completing the last shard merges the results.
+    """
+    t_start = time.time()
+    manifest = build_manifest(source_dir, work_dir, n_shards=n_shards)
+
+    def process_entry(entry, img_results_path):
+        metrics = ImageMetrics(entry['id'])
+        # appended while measuring: a restart after a crash in the middle of the image keeps the cells done
+        with ResultSink(img_results_path, batch_size=results_batch) as sink:
+            batch_process_img(entry['image'], metrics, sink)
+        write_metrics(metrics, entry['id'], batch_metrics_dir())
+
+    n_images = run_worker(work_dir, process_entry, lease_timeout=lease_timeout)
+    elapsed = time.time() - t_start
+    IJ.log('Processed {} images in {:.1f} s'.format(n_images, elapsed))
+
+    if all_done(work_dir, manifest):
+        merge_results(work_dir, results_path)
+        IJ.log('Finish: results in {}'.format(results_path))
+        summary_path = write_run_metrics(manifest)
+        IJ.log('Stage times and counters in {}'.format(summary_path))
+    else:
+        IJ.log('Finish: shards still running in other processes')
+
+
+def write_run_metrics(manifest):
+    # type: (dict) -> str
+    """
+Summary (p50/p95/max of every stage and counter) of all the images of the manifest, from their metrics files
+    """
+    image_dicts = []
+    for entry in manifest['images']:
+        path = os.path.join(batch_metrics_dir(), entry['id'] + '.json')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                image_dicts.append(json.load(f))
+    summary_path = os.path.join(batch_metrics_dir(), 'run_summary.json')
+    with open(summary_path, 'w') as f:
+        json.dump(run_summary(image_dicts), f, indent=1)
+    return summary_path
+
+
+def profile_cell(cs, max_r):
+    # type: (CellStack, int) -> dict
+    """
+First part of measure_cell (filter, local max and recentering), then the shell sums around the center
+
+    :param max_r: Last shell of the profile (must cover max_rad and every r0 and r2 of the sweep)
+
+    :return: Cell record with seed, center (image coordinates) and the RadialProfile in 'profile'
+    """
+    cs.set_calibration()
+    if method != 'none' and not prefilter:
+        filter_cellstack(cs, method=method, sigma=sigma, engine=filter_engine)
+    if recenter:
+        cs.center = local_max(cs, cs.center)
+    center = absolute_position(cs.center, cs.roi3D)
+    return {
+        'seed_x': cs.seed[0], 'seed_y': cs.seed[1], 'seed_z': cs.seed[2],
+        'center_x': center[0], 'center_y': center[1], 'center_z': center[2],
+        'profile': RadialProfile(cs, max_r)
+    }
+
+
+def sweep_process(source_dir, sweep_dir):
+    # type: (str, str) -> None
+    """
+Sweep the local mean parameters (sweep_r0, sweep_r1, sweep_r2, sweep_meanw) on every image with a marker file in
+source_dir: the radial profile of every cell is computed once, then each combination is only arithmetic on it.
+Writes one results table per combination and a summary in sweep_dir (see sweep.write_sweep)
+    """
+    t_start = time.time()
+    grid = param_grid(sweep_r0, sweep_r1, sweep_r2, sweep_meanw)
+    max_r = max([max_rad] + [abs(p['r0']) for p in grid] + [p['r2'] for p in grid])
+
+    cells = []
+    for img_path, marker_path in list_images(source_dir):
+        IJ.log('Profiling {} ...'.format(img_path))
+        source = open_source(img_path, mode=image_source, cache_slices=slice_cache)
+        markers = load_markers(img_path, source.height)
+        if method != 'none' and prefilter:
+            original = source
+            source = prefiltered_source(img_path, original, method, sigma, scaleZ, filter_cache_dir,
+                                        slab_depth=filter_slab_depth, mode=image_source, cache_slices=slice_cache,
+                                        engine=filter_engine)
+            original.close()
+
+        def profile(cs):
+            if discard_margin_cells and cs.onBorder:
+                return None
+            return profile_cell(cs, max_r)
+
+        if n_workers > 1:
+            img_cells = map_cells(source, markers, cube_roi_dim, scaleZ, profile, n_workers=n_workers,
+                                  view=view_stacks, order=cell_order)
+        else:
+            img_cells = [None] * len(markers)
+            for cs in gen_cell_stacks(source, markers, cube_roi_dim, scaleZ, view=view_stacks, order=cell_order):
+                img_cells[cs.marker] = profile(cs)
+                cs.close()
+        source.close()
+
+        for i, cell in enumerate(img_cells):
+            if cell is not None:
+                cell['image'] = os.path.basename(img_path)
+                cell['marker'] = i
+                cells.append(cell)
+
+    t_profiles = time.time() - t_start
+    summary_path = write_sweep(sweep_dir, grid, cells, max_rad, radius_confirm)
+    IJ.log('Sweep of {} combinations on {} cells: profiles {:.1f} s, scoring {:.1f} s'.format(
+        len(grid), len(cells), t_profiles, time.time() - t_start - t_profiles))
+    IJ.log('Finish: summary in {}'.format(summary_path))
+
+
 if __name__ == '__main__':
-    # launch Fiji
-    ImageJ()
+    if headless and sweep:
+        sweep_process(source_dir, sweep_dir)
+    elif headless:
+        batch_process(source_dir, results_path)
+    else:
+        # launch Fiji
+        ImageJ()
 
-    # full_process()
+        # full_process()
 
-    process_img('/home/zemp/bcfind_GT/SST_11_14.tif')
+        process_img('/home/zemp/bcfind_GT/SST_11_14.tif')
 
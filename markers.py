@@ -1,7 +1,70 @@
-from __future__ import print_function
+from __future__ import with_statement, print_function
 import csv
+import mmap
 import os
-from ij import IJ
+import sys
+from array import array
+
+try:
+    from ij import IJ
+    from java.io import FileOutputStream, RandomAccessFile
+    from java.nio import ByteBuffer, ByteOrder
+    from java.nio.channels import FileChannel
+    from jarray import zeros
+except ImportError:
+    # CPython (e.g. pipeline.py with the numpy backend): messages on stdout, sidecar mapped with mmap
+    IJ = None
+
+# binary sidecar: magic, version, number of markers (int32 each), then the x, y and z columns (int32, little endian)
+SIDECAR_MAGIC = 0x4b4d4342  # 'BCMK'
+SIDECAR_VERSION = 1
+SIDECAR_HEADER = 12
+
+
+class MarkerArray(object):
+    def __init__(self, xs=None, ys=None, zs=None):
+        # type: (array, array, array) -> MarkerArray
+        """
+    Marker coordinates stored by column in int32 arrays (12 bytes per marker instead of a list per row).
+    Indexing returns [x, y, z], so it can be used wherever a list of rows of int coordinates is expected
+        """
+        self.xs = xs if xs is not None else array('i')
+        self.ys = ys if ys is not None else array('i')
+        self.zs = zs if zs is not None else array('i')
+
+    def append(self, x, y, z):
+        # type: (int, int, int) -> None
+        self.xs.append(x)
+        self.ys.append(y)
+        self.zs.append(z)
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        return [self.xs[i], self.ys[i], self.zs[i]]
+
+    def __iter__(self):
+        for k in range(len(self.xs)):
+            yield [self.xs[k], self.ys[k], self.zs[k]]
+
+
+def _log(msg):
+    # type: (str) -> None
+    if IJ is not None:
+        IJ.log(msg)
+    else:
+        print(msg)
+
+
+def _to_int(value):
+    # type: (str) -> int
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
 
 
 def invert_y(y, height):
@@ -22,7 +85,7 @@ Read a marker file (any extension) and return the feature of interests (x, y, z)
     :return: Rows containing the coordinates (list of lists)
     """
     rows = []
-    IJ.log('Reading marker {}...'.format(marker_path))
+    _log('Reading marker {}...'.format(marker_path))
     with open(marker_path, 'r') as marker:
         reader = csv.reader(marker)
         # skip header
@@ -40,16 +103,196 @@ Read a marker file (any extension) and return the feature of interests (x, y, z)
                     row = row[:3]
                 rows.append(row)
             except IndexError as e:
-                IJ.log('ERROR ' + str(e) + ' in file ' + marker_path)
+                _log('ERROR ' + str(e) + ' in file ' + marker_path)
 
-    IJ.log('Read {} rows from {}'.format(len(rows), marker_path))
+    _log('Read {} rows from {}'.format(len(rows), marker_path))
     return rows
 
 
-def markers_to_csv(source_dir, target_dir=None, y_inv_height=None, extra_suff=''):
-    # type: (str, str, int, str) -> None
+def iter_markers(marker_path, y_inv_height=None):
+    """
+Stream the (x, y, z) int coordinates of a marker file (any extension) one row at a time, without keeping the file
+in memory
+
+    :param marker_path: Absolute path to the marker file
+
+    :param y_inv_height: Height of the image to invert upside-down the y coord (only if y inversion needed)
+    """
+    with open(marker_path, 'r') as marker:
+        # skip header
+        marker.readline()
+        for line in marker:
+            fields = line.split(',', 3)
+            if len(fields) < 3:
+                if line.strip():
+                    _log('ERROR malformed row {!r} in file {}'.format(line.strip(), marker_path))
+                continue
+            y = _to_int(fields[1])
+            if y_inv_height is not None:
+                y = y_inv_height - y
+            yield _to_int(fields[0]), y, _to_int(fields[2])
+
+
+def read_markers(marker_path, y_inv_height=None):
+    # type: (str, int) -> MarkerArray
+    """
+Read the coordinates of a marker file (any extension) in a MarkerArray (streaming, see iter_markers)
+    """
+    markers = MarkerArray()
+    for x, y, z in iter_markers(marker_path, y_inv_height):
+        markers.append(x, y, z)
+    return markers
+
+
+def sidecar_path(csv_path):
+    # type: (str) -> str
+    return os.path.splitext(csv_path)[0] + '.markers.bin'
+
+
+def write_sidecar(path, markers):
+    # type: (str, MarkerArray) -> None
+    """
+Write the markers in the binary sidecar format (see SIDECAR_MAGIC), through a temporary file renamed at the end
+    """
+    n = len(markers)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if IJ is None:
+        with open(tmp_path, 'wb') as f:
+            for values in ([SIDECAR_MAGIC, SIDECAR_VERSION, n], markers.xs, markers.ys, markers.zs):
+                values = array('i', values)
+                if sys.byteorder == 'big':
+                    values.byteswap()
+                values.tofile(f)
+    else:
+        buf = ByteBuffer.allocate(SIDECAR_HEADER + 12 * n).order(ByteOrder.LITTLE_ENDIAN)
+        buf.putInt(SIDECAR_MAGIC).putInt(SIDECAR_VERSION).putInt(n)
+        ints = buf.asIntBuffer()
+        for column in (markers.xs, markers.ys, markers.zs):
+            ints.put(column)
+        out = FileOutputStream(tmp_path)
+        try:
+            out.getChannel().write(buf)
+        finally:
+            out.close()
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def read_sidecar(path):
+    # type: (str) -> MarkerArray
+    """
+Load a binary sidecar through memory mapping: the three columns are copied in bulk in int32 arrays
+
+    :raise: ValueError if the file is not a sidecar of a supported version
     """
-Convert *.marker files in *.csv extracting only the features of interest (i.e. x,y,z)
+    if IJ is None:
+        return _read_sidecar_mmap(path)
+    raf = RandomAccessFile(path, 'r')
+    try:
+        channel = raf.getChannel()
+        buf = channel.map(FileChannel.MapMode.READ_ONLY, 0, channel.size()).order(ByteOrder.LITTLE_ENDIAN)
+        if channel.size() < SIDECAR_HEADER or buf.getInt(0) != SIDECAR_MAGIC or buf.getInt(4) != SIDECAR_VERSION:
+            raise ValueError('Not a marker sidecar: ' + path)
+        n = buf.getInt(8)
+        if channel.size() != SIDECAR_HEADER + 12 * n:
+            raise ValueError('Truncated marker sidecar: ' + path)
+        buf.position(SIDECAR_HEADER)
+        ints = buf.slice().order(ByteOrder.LITTLE_ENDIAN).asIntBuffer()
+        columns = []
+        for k in range(3):
+            column = zeros(n, 'i')
+            ints.get(column)
+            columns.append(column)
+        return MarkerArray(*columns)
+    finally:
+        raf.close()
+
+
+def _read_sidecar_mmap(path):
+    # type: (str) -> MarkerArray
+    """
+read_sidecar for CPython (mmap module instead of java.nio)
+    """
+    size = os.path.getsize(path)
+    if size < SIDECAR_HEADER:
+        raise ValueError('Not a marker sidecar: ' + path)
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            values = array('i')
+            values.frombytes(data[:])
+        finally:
+            data.close()
+    if sys.byteorder == 'big':
+        values.byteswap()
+    if values[0] != SIDECAR_MAGIC or values[1] != SIDECAR_VERSION:
+        raise ValueError('Not a marker sidecar: ' + path)
+    n = values[2]
+    if size != SIDECAR_HEADER + 12 * n:
+        raise ValueError('Truncated marker sidecar: ' + path)
+    return MarkerArray(values[3:3 + n], values[3 + n:3 + 2 * n], values[3 + 2 * n:])
+
+
+def is_stale(target_path, source_path):
+    # type: (str, str) -> bool
+    """
+    :return: True if target_path is missing or older than source_path
+    """
+    return not os.path.exists(target_path) or os.path.getmtime(target_path) < os.path.getmtime(source_path)
+
+
+def load_markers(csv_path, sidecar=False):
+    # type: (str, bool) -> MarkerArray
+    """
+Read the coordinates of a csv file written by markers_to_csv
+
+    :param sidecar: Load the binary sidecar next to the csv file when up to date, create it otherwise
+
+    :return: MarkerArray of int coordinates
+    """
+    if sidecar:
+        bin_path = sidecar_path(csv_path)
+        if not is_stale(bin_path, csv_path):
+            try:
+                return read_sidecar(bin_path)
+            except ValueError as e:
+                _log('ERROR ' + str(e))
+    _log('Reading marker {}...'.format(csv_path))
+    markers = read_markers(csv_path)
+    _log('Read {} rows from {}'.format(len(markers), csv_path))
+    if sidecar:
+        write_sidecar(sidecar_path(csv_path), markers)
+    return markers
+
+
+def marker_to_csv(marker_path, csv_path, y_inv_height=None):
+    # type: (str, str, int) -> int
+    """
+Convert one marker file in csv extracting only the features of interest (i.e. x,y,z), streaming row by row
+
+    :return: Number of rows written
+    """
+    n = 0
+    tmp_path = '{}.{}.tmp'.format(csv_path, os.getpid())
+    with open(tmp_path, 'w') as csv_file:
+        csv_file.write('x,y,z\n')
+        for x, y, z in iter_markers(marker_path, y_inv_height):
+            csv_file.write('{},{},{}\n'.format(x, y, z))
+            n += 1
+    if os.path.exists(csv_path):
+        # os.rename does not replace an existing file on Windows
+        os.remove(csv_path)
+    os.rename(tmp_path, csv_path)
+    _log('Written {} rows on {}'.format(n, csv_path))
+    return n
+
+
+def markers_to_csv(source_dir, target_dir=None, y_inv_height=None, extra_suff='', force=False):
+    # type: (str, str, int, str, bool) -> None
+    """
+Convert *.marker files in *.csv extracting only the features of interest (i.e. x,y,z).
+Only the csv files missing or older than their marker file are written
 
     :param source_dir: Source directory for the marker files
 
@@ -58,6 +301,8 @@ Convert *.marker files in *.csv extracting only the features of interest (i.e. x
     :param y_inv_height: Height of the image to invert upside-down the y coord (only if y inversion needed)
 
     :param extra_suff: Suffix before .tif.marker extension (e.g. '-GT' for files in first SST-11 dataset)
+
+    :param force: Convert every file, also the up to date ones
     """
     if target_dir is None:
         target_dir = source_dir
@@ -66,17 +311,39 @@ Convert *.marker files in *.csv extracting only the features of interest (i.e. x
     for filename in os.listdir(source_dir):
         if filename.endswith('.marker'):
             marker_path = os.path.join(source_dir, filename)
-            header = ['x', 'y', 'z']
-            rows = read_marker(marker_path, y_inv_height=y_inv_height)
             img_path = marker_path.replace('.marker', '')
             img_name, img_extension = os.path.splitext(img_path)
             csv_path = (img_name + '.csv').replace(source_dir, target_dir)
-            with open(csv_path, 'w') as csv_file:
-                IJ.log('Writing {} rows on {}...'.format(len(rows), csv_path))
+            if force or is_stale(csv_path, marker_path):
+                marker_to_csv(marker_path, csv_path, y_inv_height=y_inv_height)
+
+
+def image_markers(img_path, height, sidecar=False):
+    # type: (str, int, bool) -> MarkerArray
+    """
+Read the coordinates of the cells in the image, creating the corrected csv file if missing or older than the marker
+
+    :param img_path: Absolute path to the tif image
+
+    :param height: Height of the image (for y coordinate inversion)
+
+    :param sidecar: Use the binary sidecar of the csv (see load_markers)
+
+    :return: MarkerArray of int coordinates (indexing gives [x, y, z])
+    """
+    img_name, img_extension = os.path.splitext(img_path)
+    csv_path = img_name + '.csv'
+    marker_path = img_path + '.marker'
+
+    if os.path.exists(marker_path):
+        if is_stale(csv_path, marker_path):
+            marker_to_csv(marker_path, csv_path, y_inv_height=height)
+    elif not os.path.exists(csv_path):
+        root = os.path.dirname(csv_path)
+        _log('Creating corrected CSV files in {}...'.format(root))
+        markers_to_csv(root, y_inv_height=height)
 
-                writer = csv.writer(csv_file)
-                writer.writerow(header)
-                writer.writerows(rows)
+    return load_markers(csv_path, sidecar=sidecar)
 
 
 if __name__ == '__main__':
@@ -1,8 +1,7 @@
-from org.python.modules import math
+import math
 
-from stacks import CellStack
-from mcib3d.image3d import ImageHandler
-from mcib3d.geom import Point3D
+import instrument
+from geometry import LRUCache, shell_offsets, gather, stack_shape
 
 
 def euclid_distance(x, xi, scaleZ):
@@ -34,73 +33,137 @@ Formula: https://en.wikipedia.org/wiki/Radial_basis_function_kernel
     return val
 
 
-def mean_shift(cs, radius, peaks, sigma, thresh):
-    # type: (CellStack, int, list, float, float) -> list
-    """
-Perform mean shift algorithm starting from the peaks to determine the centroid of the cell
-This implementation is slightly different from the naive algorithm since mean shift values are also weighted by
-voxel intensity (mass of the points).
-The kernel used is Gaussian Kernel.
-
-    :param cs: CellStack containing voxels
+# gaussian weights of the neighbor offsets, the same for every cell of a run
+_kernels = LRUCache(max_size=32)
 
-    :param radius: Look-distance for mean shift seeds neighbors selection
 
-    :param peaks:  Seeds of the algorithm
+def kernel_weights(radius, sigma, scaleZ, shape):
+    # type: (int, float, float, tuple) -> list
+    """
+Gaussian kernel value of every offset of shell_offsets(0, radius, scaleZ, shape), with distances computed as
+Point3D.distance(neighbor, 1, scaleZ)
+    """
+    def factory():
+        table = shell_offsets(0, radius, scaleZ, shape)
+        return [gaussian_kernel(math.sqrt(dx**2 + dy**2 + (dz * scaleZ)**2), sigma)
+                for dx, dy, dz in zip(table.dx, table.dy, table.dz)]
 
-    :param sigma: Gaussian kernel parameter
+    return _kernels.get((radius, sigma, scaleZ, shape), factory)
 
-    :param thresh: Voxel which intensity is below thresh are not considered
 
-    :return: Shifted seeds
+def shift_seeds(peaks, shift, scaleZ, n_iterations=15, tol=1.):
+    # type: (list, callable, float, int, float) -> tuple
     """
+Batched loop of the mean shift, independent of how the voxels are read (see mean_shift and npbackend).
+All the seeds are shifted together at every iteration: a seed stops when its shift is below tol and seeds that
+reach the same voxel are merged (they would follow the same path).
 
-    imh = ImageHandler.wrap(cs)
+    :param peaks: Seeds of the algorithm
 
-    # copy peaks list
-    X = list(peaks)
+    :param shift: Function returning the new position of a seed, None if it cannot move
 
-    past_X = []
-    n_iterations = 15
-    for it in range(n_iterations):
-        for i, x in enumerate(X):
-            point_x = Point3D(x[0], x[1], x[2])
+    :param scaleZ: Depth of a voxel, for the shift distance
 
-            # for each point x in X, find the neighboring points N(x) of x.
-            neighbors = imh.getNeighborhoodLayerList(x[0], x[1], x[2], 0, radius)
+    :param n_iterations: Maximum number of iterations
 
-            # for each point x in X, calculate the mean shift m(x).
-            numerator = [0]*3
-            denominator = 0
-            neigh_arr = neighbors.toArray()
+    :param tol: Minimum shift (anisotropic distance) to keep a seed moving
+
+    :return: Shifted seeds (duplicates merged) and number of iterations run by each of them
+    """
+    # copy peaks list
+    X = [list(p) for p in peaks]
+    iterations = [0] * len(X)
+    merged = [False] * len(X)
+    active = list(range(len(X)))
+
+    it = 0
+    while active and it < n_iterations:
+        it += 1
+        past_X = [list(x) for x in X]
+        for i in active:
+            iterations[i] = it
+            new_x = shift(X[i])
+            if new_x is not None:
+                X[i] = new_x
+
+        # merge seeds landed on the same voxel of another one, then stop the settled ones
+        still_active = []
+        for i in active:
+            for k in range(len(X)):
+                if k != i and not merged[k] and X[k] == X[i] and (k < i or k not in active):
+                    merged[i] = True
+                    iterations[k] = max(iterations[k], iterations[i])
+                    break
+            if not merged[i] and euclid_distance(X[i], past_X[i], scaleZ) >= tol:
+                still_active.append(i)
+        active = still_active
+
+    centroids = [x for x, m in zip(X, merged) if not m]
+    iterations = [n for n, m in zip(iterations, merged) if not m]
+    return centroids, iterations
+
+
+def mean_shift(cs, radius, peaks, sigma, thresh, n_iterations=15, tol=1.):
+    # type: (CellStack, int, list, float, float, int, float) -> tuple
+    """
+Perform mean shift algorithm starting from the peaks to determine the centroid of the cell
+This implementation is slightly different from the naive algorithm since mean shift values are also weighted by
+voxel intensity (mass of the points).
+The kernel used is Gaussian Kernel.
+Seeds are shifted together and merged as described in shift_seeds. The weighted mean of every seed is still its
+own loop over the gathered neighborhood: an offset-major loop over all the seeds reads the same voxels and is no
+faster in Jython (see npbackend.mean_shift for the vectorized one).
 
-            for neighbor in neigh_arr:
-                # discard neighbors below certain thresh
-                if neighbor.getValue() >= thresh:
+    :param cs: CellStack containing voxels
 
-                    # neighbor is a Voxel3D Object, getPosition is a Point3D. For reference,
-                    # see https://github.com/mcib3d/mcib3d-core/blob/master/src/main/java/mcib3d/geom/Voxel3D.java
+    :param radius: Look-distance for mean shift seeds neighbors selection
 
-                    neigh_pos = [p for p in neighbor.getPosition().getArray()]
-                    distance = point_x.distance(neighbor, 1, cs.scaleZ)
-                    weight = gaussian_kernel(distance, sigma)
-                    inc = list(map(lambda n: n*(weight * neighbor.getValue()), neigh_pos))
-                    numerator = list(map(lambda a, b: a+b, numerator, inc))
-                    denominator += weight*neighbor.getValue()
+    :param peaks:  Seeds of the algorithm
 
-            # print("Denominator: " + str(denominator))
-            new_x = list(map(lambda n: int(n/denominator), numerator))
+    :param sigma: Gaussian kernel parameter
 
-            # for each point x in X, update x = m(x).
-            X[i] = new_x
+    :param thresh: Voxel which intensity is below thresh are not considered
 
-        past_X.append(list(X))
+    :param n_iterations: Maximum number of iterations
 
-    return X
+    :param tol: Minimum shift (anisotropic distance) to keep a seed moving
 
+    :return: Shifted seeds (duplicates merged) and number of iterations run by each of them
+    """
 
-def ms_center(cs, radius, peaks, sigma, thresh):
-    # type: (CellStack, int, list, float, float) -> list
+    shape = stack_shape(cs)
+    buf = cs.voxels()
+
+    # neighbors at distance d < radius (as ImageHandler.getNeighborhoodLayerList(x, y, z, 0, radius))
+    table = shell_offsets(0, radius, cs.scaleZ, shape)
+    weights = kernel_weights(radius, sigma, cs.scaleZ, shape)
+    dx, dy, dz = table.dx, table.dy, table.dz
+
+    def shift(x):
+        # mean shift m(x), as weighted mean of the offsets
+        sx = sy = sz = 0.
+        denominator = 0.
+        for j, value in gather(buf, table, x, shape):
+            # discard neighbors below certain thresh
+            if value >= thresh:
+                wv = weights[j] * value
+                sx += wv * dx[j]
+                sy += wv * dy[j]
+                sz += wv * dz[j]
+                denominator += wv
+
+        if denominator == 0:
+            # no neighbor above thresh, the seed cannot move
+            return None
+        return [int((x[0] * denominator + sx) / denominator),
+                int((x[1] * denominator + sy) / denominator),
+                int((x[2] * denominator + sz) / denominator)]
+
+    return shift_seeds(peaks, shift, cs.scaleZ, n_iterations, tol)
+
+
+def ms_center(cs, radius, peaks, sigma, thresh, method=mean_shift, log=None):
+    # type: (CellStack, int, list, float, float, callable, callable) -> list
     """
 Helper method that calls the mean shift algorithm
 
@@ -114,17 +177,28 @@ Helper method that calls the mean shift algorithm
 
     :param thresh: Voxel which intensity is below thresh are not considered
 
-    :return The closest centroid wrt cell center
-    """
-    print('[msc] Peaks: ' + str(peaks))
+    :param method: Mean shift implementation, with the arguments of mean_shift (e.g. the one of npbackend)
 
-    # use only peaks close to the cell
-    for p in peaks:
-        if euclid_distance(p, cs.center, cs.scaleZ) > radius:
-            peaks.remove(p)
+    :param log: Logger of peaks and centroids (e.g. IJ.log), nothing is logged if None (batch mode, worker threads)
 
-    centroids = mean_shift(cs, radius, peaks, sigma, thresh)
-    print('[msc] Centroids: ' + str(centroids))
+    :return The closest centroid wrt cell center
+    """
+    if log is not None:
+        log('[msc] Peaks: ' + str(peaks))
+
+    # use only peaks close to the cell (a new list: removing while iterating skips the peak after every removed one)
+    peaks = [p for p in peaks if euclid_distance(p, cs.center, cs.scaleZ) <= radius]
+    if not peaks:
+        if log is not None:
+            log('[msc] No peak within the radius, center kept')
+        return list(cs.center)
+
+    centroids, iterations = method(cs, radius, peaks, sigma, thresh)
+    # rounds of the batched loop and iterations summed over the seeds
+    instrument.count('ms_iterations', max(iterations) if iterations else 0)
+    instrument.count('ms_seed_iterations', sum(iterations))
+    if log is not None:
+        log('[msc] Centroids: ' + str(centroids) + ' after ' + str(iterations) + ' iterations')
     dist = list(map(lambda x: euclid_distance(x, cs.center, cs.scaleZ), centroids))
     min_d = min(dist)
     index = 0
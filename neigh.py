@@ -1,4 +1,4 @@
-from mcib3d.image3d import ImageHandler
+from geometry import sphere_offsets, shell_offsets, gather, stack_shape
 
 
 def nearest_neighborhood(center):
@@ -25,13 +25,17 @@ Reference at: https://github.com/mcib3d/mcib3d-core/blob/master/src/main/java/mc
 
     :param r0: internal radius (if sphere cap it must be gt 0)
     """
-    imh = ImageHandler.wrap(cs)
+    shape = stack_shape(cs)
 
     if r0 == 0:
-        neigh = imh.getNeighborhoodSphere(cs.center[0], cs.center[1], cs.center[2], r1, r1, r1*cs.scaleZ)
-        mean = neigh.getMean()
+        table = sphere_offsets(abs(r1), cs.scaleZ, shape)
     else:
-        neigh = imh.getNeighborhoodLayer(cs.center[0], cs.center[1], cs.center[2], r0, r1)
-        mean = neigh.getMean()
+        table = shell_offsets(r0, r1, cs.scaleZ, shape)
 
-    return mean
+    s = 0.
+    n = 0
+    for i, v in gather(cs.voxels(), table, cs.center, shape):
+        s += v
+        n += 1
+
+    return s / n if n > 0 else float('nan')
@@ -0,0 +1,508 @@
+"""
+NumPy backend of the measure pipeline (CPython, see backends.py)
+
+Every cell is a view of the image array (z, y, x) and every operation works on the whole cube at once: the radial
+profile is a histogram of the voxel distances, filters and maxima are sums, ranks and maxima of shifted copies of
+the cube. Distances, shells, kernels, the maxima (local maxima flooded with the noise tolerance, as mcib3d
+MaximaFinder) and the mean shift loop are the ones of the ImageJ backend, so the results match it up to the
+summation order of floating point values. scipy is optional, only used to flood the maxima faster
+"""
+
+import heapq
+import math
+import time
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+import instrument
+from backends import Backend
+from geometry import LRUCache, shell_offsets, stack_shape
+from mean_shift import kernel_weights, ms_center, shift_seeds
+from roi import dump_3DRoi, relative_center, is_on_border
+from shells import ShellSums
+from spatial import plan_cells
+
+# kernels and offsets depend only on the run parameters, shared by all the cells
+_tables = LRUCache(max_size=64)
+
+# the 26 neighbors in the order of neigh.nearest_neighborhood
+_NEIGHBORS = np.array([(dx, dy, dz) for dz in (-1, 0, 1) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                       if not (dx == 0 and dy == 0 and dz == 0)])
+
+
+def read_tiff(img_path):
+    # type: (str) -> np.ndarray
+    """
+    :return: Volume as array (depth, height, width)
+
+    :raise: ImportError if tifffile is not installed
+    """
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError('tifffile is needed to open {} with the numpy backend'.format(img_path))
+    array = tifffile.imread(img_path)
+    if array.ndim == 2:
+        array = array[np.newaxis]
+    return array
+
+
+class ArrayImage(object):
+    def __init__(self, array, title='array'):
+        # type: (np.ndarray, str) -> ArrayImage
+        """
+    Whole volume in memory, same dimensions interface of ImagePlus and ImageSource (see roi.dump_3DRoi)
+
+        :param array: Voxels (depth, height, width)
+        """
+        self.array = array
+        self.title = title
+        self.depth, self.height, self.width = array.shape
+
+    def getDimensions(self):
+        return [self.width, self.height, 1, self.depth, 1]
+
+
+class ArrayCell(object):
+    def __init__(self, image, xc, yc, zc, dim, scaleZ=1.):
+        # type: (ArrayImage, int, int, int, int, float) -> ArrayCell
+        """
+    Cube around one cell, same attributes of CellStack. The voxels are a view of the image array, replaced by a copy
+    only when filtered
+        """
+        t_start = time.time()
+        self.image = image
+        self.seed = [xc, yc, zc]
+        self.scaleZ = scaleZ
+        self.marker = None
+        self.neighbors = []
+        self.crowded = False
+        self.t_crop = 0.
+        self._crop(dim)
+        self.t_crop = time.time() - t_start
+
+    def _crop(self, dim):
+        xc, yc, zc = self.seed
+        self.dim = dim
+        self.roi3D = dump_3DRoi(self.image, xc, yc, zc, dim, self.scaleZ)
+        self.center = relative_center(xc, yc, zc, self.roi3D)
+        self.onBorder = is_on_border(self.roi3D, dim, self.scaleZ)
+        r = self.roi3D
+        self.array = self.image.array[r['z0']:r['z0'] + r['depth'], r['y0']:r['y0'] + r['height'],
+                                      r['x0']:r['x0'] + r['width']]
+
+    def grow(self, dim):
+        # type: (int) -> None
+        """
+    Same as CellStack.grow: view of a cube of side dim around the seed, center back on the seed
+        """
+        t_start = time.time()
+        self._crop(dim)
+        self.t_crop += time.time() - t_start
+
+    def set_neighbors(self, marker, neighbors):
+        # type: (int, list) -> None
+        self.marker = marker
+        self.neighbors = neighbors
+        self.crowded = len(neighbors) > 0
+
+    def contains(self, pos):
+        # type: (list) -> bool
+        return 0 <= pos[0] < self.roi3D['width'] and 0 <= pos[1] < self.roi3D['height'] and \
+            0 <= pos[2] < self.roi3D['depth']
+
+
+def _distances(shape, center, scaleZ):
+    # type: (tuple, list, float) -> np.ndarray
+    """
+Squared anisotropic distance of every voxel of a cube (depth, height, width) from center, computed with the same
+operations of geometry.OffsetTable (so the shells and the boundaries are exactly the same)
+    """
+    d, h, w = shape
+    ratio = 1. / scaleZ
+    dx = np.arange(w) - center[0]
+    dy = np.arange(h) - center[1]
+    dz = np.arange(d) - center[2]
+    return (dx * dx)[np.newaxis, np.newaxis, :] + (dy * dy)[np.newaxis, :, np.newaxis] + \
+        ((dz * dz) * ratio * ratio)[:, np.newaxis, np.newaxis]
+
+
+def _ellipsoid_offsets(rx, ry, rz):
+    # type: (float, float, float) -> list
+    """
+Offsets (dx, dy, dz) of the ellipsoid kernel of the ImageJ 3D filters and maxima ((dx/rx)^2 + (dy/ry)^2 +
+(dz/rz)^2 <= 1, see fastfilters.ellipsoid_rows)
+    """
+    def ratio2(d, r):
+        if r == 0:
+            return 0. if d == 0 else 2.
+        return float(d * d) / (r * r)
+
+    def factory():
+        vx, vy, vz = int(math.ceil(rx)), int(math.ceil(ry)), int(math.ceil(rz))
+        return [(dx, dy, dz) for dz in range(-vz, vz + 1) for dy in range(-vy, vy + 1) for dx in range(-vx, vx + 1)
+                if ratio2(dx, rx) + ratio2(dy, ry) + ratio2(dz, rz) <= 1. + 1e-9]
+
+    return _tables.get(('ellipsoid', rx, ry, rz), factory)
+
+
+def _shifted(array, offsets, fill):
+    """
+Generate the copies of the cube moved by every offset: the voxel (x, y, z) of the copy of (dx, dy, dz) is the voxel
+(x + dx, y + dy, z + dz) of array, fill outside it
+    """
+    ex = max(abs(o[0]) for o in offsets)
+    ey = max(abs(o[1]) for o in offsets)
+    ez = max(abs(o[2]) for o in offsets)
+    padded = np.pad(array, ((ez, ez), (ey, ey), (ex, ex)), mode='constant', constant_values=fill)
+    d, h, w = array.shape
+    for dx, dy, dz in offsets:
+        yield padded[ez + dz:ez + dz + d, ey + dy:ey + dy + h, ex + dx:ex + dx + w]
+
+
+def _flood(mask, pos):
+    # type: (np.ndarray, tuple) -> np.ndarray
+    """
+Voxels of mask 26-connected to pos (z, y, x), pos included
+    """
+    if ndimage is not None:
+        labels, n = ndimage.label(mask, structure=np.ones((3, 3, 3)))
+        return labels == labels[pos]
+    region = np.zeros(mask.shape, dtype=bool)
+    region[pos] = True
+    while True:
+        grown = region.copy()
+        for s in _shifted(region, _ellipsoid_offsets(1.5, 1.5, 1.5), False):
+            grown |= s
+        grown &= mask
+        if (grown == region).all():
+            return region
+        region = grown
+
+
+def _gaussian_kernel(sigma, accuracy):
+    # type: (float, float) -> np.ndarray
+    """
+Symmetric 1D gaussian kernel (length 2r+1) as ImageJ GaussianBlur.makeGaussianKernel (same cut-off and edge
+smoothing, see fastfilters.gaussian_kernel)
+    """
+    def factory():
+        k_radius = int(math.ceil(sigma * math.sqrt(-2 * math.log(accuracy)))) + 1
+        max_radius = 1 << 16
+        k_radius = min(k_radius, max_radius)
+        # single precision values, as the float[] of ImageJ
+        kernel = [float(np.float32(math.exp(-0.5 * i * i / sigma / sigma))) for i in range(k_radius)]
+        if 3 < k_radius < max_radius:
+            # edge correction: the tail goes to zero smoothly
+            sqrt_slope = float('inf')
+            r = k_radius
+            while r > k_radius // 2:
+                r -= 1
+                a = math.sqrt(kernel[r]) / (k_radius - r)
+                if a < sqrt_slope:
+                    sqrt_slope = a
+                else:
+                    break
+            for r1 in range(r + 2, k_radius):
+                kernel[r1] = float(np.float32((k_radius - r1) * (k_radius - r1) * sqrt_slope * sqrt_slope))
+        total = kernel[0] + 2 * sum(kernel[1:])
+        one_side = [np.float32(v / total) for v in kernel]
+        r = len(one_side) - 1
+        while r > 0 and one_side[r] == 0:
+            r -= 1
+        return np.array([one_side[abs(i)] for i in range(-r, r + 1)], dtype=np.float64)
+
+    return _tables.get(('gauss', sigma, accuracy), factory)
+
+
+def _convolve_axis(array, kernel, axis):
+    # type: (np.ndarray, np.ndarray, int) -> np.ndarray
+    """
+1D convolution along axis, edges replicated (as ImageJ Convolver and GaussianBlur)
+    """
+    r = len(kernel) // 2
+    pad = [(0, 0)] * 3
+    pad[axis] = (r, r)
+    padded = np.pad(array, pad, mode='edge')
+    n = array.shape[axis]
+    out = np.zeros(array.shape)
+    for j, k in enumerate(kernel):
+        window = [slice(None)] * 3
+        window[axis] = slice(j, j + n)
+        out += k * padded[tuple(window)]
+    return out
+
+
+def _to_dtype(values, dtype):
+    # type: (np.ndarray, np.dtype) -> np.ndarray
+    """
+Back to the voxel type, rounding and clamping without scaling (as the ImageJ filters do)
+    """
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        return np.clip(np.floor(values + 0.5), info.min, info.max).astype(dtype)
+    return values.astype(dtype)
+
+
+def gaussian(array, sigma, scaleZ):
+    # type: (np.ndarray, float, float) -> np.ndarray
+    """
+Separable gaussian blur, same kernels of fastfilters.gaussian (sigma on x and y, sigma * scaleZ on z)
+    """
+    out = array.astype(np.float64)
+    kxy = _gaussian_kernel(sigma, 0.002 if array.dtype == np.uint8 else 0.0002)
+    out = _convolve_axis(_convolve_axis(out, kxy, 2), kxy, 1)
+    if sigma * scaleZ > 0:
+        out = _convolve_axis(out, _gaussian_kernel(sigma * scaleZ, 0.01), 0)
+    return _to_dtype(out, array.dtype)
+
+
+def mean(array, sigma, scaleZ):
+    # type: (np.ndarray, float, float) -> np.ndarray
+    """
+Mean over the ellipsoid of radii (sigma, sigma, sigma * scaleZ), voxels outside the cube excluded (as ImageJ
+Filters3D.MEAN)
+    """
+    offsets = _ellipsoid_offsets(sigma, sigma, sigma * scaleZ)
+    sums = np.zeros(array.shape)
+    for s in _shifted(array.astype(np.float64), offsets, 0.):
+        sums += s
+    counts = np.zeros(array.shape)
+    for s in _shifted(np.ones(array.shape), offsets, 0.):
+        counts += s
+    return _to_dtype(sums / counts, array.dtype)
+
+
+def median(array, sigma, scaleZ):
+    # type: (np.ndarray, float, float) -> np.ndarray
+    """
+Median (rank n//2, as fastfilters.median) over the ellipsoid of radii (sigma, sigma, sigma * scaleZ), voxels outside
+the cube excluded (as ImageJ Filters3D.MEDIAN)
+    """
+    offsets = _ellipsoid_offsets(sigma, sigma, sigma * scaleZ)
+    # NaN outside the cube, sorted after every value
+    layers = np.sort(np.stack(list(_shifted(array.astype(np.float64), offsets, np.nan))), axis=0)
+    n = np.sum(~np.isnan(layers), axis=0)
+    return _to_dtype(np.take_along_axis(layers, (n // 2)[np.newaxis], axis=0)[0], array.dtype)
+
+
+def _shell_arrays(radius, sigma, scaleZ, shape):
+    """
+Offsets at distance d < radius and their gaussian weights as arrays (same tables of mean_shift.mean_shift)
+    """
+    def factory():
+        table = shell_offsets(0, radius, scaleZ, shape)
+        return (np.array(table.dx, dtype=np.int64), np.array(table.dy, dtype=np.int64),
+                np.array(table.dz, dtype=np.int64), np.array(kernel_weights(radius, sigma, scaleZ, shape)))
+
+    return _tables.get(('shell', radius, sigma, scaleZ, shape), factory)
+
+
+def mean_shift(cell, radius, peaks, sigma, thresh, n_iterations=15, tol=1.):
+    # type: (ArrayCell, int, list, float, float, int, float) -> tuple
+    """
+Same algorithm of mean_shift.mean_shift, the weighted mean of every seed is computed on the whole neighborhood at
+once
+
+    :return: Shifted seeds (duplicates merged) and number of iterations run by each of them
+    """
+    array = cell.array
+    d, h, w = array.shape
+    dx, dy, dz, weights = _shell_arrays(radius, sigma, cell.scaleZ, stack_shape(cell))
+
+    def shift(x):
+        xs, ys, zs = x[0] + dx, x[1] + dy, x[2] + dz
+        inside = (xs >= 0) & (xs < w) & (ys >= 0) & (ys < h) & (zs >= 0) & (zs < d)
+        instrument.count('voxels', len(dx))
+        values = array[zs[inside], ys[inside], xs[inside]].astype(np.float64)
+        # discard neighbors below certain thresh
+        keep = values >= thresh
+        wv = weights[inside][keep] * values[keep]
+        denominator = float(wv.sum())
+        if denominator == 0:
+            # no neighbor above thresh, the seed cannot move
+            return None
+        return [int((x[0] * denominator + float(np.dot(wv, dx[inside][keep]))) / denominator),
+                int((x[1] * denominator + float(np.dot(wv, dy[inside][keep]))) / denominator),
+                int((x[2] * denominator + float(np.dot(wv, dz[inside][keep]))) / denominator)]
+
+    return shift_seeds(peaks, shift, cell.scaleZ, n_iterations, tol)
+
+
+def watershed(array, seeds, thresholds):
+    # type: (np.ndarray, list, list) -> list
+    """
+Seeded watershed of the volume flooded down to the lowest threshold, as utils.image_watershed: priority flood from
+the seeds (brightest voxel first, the oldest one among equal values), 26-connected and limited to the voxels above
+the lowest threshold, so the bright regions without seed are not assigned to any seed. A voxel holding more than
+one seed is flooded from the first one
+    """
+    array = np.asarray(array, dtype=np.float64)
+    # one voxel of background around the volume: the neighbors of a voxel never wrap around a row or a slice
+    free = np.pad(array >= min(thresholds), 1, mode='constant')
+    d, h, w = free.shape
+    # memoryviews: item access in the flood loop is much faster than on the arrays
+    values = memoryview(np.pad(array, 1, mode='constant').ravel())
+    free = bytearray(free.ravel().tobytes())
+    steps = [int(dz * h * w + dy * w + dx) for dx, dy, dz in _NEIGHBORS]
+
+    flat = np.zeros(len(free), dtype=np.int32)
+    labels = memoryview(flat)
+    heap = []
+    for i, seed in enumerate(seeds):
+        idx = ((seed[2] + 1) * h + seed[1] + 1) * w + seed[0] + 1
+        if labels[idx] == 0:
+            labels[idx] = i + 1
+            free[idx] = 0
+            heap.append((-values[idx], len(heap), idx))
+    heapq.heapify(heap)
+    age = len(heap)
+    while heap:
+        idx = heapq.heappop(heap)[2]
+        label = labels[idx]
+        for step in steps:
+            n = idx + step
+            if free[n]:
+                free[n] = 0
+                labels[n] = label
+                heapq.heappush(heap, (-values[n], age, n))
+                age += 1
+    labels = flat.reshape(d, h, w)[1:-1, 1:-1, 1:-1]
+
+    # voxels above the threshold of their own seed
+    thresh = np.array([np.inf] + list(thresholds))
+    zs, ys, xs = np.nonzero((labels > 0) & (array >= thresh[labels]))
+    keep = labels[zs, ys, xs]
+    n_labels = len(seeds) + 1
+    counts = np.bincount(keep, minlength=n_labels)
+    sums = [np.bincount(keep, weights=c, minlength=n_labels) for c in (xs, ys, zs)]
+    regions = []
+    for i in range(1, n_labels):
+        n = int(counts[i])
+        regions.append((n, [float(s[i]) / n for s in sums] if n else None))
+    return regions
+
+
+class NumpyBackend(Backend):
+    """
+    NumPy backend: cells are ArrayCell, every operation works on the whole cube array
+    """
+    name = 'numpy'
+
+    def open_image(self, img_path, mode='full', cache_slices=64):
+        return ArrayImage(read_tiff(img_path), title=img_path)
+
+    def image_height(self, image):
+        return image.height
+
+    def cells(self, image, seeds, cube_dim, scaleZ, order='file', dims=None):
+        for i, neighbors in plan_cells(seeds, cube_dim, scaleZ, order):
+            pos = seeds[i]
+            cell = ArrayCell(image, pos[0], pos[1], pos[2], cube_dim if dims is None else dims[i], scaleZ)
+            cell.set_neighbors(i, neighbors)
+            yield cell
+
+    def get_voxel(self, cell, pos):
+        if not cell.contains(pos):
+            raise IndexError("3D coordinates out of bounds")
+        return cell.array[pos[2], pos[1], pos[0]].item()
+
+    def filter(self, cell, method, sigma, engine='ij'):
+        if method == 'gauss':
+            cell.array = gaussian(cell.array, sigma, cell.scaleZ)
+        elif method == 'mean':
+            cell.array = mean(cell.array, sigma, cell.scaleZ)
+        elif method == 'median':
+            cell.array = median(cell.array, sigma, cell.scaleZ)
+        else:
+            raise ValueError('Filter not valid: ' + method)
+
+    def local_max(self, cell, seed):
+        array = cell.array
+        d, h, w = array.shape
+        max_v = self.get_voxel(cell, seed)
+        max_pos = list(seed)
+        visited = set()
+        while True:
+            visited.add(tuple(max_pos))
+            pos = _NEIGHBORS + max_pos
+            pos = pos[(pos[:, 0] >= 0) & (pos[:, 0] < w) & (pos[:, 1] >= 0) & (pos[:, 1] < h) &
+                      (pos[:, 2] >= 0) & (pos[:, 2] < d)]
+            instrument.count('voxels', len(_NEIGHBORS))
+            if len(pos) == 0:
+                break
+            values = array[pos[:, 2], pos[:, 1], pos[:, 0]]
+            # first maximum in scan order, as in utils.local_max
+            best = int(np.argmax(values))
+            if values[best] <= max_v:
+                break
+            new_pos = pos[best].tolist()
+            if tuple(new_pos) in visited:
+                break
+            max_pos = new_pos
+            max_v = values[best]
+        return max_pos
+
+    def radial_profile(self, cell, max_rad, center=None, lazy=False, min_rad=0):
+        # the whole cube is a single array operation, nothing to gain computing it by shells
+        profile = ShellSums(max_rad, cell.center if center is None else center)
+        r_max = max_rad + 1
+        d2 = _distances(cell.array.shape, profile.center, cell.scaleZ)
+        # voxels within the sphere of radius max_rad+1 (as geometry.sphere_offsets), or the shell from min_rad
+        # (as geometry.shell_offsets)
+        if min_rad > 0:
+            inside = (d2 < r_max * r_max) & (d2 >= min_rad * min_rad)
+        else:
+            inside = d2 <= r_max * r_max
+        d2 = d2[inside]
+        values = cell.array[inside].astype(np.float64)
+        instrument.count('voxels', len(values))
+        shell = np.sqrt(d2).astype(np.int64)
+
+        in_profile = shell <= max_rad
+        profile.sums = np.bincount(shell[in_profile], weights=values[in_profile], minlength=max_rad + 1).tolist()
+        profile.counts = np.bincount(shell[in_profile], minlength=max_rad + 1).tolist()
+        edge = shell * shell == d2
+        profile.edge_sums = np.bincount(shell[edge], weights=values[edge], minlength=max_rad + 2).tolist()
+        profile.edge_counts = np.bincount(shell[edge], minlength=max_rad + 2).tolist()
+        return profile
+
+    def find_maxima(self, cell, rad, thresh):
+        # in MaximaFinder thresh is the noise tolerance value
+        array = cell.array.astype(np.float64)
+        local = np.full(array.shape, -np.inf)
+        for s in _shifted(array, _ellipsoid_offsets(rad, rad, rad * cell.scaleZ), -np.inf):
+            np.maximum(local, s, out=local)
+        # peaks at thresh are kept, as in utils.find_maxima
+        zs, ys, xs = np.nonzero((array == local) & (array >= thresh))
+        # brightest first, as the list of MaximaFinder
+        order = np.argsort(-array[zs, ys, xs], kind='stable')
+
+        # a peak floods the voxels connected to it down to its value minus the noise tolerance, the peaks in the
+        # flooded region are dropped
+        work = array.copy()
+        peaks = []
+        for k in order:
+            pos = (zs[k], ys[k], xs[k])
+            if work[pos] <= 0:
+                continue
+            peaks.append([int(xs[k]), int(ys[k]), int(zs[k])])
+            work[_flood(work >= max(1, int(array[pos] - thresh)), pos)] = 0
+        peaks.append(cell.center)
+        return peaks
+
+    def mean_shift(self, cell, radius, peaks, sigma, thresh, log=None):
+        return ms_center(cell, radius, peaks, sigma, thresh, method=mean_shift, log=log)
+
+    def downsample(self, image, factor, z_factor):
+        d, h, w = image.depth // z_factor, image.height // factor, image.width // factor
+        bins = image.array[:d * z_factor, :h * factor, :w * factor].reshape(d, z_factor, h, factor, w, factor)
+        return ArrayImage(bins.mean(axis=(1, 3, 5)), title=image.title)
+
+    def watershed(self, image, seeds, thresholds):
+        return watershed(image.array, seeds, thresholds)
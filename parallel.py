@@ -0,0 +1,122 @@
+from collections import deque
+
+from java.lang import Runtime
+from java.util.concurrent import Callable, Executors
+
+from stacks import CellStack
+from spatial import plan_cells
+
+
+class CellTask(Callable):
+    def __init__(self, imp, seed, cube_dim, scaleZ, func, view=False, marker=None, neighbors=()):
+        # type: (ImagePlus, list, int, float, callable, bool, int, list) -> CellTask
+        """
+    Work unit of the pool: crop the cell stack of one seed and run func on it.
+    The CellStack (and everything wrapping it) is created inside the worker thread, so no state is shared
+    between cells apart from the read-only original image
+        """
+        self.imp = imp
+        self.seed = seed
+        self.cube_dim = cube_dim
+        self.scaleZ = scaleZ
+        self.func = func
+        self.view = view
+        self.marker = marker
+        self.neighbors = list(neighbors)
+
+    def call(self):
+        cs = CellStack(self.imp, self.seed[0], self.seed[1], self.seed[2], self.cube_dim, self.scaleZ,
+                       view=self.view)
+        cs.set_neighbors(self.marker, self.neighbors)
+        try:
+            return self.func(cs)
+        finally:
+            cs.close()
+
+
+def default_workers():
+    # type: () -> int
+    return Runtime.getRuntime().availableProcessors()
+
+
+def cell_pool(n_workers=None):
+    # type: (int) -> ExecutorService
+    """
+Fixed pool of n_workers Java threads (number of available processors if None) to be shared by several map_cells
+calls, e.g. one per tile of an image. The caller shuts it down (shutdownNow) when done
+    """
+    if n_workers is None:
+        n_workers = default_workers()
+    return Executors.newFixedThreadPool(n_workers)
+
+
+def map_cells(imp, seeds, cube_dim, scaleZ, func, n_workers=None, max_pending=None, view=False, order='file',
+              plan=None, dims=None, pool=None):
+    # type: (ImagePlus, list, int, float, callable, int, int, bool, str, list, list, ExecutorService) -> list
+    """
+Run func on the CellStack of every seed using a fixed pool of Java threads (Jython has no GIL).
+func must not touch the GUI (no show(), no IJ.log on the log window): it runs outside the event dispatch thread.
+
+    :param imp: Original ImageJ ImagePlus or ImageSource (only read by the workers)
+
+    :param seeds: Coordinates of the cells
+
+    :param cube_dim: Dimension of the cube roi around every cell
+
+    :param scaleZ: Depth of a voxel (1 if image is isotropic)
+
+    :param func: Function CellStack -> result, called once per seed
+
+    :param n_workers: Number of threads (number of available processors if None)
+
+    :param max_pending: Maximum number of submitted but not collected cells, bounds the memory taken by
+    the cell stacks waiting for a free worker (4 times n_workers if None)
+
+    :param view: Create the cell stacks as views of imp (see CellStack)
+
+    :param order: Order in which the cells are submitted (see spatial.plan_cells)
+
+    :param plan: Cells to process as returned by spatial.plan_cells (all the seeds in the given order if None),
+    e.g. the cells of one tile (see tiles.gen_tiles)
+
+    :param dims: Cube dimension of every seed (see stacks.gen_cell_stacks), cube_dim for all if None
+
+    :param pool: Thread pool running the cells (see cell_pool), left open. If None a pool of n_workers threads is
+    created and shut down at the end
+
+    :return: Results of func in the same order of seeds (whatever the processing order), None for the seeds not in
+    the plan
+    """
+    if n_workers is None:
+        n_workers = default_workers()
+    if max_pending is None:
+        max_pending = 4 * n_workers
+    if plan is None:
+        plan = plan_cells(seeds, cube_dim, scaleZ, order)
+
+    own_pool = pool is None
+    if own_pool:
+        pool = cell_pool(n_workers)
+    results = [None] * len(seeds)
+    pending = deque()
+    try:
+        for i, neighbors in plan:
+            task = CellTask(imp, seeds[i], cube_dim if dims is None else dims[i], scaleZ, func, view, i, neighbors)
+            pending.append((i, pool.submit(task)))
+            if len(pending) >= max_pending:
+                # futures are collected in submission order
+                j, future = pending.popleft()
+                results[j] = future.get()
+
+        while pending:
+            j, future = pending.popleft()
+            results[j] = future.get()
+    finally:
+        if own_pool:
+            pool.shutdownNow()
+        else:
+            # tasks of this call still queued (after an error) must not run on the shared pool
+            for j, future in pending:
+                future.cancel(True)
+
+    return results
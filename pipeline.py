@@ -0,0 +1,329 @@
+"""
+Measure pipeline of a cell, independent of the compute backend (see backends.py)
+
+main.py runs it with the ImageJ backend in Fiji. In CPython it runs with the NumPy backend on whole images:
+
+    python pipeline.py image.tif [results.csv]
+
+(markers next to the image as for main.py, parameters in DEFAULT_PARAMS)
+"""
+
+from __future__ import with_statement, print_function
+import math
+import os
+import sys
+import time
+
+from backends import get_backend
+from cache import stage_key
+from instrument import Metrics, ImageMetrics
+from markers import image_markers
+from results import write_results
+from roi import absolute_position
+from pyramid import pyramid_image
+from segment import segment_image
+from shells import profile_local_mean, radius_thresh, interpolate_radius
+from spatial import cell_peaks
+
+# parameters of the pipeline, the same of main.py (see main.cell_params)
+DEFAULT_PARAMS = {
+    'algorithm': 'cells',
+    'method': 'none', 'sigma': 2, 'filter_engine': 'ij', 'prefilter': False,
+    'recenter': True,
+    'r0': 13, 'r1': 18, 'r2': 40, 'meanw': 0.4,
+    'max_rad': 40, 'radius_confirm': 0,
+    'maxima_rad': 2, 'noise_tol': 0,
+    'ms_sigma': 10,
+    'pyramid_factor': 4, 'pyramid_band': 2,
+    'adaptive_crop': False, 'crop_margin': 8, 'min_crop_dim': 24
+}
+
+cube_roi_dim = 70
+scaleZ = 0.4
+
+
+def quiet(msg):
+    # type: (str) -> None
+    """
+Logger that drops every message (used in batch mode)
+    """
+    pass
+
+
+def fit_dim(radius, margin, min_dim, max_dim):
+    # type: (float, int, int, int) -> int
+    """
+Side of the cube containing a cell of the given radius plus margin voxels on every side, between min_dim and max_dim
+    """
+    return min(max(2 * (int(math.ceil(radius)) + margin), min_dim), max_dim)
+
+
+def crop_dims(backend, image, markers, params, cube_dim, scaleZ, order='file', cell_metrics=None):
+    # type: (Backend, object, list, dict, int, float, str, list) -> list
+    """
+Adaptive cube side of every marker: first crossing of the radial profile (around the seed, nothing filtered)
+with the local mean, plus params['crop_margin'] voxels, between params['min_crop_dim'] and cube_dim
+
+    :param cell_metrics: If given, one Metrics per marker (passed on to measure_cell): the time of the pass, crop of
+    its cube included, is added as stage crop_dims and the voxels it visits to the counters of the marker
+
+    :return: Cube side of every marker (see Backend.cells)
+    """
+    r0, r1, r2, meanw = params['r0'], params['r1'], params['r2'], params['meanw']
+    max_rad = params['max_rad']
+    dims = [cube_dim] * len(markers)
+    for cell in backend.cells(image, markers, cube_dim, scaleZ, order):
+        metrics = Metrics() if cell_metrics is None else cell_metrics[cell.marker]
+        with metrics.activate(), metrics.stage('crop_dims'):
+            backend.prepare(cell)
+            profile = backend.radial_profile(cell, max(max_rad, r0, r2), lazy=r2 < max_rad)
+            loc_mean = profile_local_mean(profile, r0, r1, r2, meanw)
+            radius = radius_thresh(profile.iter_means(max_rad), loc_mean)
+            dims[cell.marker] = fit_dim(radius, params['crop_margin'], params['min_crop_dim'], cube_dim)
+            backend.close_cell(cell)
+        metrics.add_time('crop_dims', cell.t_crop)
+    return dims
+
+
+def measure_cell(cell, backend, params, log=quiet, peak_index=None, cache=None, image_key=None, image_metrics=None,
+                 max_dim=None, metrics=None):
+    # type: (object, Backend, dict, callable, GridIndex, ResultCache, str, ImageMetrics, int, Metrics) -> dict
+    """
+Run the whole measure pipeline on a cell without any GUI interaction
+
+    :param cell: Cell of the backend (CellStack, ArrayCell)
+
+    :param backend: Backend reading the voxels of the cell
+
+    :param params: Parameters of the pipeline (keys of DEFAULT_PARAMS)
+
+    :param log: Function used to log intermediate values (e.g. IJ.log or quiet)
+
+    :param peak_index: Maxima of the whole image (see utils.image_maxima), if None they are searched in the cell
+
+    :param cache: If given, the output of every stage is cached and a stage is computed again only if its
+    parameters (or those of a previous stage) changed. The timings of the cached stages are left empty
+
+    :param image_key: Digest of the image content (see cache.image_digest), required with cache
+
+    :param image_metrics: If given, the metrics of the cell are added to it (see instrument.ImageMetrics)
+
+    :param max_dim: Adaptive crops (see crop_dims): while a radius comes within params['crop_margin'] / 2 voxels of
+    the edge of the cube, the cell is cropped again with a cube twice as large (up to max_dim) and measured again
+
+    :param metrics: Metrics of the cell so far (e.g. those of crop_dims), new ones if None
+
+    :return: Cell record with seed, refined center (image coordinates), radii, local means, stage timings (t_*)
+    and counters (voxels visited, mean shift iterations, crop grows)
+    """
+    if metrics is None:
+        metrics = Metrics()
+    if cache is not None:
+        # 0 rather than an empty column when no stage was cached
+        metrics.count('cache_hits', 0)
+    with metrics.activate():
+        with metrics.stage('total'):
+            record = _measure_cell(cell, backend, params, metrics, log, peak_index, cache, image_key)
+            while max_dim is not None and cell.dim < max_dim and \
+                    max(record['radius'], record['new_radius']) > cell.dim // 2 - params['crop_margin'] // 2:
+                log('Radius close to the edge of the cube {}, growing it'.format(cell.dim))
+                backend.grow_cell(cell, min(2 * cell.dim, max_dim))
+                metrics.count('crop_grows')
+                record = _measure_cell(cell, backend, params, metrics, log, peak_index, cache, image_key)
+    # crop (or view) of the cube, done when the cell was created and when it grew
+    metrics.add_time('crop', cell.t_crop)
+    record['crop_dim'] = cell.dim
+    record.update(metrics.as_record())
+    if image_metrics is not None:
+        image_metrics.add_cell(metrics)
+    return record
+
+
+def _measure_cell(cs, backend, params, metrics, log, peak_index, cache, image_key):
+    # type: (object, Backend, dict, Metrics, callable, GridIndex, ResultCache, str) -> dict
+    method = params['method']
+    r0, r1, r2, meanw = params['r0'], params['r1'], params['r2'], params['meanw']
+    max_rad = params['max_rad']
+    record = {
+        'seed_x': cs.seed[0], 'seed_y': cs.seed[1], 'seed_z': cs.seed[2],
+        'on_border': cs.onBorder,
+        'n_neighbors': len(cs.neighbors)
+    }
+
+    log('Cell at {}'.format(cs.center))
+    if cs.crowded:
+        log('Crowded cell, cube overlapping markers {}'.format(cs.neighbors))
+    backend.prepare(cs)
+
+    # filtered only when the first stage is computed (not at all if every stage is cached)
+    filtered = [method == 'none' or params['prefilter']]
+    keys = [stage_key(image_key, 'seed', {'seed': cs.seed})] if cache is not None else []
+
+    def run_stage(name, stage_params, compute):
+        def filter_and_compute():
+            if not filtered[0]:
+                log('Applying ' + method + ' 3D filtering')
+                with metrics.stage('filter'):
+                    backend.filter(cs, method, params['sigma'], engine=params['filter_engine'])
+                filtered[0] = True
+            return compute()
+
+        if cache is None:
+            return filter_and_compute()
+        keys.append(stage_key(keys[-1], name, stage_params))
+        value, hit = cache.stage(keys[-1], filter_and_compute)
+        if hit:
+            metrics.count('cache_hits')
+        return value
+
+    # cell stats
+    def center_stage():
+        with metrics.stage('local_max'):
+            loc_max = backend.local_max(cs, cs.center)
+        log('Local max in {}, value: {}'.format(loc_max, backend.get_voxel(cs, loc_max)))
+        return loc_max
+
+    filter_params = {'method': method}
+    if method != 'none':
+        filter_params.update({'sigma': params['sigma'], 'engine': params['filter_engine'],
+                              'prefilter': params['prefilter']})
+    filter_params.update({'cube_roi_dim': cs.dim, 'scaleZ': cs.scaleZ})
+    loc_max = run_stage('local_max', filter_params, center_stage)
+
+    if params['recenter']:
+        cs.center = loc_max
+
+    def radius_stage():
+        # shell sums around the center, shared by local mean and radial distribution. The local mean reads every
+        # shell below r2, so the profile is lazy only when the shells from r2 to max_rad can be skipped
+        with metrics.stage('rad3d'):
+            profile = backend.radial_profile(cs, max(max_rad, r0, r2), lazy=r2 < max_rad)
+
+        with metrics.stage('local_mean'):
+            loc_mean = profile_local_mean(profile, r0, r1, r2, meanw)
+        log('Local mean: ' + str(loc_mean))
+
+        with metrics.stage('rad3d'):
+            radius = radius_thresh(profile.iter_means(max_rad), loc_mean, confirm)
+        fine_radius = interpolate_radius(profile, radius, loc_mean)
+        log('Radius: {} ({:.2f})'.format(radius, fine_radius))
+        return [loc_mean, radius, fine_radius]
+
+    confirm = params['radius_confirm']
+    loc_mean, radius, fine_radius = run_stage('radius', {'recenter': params['recenter'], 'r0': r0, 'r1': r1, 'r2': r2,
+                                                         'meanw': meanw, 'max_rad': max_rad,
+                                                         'radius_confirm': confirm}, radius_stage)
+
+    # find local maxima in the whole image, even those far from the cell center
+    def maxima_stage():
+        with metrics.stage('maxima'):
+            if peak_index is not None:
+                peaks = cell_peaks(cs, peak_index, radius, loc_mean)
+            else:
+                peaks = backend.find_maxima(cs, radius // 2, loc_mean)
+        log('Peaks: ' + str(peaks))
+        return peaks
+
+    maxima_params = {'global_maxima': peak_index is not None}
+    if peak_index is not None:
+        maxima_params.update({'maxima_rad': params['maxima_rad'], 'noise_tol': params['noise_tol']})
+    peaks = run_stage('maxima', maxima_params, maxima_stage)
+
+    # run mean shift with maxima that are closer to the cell center
+    def mean_shift_stage():
+        log('Applying mean shift...')
+        with metrics.stage('mean_shift'):
+            centroid = backend.mean_shift(cs, radius, peaks, params['ms_sigma'], loc_mean, log=log)
+        log('New center: ' + str(centroid))
+        return centroid
+
+    centroid = run_stage('mean_shift', {'ms_sigma': params['ms_sigma']}, mean_shift_stage)
+
+    # update the centroid
+    cs.center = centroid
+
+    # apply local_mean thresh to radial distribution
+    def new_radius_stage():
+        with metrics.stage('new_rad3d'):
+            new_profile = backend.radial_profile(cs, max(max_rad, radius + 2, r2), lazy=r2 < max_rad)
+
+        with metrics.stage('new_local_mean'):
+            new_loc_mean = profile_local_mean(new_profile, radius - 2, radius + 2, r2, meanw)
+        log('New local mean: ' + str(new_loc_mean))
+
+        with metrics.stage('new_rad3d'):
+            new_radius = radius_thresh(new_profile.iter_means(max_rad), new_loc_mean, confirm)
+        new_fine_radius = interpolate_radius(new_profile, new_radius, new_loc_mean)
+        log('New radius: {} ({:.2f})'.format(new_radius, new_fine_radius))
+        return [new_loc_mean, new_radius, new_fine_radius]
+
+    new_loc_mean, new_radius, new_fine_radius = run_stage('new_radius', {}, new_radius_stage)
+
+    center = absolute_position(cs.center, cs.roi3D)
+    record.update({
+        'center_x': center[0], 'center_y': center[1], 'center_z': center[2],
+        'radius': radius, 'new_radius': new_radius,
+        'fine_radius': fine_radius, 'new_fine_radius': new_fine_radius,
+        'loc_mean': loc_mean, 'new_loc_mean': new_loc_mean
+    })
+    return record
+
+
+def measure_image(img_path, backend, params=None, cube_dim=cube_roi_dim, scaleZ=scaleZ, order='file', log=quiet,
+                  metrics=None):
+    # type: (str, Backend, dict, int, float, str, callable, ImageMetrics) -> list
+    """
+Measure every cell of an image with the given backend (sequential, no cache). With params['algorithm'] 'segment'
+the whole image is segmented at once instead (see segment.py), with 'pyramid' the cells are measured coarse to fine
+(see pyramid.py)
+
+    :param params: Parameters of the pipeline (DEFAULT_PARAMS if None)
+
+    :return: List of cell records, in marker order
+    """
+    if params is None:
+        params = DEFAULT_PARAMS
+    if metrics is None:
+        metrics = ImageMetrics(os.path.basename(img_path))
+
+    with metrics.image.stage('open'):
+        image = backend.open_image(img_path)
+    with metrics.image.stage('markers'):
+        markers = image_markers(img_path, backend.image_height(image))
+
+    t_cells = time.time()
+    if params['algorithm'] in ['segment', 'pyramid']:
+        measure = segment_image if params['algorithm'] == 'segment' else pyramid_image
+        records = measure(image, backend, markers, params, cube_dim, scaleZ, order, metrics)
+        for i, record in enumerate(records):
+            record['image'] = os.path.basename(img_path)
+            record['marker'] = i
+    else:
+        dims, max_dim, crop_metrics = None, None, None
+        if params['adaptive_crop']:
+            crop_metrics = [Metrics() for _ in markers]
+            with metrics.image.stage('crop_dims'):
+                dims = crop_dims(backend, image, markers, params, cube_dim, scaleZ, order, crop_metrics)
+            max_dim = cube_dim
+        records = [None] * len(markers)
+        for cell in backend.cells(image, markers, cube_dim, scaleZ, order, dims):
+            record = measure_cell(cell, backend, params, log=log, image_metrics=metrics, max_dim=max_dim,
+                                  metrics=crop_metrics[cell.marker] if crop_metrics is not None else None)
+            record['image'] = os.path.basename(img_path)
+            record['marker'] = cell.marker
+            records[cell.marker] = record
+            backend.close_cell(cell)
+    metrics.image.add_time('cells', time.time() - t_cells)
+    backend.close_image(image)
+    return records
+
+
+if __name__ == '__main__':
+    img_path = sys.argv[1]
+    results_path = sys.argv[2] if len(sys.argv) > 2 else os.path.splitext(img_path)[0] + '_results.csv'
+    image_metrics = ImageMetrics(os.path.basename(img_path))
+    image_records = measure_image(img_path, get_backend('numpy'), metrics=image_metrics)
+    write_results(results_path, image_records)
+    t_total = image_metrics.cells.get('total', [])
+    print('Measured {} cells in {:.2f} s ({:.4f} s per cell), results in {}'.format(
+        len(image_records), sum(t_total), sum(t_total) / len(t_total) if t_total else float('nan'), results_path))
@@ -0,0 +1,131 @@
+import hashlib
+import os
+
+from ij import IJ, ImagePlus, VirtualStack
+from ij.io import FileSaver
+
+from filters import filter_imp, filter_halo
+from sources import open_source
+
+
+class FilteredStack(VirtualStack):
+    def __init__(self, source, method, sigma, scaleZ, slab_depth, engine='ij'):
+        # type: (ImageSource, str, float, float, int, str) -> FilteredStack
+        """
+    Virtual stack with the filtered slices of the source, computed slab by slab on demand.
+    Every slab is read with a halo of slices above and below (see filters.filter_halo) so the result is the same
+    of filtering the whole volume, while only one slab is in memory at a time
+
+        :param slab_depth: Number of slices filtered together (without the halo)
+        """
+        VirtualStack.__init__(self, source.width, source.height, None, None)
+        self.source = source
+        self.method = method
+        self.sigma = sigma
+        self.scaleZ = scaleZ
+        self.slab_depth = slab_depth
+        self.engine = engine
+        self.halo = filter_halo(method, sigma, scaleZ)
+        self.slab_z0 = None
+        self.slab = None
+
+    def getSize(self):
+        return self.source.depth
+
+    def getSliceLabel(self, n):
+        return None
+
+    def getProcessor(self, n):
+        z = n - 1
+        z0 = (z // self.slab_depth) * self.slab_depth
+        if z0 != self.slab_z0:
+            self.slab = self._filter_slab(z0)
+            self.slab_z0 = z0
+        return self.slab.getProcessor(z - z0 + 1 + self._top_halo(z0))
+
+    def _top_halo(self, z0):
+        return z0 - max(z0 - self.halo, 0)
+
+    def _filter_slab(self, z0):
+        # type: (int) -> ImageStack
+        src = self.source
+        top = max(z0 - self.halo, 0)
+        bottom = min(z0 + self.slab_depth + self.halo, src.depth)
+        imp = ImagePlus('slab', src.crop(0, 0, top, src.width, src.height, bottom - top))
+        filter_imp(imp, self.method, self.sigma, self.scaleZ, self.engine)
+        return imp.getImageStack()
+
+
+def filter_key(img_path, method, sigma, scaleZ, engine='ij'):
+    # type: (str, str, float, float, str) -> str
+    """
+Key of a filtered image: changes if the image file or any filter parameter changes
+    """
+    stat = os.stat(img_path)
+    desc = '|'.join(str(p) for p in [os.path.abspath(img_path), stat.st_size, stat.st_mtime, method, sigma, scaleZ,
+                                             engine])
+    return hashlib.md5(desc.encode('utf-8')).hexdigest()
+
+
+def filter_image(source, method, sigma, scaleZ, slab_depth=None, engine='ij'):
+    # type: (ImageSource, str, float, float, int, str) -> ImagePlus
+    """
+Filter the whole image once (instead of every cell cube)
+
+    :param source: Image to filter
+
+    :param method: name of filter, can be 'gauss', 'mean' or 'median'
+
+    :param sigma: sigma value along xy axis (z sigma is sigma * scaleZ)
+
+    :param slab_depth: If given, the volume is streamed in slabs of slab_depth slices (plus halo), otherwise it
+    is filtered at once
+
+    :param engine: Filter implementation (see filters.filter_cellstack)
+
+    :return: Filtered image (virtual if streamed, slices are computed when read)
+    """
+    if slab_depth is None or slab_depth >= source.depth:
+        imp = ImagePlus(source.title, source.crop(0, 0, 0, source.width, source.height, source.depth))
+        filter_imp(imp, method, sigma, scaleZ, engine)
+        return imp
+
+    return ImagePlus(source.title, FilteredStack(source, method, sigma, scaleZ, slab_depth, engine))
+
+
+def prefiltered_source(img_path, source, method, sigma, scaleZ, cache_dir, slab_depth=None, mode='full',
+                       cache_slices=64, engine='ij'):
+    # type: (str, ImageSource, str, float, float, str, int, str, int, str) -> ImageSource
+    """
+Source of the filtered image, cached on disk: the filter runs only the first time an image is processed with
+the given parameters
+
+    :param img_path: Path of the original image (part of the cache key)
+
+    :param source: Original image
+
+    :param cache_dir: Directory of the filtered images
+
+    :param mode: How the cached filtered image is opened (see sources.open_source)
+
+    :return: ImageSource over the filtered image
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    cached_path = os.path.join(cache_dir, filter_key(img_path, method, sigma, scaleZ, engine) + '.tif')
+
+    if not os.path.exists(cached_path):
+        IJ.log('Filtering {} ({}, sigma {})...'.format(img_path, method, sigma))
+        imp = filter_image(source, method, sigma, scaleZ, slab_depth, engine)
+        # slices of virtual stacks are written one at a time, rename makes the file visible only when complete
+        tmp_path = cached_path + '.{}.tmp'.format(os.getpid())
+        if imp.getStackSize() > 1:
+            FileSaver(imp).saveAsTiffStack(tmp_path)
+        else:
+            FileSaver(imp).saveAsTiff(tmp_path)
+        os.rename(tmp_path, cached_path)
+        imp.close()
+
+    filtered = open_source(cached_path, mode=mode, cache_slices=cache_slices)
+    filtered.title = source.title
+    return filtered
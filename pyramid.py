@@ -0,0 +1,151 @@
+"""
+Coarse-to-fine radius estimation, alternative to the pipeline around every seed (see pipeline.py) for easy cells
+
+The image is binned once (factor along x and y, the closest factor to factor * scaleZ along z, so the coarse voxels
+are closer to isotropic). On the coarse image every cell gets an approximate center (local maximum), local mean and
+radius. At full resolution the center is refined with the local maximum from the coarse one and the radial profile
+is computed only in a band of shells around the coarse radius, falling back to the whole profile if the crossing is
+not inside the band. The local mean is the coarse one: the bins are averages, the means over spheres and layers are
+almost the same as at full resolution
+"""
+
+from __future__ import with_statement
+import math
+
+from instrument import Metrics, ImageMetrics
+from roi import absolute_position, relative_center
+from shells import profile_local_mean, radius_thresh, interpolate_radius
+
+
+def pyramid_factors(factor, scaleZ):
+    # type: (int, float) -> tuple
+    """
+    :return: (z_factor, scaleZ of the coarse image) for a binning of factor along x and y
+    """
+    z_factor = max(1, int(round(factor * scaleZ)))
+    return z_factor, scaleZ * factor / z_factor
+
+
+def coarse_estimates(backend, coarse, markers, params, factor, z_factor, cube_dim, scaleZ, order='file'):
+    # type: (Backend, object, list, dict, int, int, int, float, str) -> list
+    """
+Center, radius and local mean of every marker on the binned image, in full resolution units
+
+    :param coarse: Binned image (see Backend.downsample)
+
+    :param scaleZ: scaleZ of the coarse image
+
+    :return: One dict per marker (center in image coordinates, radius, local mean, metrics of the cell), in marker
+    order
+    """
+    def scaled(r):
+        return max(int(round(float(r) / factor)), 1)
+
+    r0, r1, r2 = scaled(params['r0']), scaled(params['r1']), scaled(params['r2'])
+    max_rad = scaled(params['max_rad'])
+    coarse_markers = [[m[0] // factor, m[1] // factor, m[2] // z_factor] for m in markers]
+
+    estimates = [None] * len(markers)
+    for cell in backend.cells(coarse, coarse_markers, max(cube_dim // factor, 1), scaleZ, order):
+        metrics = Metrics()
+        with metrics.activate():
+            with metrics.stage('total'), metrics.stage('coarse'):
+                backend.prepare(cell)
+                cell.center = backend.local_max(cell, cell.center)
+                profile = backend.radial_profile(cell, max(max_rad, r0, r2), lazy=r2 < max_rad)
+                loc_mean = profile_local_mean(profile, r0, r1, r2, params['meanw'])
+                radius = radius_thresh(profile.iter_means(max_rad), loc_mean)
+                # second local mean around the first radius, as the new radius stage of the pipeline
+                full = radius * factor
+                new_loc_mean = profile_local_mean(profile, scaled(full - 2), scaled(full + 2), r2, params['meanw'])
+                new_radius = radius_thresh(profile.iter_means(max_rad), new_loc_mean)
+                new_radius = interpolate_radius(profile, new_radius, new_loc_mean)
+        x, y, z = absolute_position(cell.center, cell.roi3D)
+        estimates[cell.marker] = {
+            # center of the bin
+            'center': [x * factor + (factor - 1) // 2, y * factor + (factor - 1) // 2,
+                       z * z_factor + (z_factor - 1) // 2],
+            'radius': new_radius * factor,
+            'loc_mean': new_loc_mean,
+            'metrics': metrics
+        }
+        backend.close_cell(cell)
+    return estimates
+
+
+def refine_cell(cell, backend, estimate, params, band):
+    # type: (object, Backend, dict, dict, int) -> dict
+    """
+Full resolution center and radius of a cell from its coarse estimate (metrics of the estimate updated)
+
+    :param band: Half width (shells) of the band around the coarse radius
+
+    :return: Cell record
+    """
+    metrics = estimate['metrics']
+    max_rad = params['max_rad']
+    loc_mean = estimate['loc_mean']
+    with metrics.activate():
+        with metrics.stage('total'):
+            backend.prepare(cell)
+            start = relative_center(estimate['center'][0], estimate['center'][1], estimate['center'][2], cell.roi3D)
+            r = cell.roi3D
+            start = [min(max(start[0], 0), r['width'] - 1), min(max(start[1], 0), r['height'] - 1),
+                     min(max(start[2], 0), r['depth'] - 1)]
+            with metrics.stage('local_max'):
+                cell.center = backend.local_max(cell, start)
+
+            lo = max(int(estimate['radius']) - band, 1)
+            hi = min(int(math.ceil(estimate['radius'])) + band, max_rad)
+            with metrics.stage('rad3d'):
+                profile = backend.radial_profile(cell, hi, lazy=True, min_rad=lo)
+                radius = radius_thresh(profile.iter_means(hi), loc_mean)
+                # first shell of the band already below the local mean, or no crossing in the band
+                if not lo < radius < hi:
+                    metrics.count('band_misses')
+                    profile = backend.radial_profile(cell, max_rad, lazy=True)
+                    radius = radius_thresh(profile.iter_means(max_rad), loc_mean)
+            fine_radius = interpolate_radius(profile, radius, loc_mean)
+
+    center = absolute_position(cell.center, cell.roi3D)
+    record = {
+        'seed_x': cell.seed[0], 'seed_y': cell.seed[1], 'seed_z': cell.seed[2],
+        'center_x': center[0], 'center_y': center[1], 'center_z': center[2],
+        'radius': radius, 'fine_radius': fine_radius, 'coarse_radius': estimate['radius'],
+        'loc_mean': loc_mean,
+        'on_border': cell.onBorder, 'n_neighbors': len(cell.neighbors)
+    }
+    record.update(metrics.as_record())
+    return record
+
+
+def pyramid_image(image, backend, markers, params, cube_dim, scaleZ, order='file', metrics=None):
+    # type: (object, Backend, list, dict, int, float, str, ImageMetrics) -> list
+    """
+Measure every marker of an opened image coarse to fine (no per-cell filter: filter the image with prefilter)
+
+    :param params: Parameters of the pipeline (r0, r1, r2, meanw, max_rad, pyramid_factor, pyramid_band)
+
+    :param metrics: If given, the time of the binning is added to its image stages and the metrics of every cell to
+    its cells
+
+    :return: Cell records in marker order (coarse_radius is the estimate on the binned image)
+    """
+    if metrics is None:
+        metrics = ImageMetrics('image')
+    factor = params['pyramid_factor']
+    z_factor, coarse_scaleZ = pyramid_factors(factor, scaleZ)
+    with metrics.image.stage('pyramid'):
+        coarse = backend.downsample(image, factor, z_factor)
+    estimates = coarse_estimates(backend, coarse, markers, params, factor, z_factor, cube_dim, coarse_scaleZ,
+                                 order)
+    backend.close_image(coarse)
+
+    records = [None] * len(markers)
+    for cell in backend.cells(image, markers, cube_dim, scaleZ, order):
+        estimate = estimates[cell.marker]
+        estimate['metrics'].add_time('crop', cell.t_crop)
+        records[cell.marker] = refine_cell(cell, backend, estimate, params, params['pyramid_band'])
+        metrics.add_cell(estimate['metrics'])
+        backend.close_cell(cell)
+    return records
@@ -1,23 +1,95 @@
 from ij.gui import Plot
 
-from neigh import neighborhood_mean
+import instrument
+from geometry import sphere_offsets, shell_offsets, gather, stack_shape
+from shells import ShellSums
 from stacks import CellStack
 
 
-def radial_distribution_3D(cs, max_rad):
-    # type: (CellStack, int) -> list
+class RadialProfile(ShellSums):
+    def __init__(self, cs, max_rad, center=None, lazy=False, min_rad=0):
+        # type: (CellStack, int, list, bool, int) -> RadialProfile
+        """
+    Shell sums (see shells.ShellSums) of a cell stack, computed visiting each voxel of the cell stack once
+
+        :param cs: CellStack
+
+        :param max_rad: Last shell of the profile (shells from 0 to max_rad)
+
+        :param center: Center of the shells (cs.center if None)
+
+        :param lazy: Visit the voxels only when a shell is read, from the center outwards (the offsets are sorted by
+        distance), so that the outer shells are never visited if nobody reads them (see shells.radius_thresh)
+
+        :param min_rad: First shell of the profile, the inner shells are left empty (NaN means) and their voxels are
+        not visited (band around a known radius, see pyramid.py)
+        """
+        ShellSums.__init__(self, max_rad, cs.center if center is None else center)
+
+        # geometry is shared by all the cells with the same stack shape
+        shape = stack_shape(cs)
+        if min_rad > 0:
+            self._table = shell_offsets(min_rad, max_rad + 1, cs.scaleZ, shape)
+        else:
+            self._table = sphere_offsets(max_rad + 1, cs.scaleZ, shape)
+        self._voxels = gather(cs.voxels(), self._table, self.center, shape, count=False)
+        # next voxel, already read but outside the completed shells
+        self._pending = None
+        # shells below complete are final
+        self.complete = 0
+        if not lazy:
+            self.ensure(max_rad + 1)
+
+    def ensure(self, r):
+        # type: (int) -> None
+        if self._voxels is None or r < self.complete:
+            return
+        shell = self._table.shell
+        d2 = self._table.d2
+        sums, counts, edge_sums, edge_counts = self.sums, self.counts, self.edge_sums, self.edge_counts
+        max_rad = self.max_rad
+        visited = 0
+        item = self._pending
+        self._pending = None
+        while True:
+            if item is None:
+                item = next(self._voxels, None)
+                if item is None:
+                    # every voxel visited
+                    self._voxels = None
+                    self.complete = max_rad + 2
+                    break
+            i, v = item
+            s = shell[i]
+            if s > r:
+                self._pending = item
+                self.complete = s
+                break
+            if s <= max_rad:
+                sums[s] += v
+                counts[s] += 1
+            if s * s == d2[i]:
+                edge_sums[s] += v
+                edge_counts[s] += 1
+            visited += 1
+            item = None
+        instrument.count('voxels', visited)
+
+
+def radial_distribution_3D(cs, max_rad, profile=None):
+    # type: (CellStack, int, RadialProfile) -> list
     """
 Compute the 3D radial distribution in the given radius
 Reference https://github.com/mcib3d/mcib3d-core/blob/master/src/main/java/mcib3d/image3d/ImageHandler.java
 
+    :param profile: RadialProfile already computed around cs.center (a new one is computed if None)
+
     :return: Values of (half) the gaussian in list of length max_rad+1
     """
-    tab = []
-    for r in range(max_rad + 1):
-        mean = neighborhood_mean(cs, r + 1, r)
-        tab.append(mean)
+    if profile is None:
+        profile = RadialProfile(cs, max_rad)
 
-    return tab
+    return profile.means()[:max_rad + 1]
 
 
 def plot_rad3d(tab):
@@ -26,22 +98,3 @@ def plot_rad3d(tab):
     val = tab[::-1] + tab[1:]
 
     return Plot("3D radial distribution", "rad", "mean", idx, val)
-
-
-def radius_thresh(rad3d, thresh):
-    # type: (list, float) -> int
-    """
-Find the radius of the cell from the 3D radial distribution counting the values above the given threshold
-
-    :param rad3d: Radial distribution obtained with radial_distribution_3D
-
-    :param thresh: Threshold value
-
-    :return: Radius
-    """
-    r = 0
-    for r, v in enumerate(rad3d):
-        if v < thresh:
-            break
-
-    return r
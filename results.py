@@ -0,0 +1,183 @@
+from __future__ import with_statement
+import csv
+import os
+import threading
+
+# columns of the results file, one row per marker
+RESULT_FIELDS = ['image', 'marker',
+                 'seed_x', 'seed_y', 'seed_z',
+                 'center_x', 'center_y', 'center_z',
+                 'radius', 'new_radius', 'fine_radius', 'new_fine_radius',
+                 'loc_mean', 'new_loc_mean', 'n_voxels', 'coarse_radius',
+                 'on_border', 'n_neighbors', 'seed_collision', 'crop_dim', 'cache_hits',
+                 't_crop', 't_crop_dims', 't_coarse', 't_filter', 't_local_max', 't_local_mean', 't_rad3d',
+                 't_maxima', 't_mean_shift', 't_new_local_mean', 't_new_rad3d', 't_total',
+                 'voxels', 'ms_iterations', 'ms_seed_iterations', 'band_misses', 'crop_grows']
+
+
+def to_row(record, fields=RESULT_FIELDS):
+    # type: (dict, list) -> list
+    """
+Flatten a cell record (as returned by main.measure_cell) in a row following RESULT_FIELDS (or fields) order
+    """
+    row = []
+    for field in fields:
+        value = record.get(field, '')
+        if isinstance(value, float):
+            value = '{:.6g}'.format(value)
+        row.append(value)
+    return row
+
+
+def write_results(results_path, records, fields=RESULT_FIELDS):
+    # type: (str, list, list) -> None
+    """
+Write the cell records in a csv file with header RESULT_FIELDS (or fields)
+
+    :param results_path: Absolute path to the results file
+
+    :param records: List of dict, one for every processed marker
+    """
+    with open(results_path, 'w') as results_file:
+        writer = csv.writer(results_file)
+        writer.writerow(fields)
+        for record in records:
+            writer.writerow(to_row(record, fields))
+
+
+def read_results(results_path):
+    # type: (str) -> iter
+    """
+Read the records of a results file, also while a ResultSink is appending to it: a last row still being written
+(no line terminator yet) is left out
+
+    :return: Generator of dict (field -> string value)
+    """
+    with open(results_path, 'r') as results_file:
+        header = None
+        for line in results_file:
+            if not line.endswith('\n'):
+                break
+            row = next(csv.reader([line]))
+            if header is None:
+                header = row
+            else:
+                yield dict(zip(header, row))
+
+
+def record_key(record):
+    # type: (dict) -> tuple
+    """
+(image, seed) identifying a cell record, with the seed as a tuple of int
+    """
+    return record['image'], (int(record['seed_x']), int(record['seed_y']), int(record['seed_z']))
+
+
+def _drop_partial_row(results_path, tail=65536):
+    # type: (str, int) -> None
+    """
+Truncate the file after its last line terminator (a row cut by a crash)
+    """
+    size = os.path.getsize(results_path)
+    with open(results_path, 'rb+') as results_file:
+        start = max(size - tail, 0)
+        results_file.seek(start)
+        end = results_file.read().rfind(b'\n')
+        if start + end + 1 < size:
+            results_file.truncate(start + end + 1 if end >= 0 else 0)
+
+
+class ResultSink(object):
+    def __init__(self, results_path, fields=RESULT_FIELDS, batch_size=64):
+        # type: (str, list, int) -> ResultSink
+        """
+    Append-only results file: the records are written in batches of batch_size rows and made durable (fsync) by
+    sync, e.g. at the end of every image. An existing file is reopened (a row cut by a crash is dropped) and the
+    cells it already contains are listed by done_seeds, so a restarted run measures only the missing ones.
+    Thread safe, the file can be read with read_results while it grows
+
+        :param results_path: Absolute path to the results file
+
+        :raise: ValueError if the file exists with different columns
+        """
+        self.results_path = results_path
+        self.fields = fields
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.rows = []
+        self.done = set()
+
+        if os.path.exists(results_path):
+            _drop_partial_row(results_path)
+        new = not os.path.exists(results_path) or os.path.getsize(results_path) == 0
+        if not new:
+            with open(results_path, 'r') as results_file:
+                header = next(csv.reader([results_file.readline()]))
+            if header != list(fields):
+                raise ValueError('Results file {} has different columns: {}'.format(results_path, header))
+            for record in read_results(results_path):
+                self.done.add(record_key(record))
+
+        self.results_file = open(results_path, 'a')
+        self.writer = csv.writer(self.results_file)
+        if new:
+            self.writer.writerow(fields)
+            self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_done(self, image, seed):
+        # type: (str, list) -> bool
+        with self.lock:
+            return (image, tuple(seed)) in self.done
+
+    def done_seeds(self, image):
+        # type: (str) -> set
+        """
+    Seeds (tuples) of the image already in the file or appended
+        """
+        with self.lock:
+            return set(seed for img, seed in self.done if img == image)
+
+    def append(self, record):
+        # type: (dict) -> None
+        """
+    Queue a cell record (with image and seed), written when the batch is full
+        """
+        with self.lock:
+            self.rows.append(to_row(record, self.fields))
+            self.done.add(record_key(record))
+            if len(self.rows) >= self.batch_size:
+                self._write()
+
+    def _write(self):
+        self.writer.writerows(self.rows)
+        self.rows = []
+        self.results_file.flush()
+
+    def flush(self):
+        # type: () -> None
+        """
+    Write the queued rows (visible to the readers, not yet durable)
+        """
+        with self.lock:
+            self._write()
+
+    def sync(self):
+        # type: () -> None
+        """
+    Write the queued rows and wait until they are on disk
+        """
+        with self.lock:
+            self._write()
+            os.fsync(self.results_file.fileno())
+
+    def close(self):
+        # type: () -> None
+        if not self.results_file.closed:
+            self.sync()
+            self.results_file.close()
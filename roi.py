@@ -0,0 +1,73 @@
+def relative_center(xc, yc, zc, roi_3D):
+    # type: (int, int, int, dict) -> list
+    """
+Calculate the center of the cell relatively to its roi
+
+    :param roi_3D: region of interest of the cell obtained with dump_3DRoi()
+
+    :return: 3D coordinates
+    """
+    return [xc - roi_3D['x0'], yc - roi_3D['y0'], zc - roi_3D['z0']]
+
+
+def absolute_position(pos, roi_3D):
+    # type: (list, dict) -> list
+    """
+Inverse of relative_center, bring a point of the cell stack back to the coordinates of the original image
+
+    :param pos: 3D coordinates relative to the roi
+
+    :param roi_3D: region of interest of the cell obtained with dump_3DRoi()
+
+    :return: 3D coordinates
+    """
+    return [pos[0] + roi_3D['x0'], pos[1] + roi_3D['y0'], pos[2] + roi_3D['z0']]
+
+
+def dump_3DRoi(imp, xc, yc, zc, dim, scaleZ=1.):
+    # type: (ImagePlus, int, int, int, int, float) -> dict
+    """
+Create a dict for rapid access to stack dimensions
+
+    :param scaleZ: Depth of a voxel (1 if image is isotropic, less otherwise)
+
+    :return: dict, Key values are: x0, y0, z0, width, height, depth
+    """
+    x0 = max(xc - int(dim / 2), 0)
+    y0 = max(yc - int(dim / 2), 0)
+    z0 = max(zc - int(dim * scaleZ / 2), 0)
+
+    # Returns the dimensions of this image (width, height, nChannels, nSlices, nFrames) as a 5 element int array
+    dimensions = imp.getDimensions()
+    imp_width = dimensions[0]
+    imp_height = dimensions[1]
+    imp_depth = dimensions[3]
+
+    x1 = min(xc + int(dim / 2), imp_width)
+    y1 = min(yc + int(dim / 2), imp_height)
+    z1 = min(zc + int(dim * scaleZ / 2), imp_depth)
+
+    w = x1 - x0
+    h = y1 - y0
+    d = z1 - z0
+    # z0 is the z coordinate, NOT the slice (slices go from 1 to stack size)
+
+    roi = {
+        'x0': x0,
+        'y0': y0,
+        'z0': z0,
+        'width': w,
+        'height': h,
+        'depth': d
+    }
+    return roi
+
+
+def is_on_border(roi3D, dim, scaleZ):
+    # type: (dict, int, float) -> bool
+    """
+True if the roi of a cube of side dim (see dump_3DRoi) was cut by the image border. An uncut roi spans int(dim / 2)
+voxels on both sides of the center (int(dim * scaleZ / 2) along z), whatever the parity of dim
+    """
+    return roi3D['width'] != 2 * int(dim / 2) or roi3D['height'] != 2 * int(dim / 2) or \
+        roi3D['depth'] != 2 * int(dim * scaleZ / 2)
@@ -0,0 +1,400 @@
+from __future__ import with_statement
+import errno
+import json
+import os
+import socket
+import time
+
+from ij import IJ
+
+MANIFEST = 'manifest.json'
+
+
+def image_id(img_path, source_dir):
+    # type: (str, str) -> str
+    """
+Unique name of an image inside the dataset, usable as file name (relative path with separators replaced)
+    """
+    rel = os.path.relpath(img_path, source_dir)
+    return os.path.splitext(rel)[0].replace(os.sep, '__')
+
+
+def list_images(source_dir):
+    # type: (str) -> list
+    """
+List every image with a marker file in source_dir (same rule of main.full_process)
+
+    :return: Sorted list of (img_path, marker_path) pairs
+    """
+    pairs = []
+    for root, directories, filenames in os.walk(source_dir):
+        for filename in filenames:
+            if filename.endswith('.marker'):
+                tif_file = filename.replace('.marker', '')
+                pairs.append((os.path.join(root, tif_file), os.path.join(root, filename)))
+    return sorted(pairs)
+
+
+def build_manifest(source_dir, work_dir, n_shards=1):
+    # type: (str, str, int) -> dict
+    """
+Create the work manifest of the dataset in work_dir (or load it if it already exists, so that every process
+and every restart see the same listing and the same shards)
+
+    :param source_dir: Dataset directory
+
+    :param work_dir: Directory shared by all the processes working on the dataset
+
+    :param n_shards: Number of shards in which the images are split (ignored if the manifest exists)
+
+    :return: Manifest dict with keys source_dir, n_shards and images (list of dict with id, image, marker, shard)
+    """
+    manifest_path = os.path.join(work_dir, MANIFEST)
+    if os.path.exists(manifest_path):
+        return load_manifest(work_dir)
+
+    for sub in ['leases', 'done', os.path.join('done', 'shards'), 'results']:
+        path = os.path.join(work_dir, sub)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    pairs = list_images(source_dir)
+    n_shards = max(1, min(n_shards, len(pairs)))
+    images = []
+    for i, (img_path, marker_path) in enumerate(pairs):
+        images.append({
+            'id': image_id(img_path, source_dir),
+            'image': img_path,
+            'marker': marker_path,
+            # contiguous shards, i.e. images of the same directory stay together
+            'shard': i * n_shards // len(pairs)
+        })
+    manifest = {'source_dir': source_dir, 'n_shards': n_shards, 'images': images}
+
+    # write and rename, a concurrent process either finds the whole manifest or none
+    tmp_path = '{}.{}.tmp'.format(manifest_path, owner_name())
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.exists(manifest_path):
+        os.remove(tmp_path)
+        return load_manifest(work_dir)
+    os.rename(tmp_path, manifest_path)
+
+    IJ.log('Manifest with {} images in {} shards written in {}'.format(len(images), n_shards, manifest_path))
+    return manifest
+
+
+def load_manifest(work_dir):
+    # type: (str) -> dict
+    with open(os.path.join(work_dir, MANIFEST), 'r') as f:
+        return json.load(f)
+
+
+def owner_name():
+    # type: () -> str
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def _lease_path(work_dir, shard):
+    return os.path.join(work_dir, 'leases', 'shard_{}.lease'.format(shard))
+
+
+def _done_path(work_dir, name):
+    return os.path.join(work_dir, 'done', name + '.done')
+
+
+def _shard_done_path(work_dir, shard):
+    # shards in their own directory: no image id can collide with them
+    return os.path.join(work_dir, 'done', 'shards', 'shard_{}.done'.format(shard))
+
+
+def _create_exclusive(path, owner):
+    # type: (str, str) -> bool
+    """
+Create the file at path only if it does not exist (O_EXCL), writing owner, time, host and pid of this process
+
+    :return: True if the file was created
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, '{} {} {} {}\n'.format(owner, time.time(), socket.gethostname(), os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def _pid_alive(pid):
+    # type: (int) -> bool
+    if not hasattr(os, 'kill'):
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _holder_dead(path):
+    # type: (str) -> bool
+    """
+    :return: True if the lease or lock file at path was written by a process of this host that is not running
+    anymore (a crashed run). The processes of other hosts cannot be checked, their files only expire
+    """
+    try:
+        with open(path, 'r') as f:
+            fields = f.read().split()
+    except (IOError, OSError):
+        return False
+    if len(fields) < 4 or fields[2] != socket.gethostname():
+        return False
+    pid = int(fields[3])
+    return pid != os.getpid() and not _pid_alive(pid)
+
+
+def _remove_stale(path):
+    # type: (str) -> bool
+    """
+Remove the file at path left by a crashed process of this host. The file is renamed first and checked again, so a
+file created by a live process in the meantime is put back instead of being removed
+
+    :return: True if the file was removed
+    """
+    stale = '{}.{}.stale'.format(path, owner_name())
+    try:
+        os.rename(path, stale)
+    except OSError:
+        return False
+    if _holder_dead(stale):
+        os.remove(stale)
+        return True
+    os.rename(stale, path)
+    return False
+
+
+def _lock_lease(path, owner, attempts=1, wait=0.1):
+    # type: (str, str, int, float) -> bool
+    """
+Take the lock guarding the lease file at path (O_EXCL lock file next to it). It is held only for the few file
+operations of a takeover, renewal or release, so that the lease cannot change between the check of its owner or
+age and its removal. A lock left by a crashed process of this host is broken
+
+    :param attempts: Number of tries, wait seconds apart
+
+    :return: True if the lock is now held by owner
+    """
+    lock = path + '.lock'
+    for i in range(attempts):
+        if _create_exclusive(lock, owner):
+            return True
+        if _holder_dead(lock) and _remove_stale(lock):
+            IJ.log('Lock {} left by a crashed process removed'.format(lock))
+            if _create_exclusive(lock, owner):
+                return True
+        if i < attempts - 1:
+            time.sleep(wait)
+    return False
+
+
+def _unlock_lease(path):
+    # type: (str) -> None
+    os.remove(path + '.lock')
+
+
+def _lease_owner(path):
+    # type: (str) -> str
+    """
+    :return: Owner written in the lease file at path, None if there is no lease
+    """
+    try:
+        with open(path, 'r') as f:
+            return f.read().split(' ')[0]
+    except (IOError, OSError):
+        return None
+
+
+def _stale_lease(path, lease_timeout):
+    # type: (str, float) -> bool
+    """
+    :return: True if the lease at path was not renewed for lease_timeout seconds or its holder crashed on this host
+    """
+    try:
+        expired = time.time() - os.path.getmtime(path) > lease_timeout
+    except OSError:
+        return False
+    return expired or _holder_dead(path)
+
+
+def claim_shard(work_dir, shard, owner, lease_timeout):
+    # type: (str, int, str, float) -> bool
+    """
+Try to take the lease of a shard. The lease file is created atomically (O_EXCL) so only one process can hold it.
+A lease not renewed for lease_timeout seconds belongs to a crashed process and is taken over, and so is at once
+the lease of a process of this host that is not running anymore (a run restarted after a crash resumes its own
+shard without waiting for the lease to expire). The takeover is done under the lease lock (see _lock_lease) and
+checks the lease again once the lock is held, so a lease renewed or taken over by another process in the meantime
+is left alone
+
+    :return: True if the lease is now held by owner
+    """
+    path = _lease_path(work_dir, shard)
+    if _stale_lease(path, lease_timeout):
+        if not _lock_lease(path, owner):
+            return False
+        try:
+            if _stale_lease(path, lease_timeout):
+                os.remove(path)
+                IJ.log('Lease of shard {} expired or left by a crashed process, taking over'.format(shard))
+        finally:
+            _unlock_lease(path)
+
+    return _create_exclusive(path, owner)
+
+
+def renew_lease(work_dir, shard, owner):
+    # type: (str, int, str) -> bool
+    """
+Touch the lease of a shard if it is still held by owner
+
+    :return: False if the lease expired and was taken over by another process
+    """
+    path = _lease_path(work_dir, shard)
+    if not _lock_lease(path, owner, attempts=50):
+        # takeover in progress
+        return _lease_owner(path) == owner
+    try:
+        if _lease_owner(path) != owner:
+            return False
+        os.utime(path, None)
+        return True
+    finally:
+        _unlock_lease(path)
+
+
+def release_shard(work_dir, shard, owner):
+    # type: (str, int, str) -> None
+    """
+Remove the lease of a shard if it is still held by owner (a slow owner whose lease expired must not remove the
+lease of the process that took it over)
+    """
+    path = _lease_path(work_dir, shard)
+    if not _lock_lease(path, owner, attempts=50):
+        IJ.log('Lease of shard {} locked by another process, not released'.format(shard))
+        return
+    try:
+        if _lease_owner(path) == owner:
+            os.remove(path)
+    finally:
+        _unlock_lease(path)
+
+
+def _write_checkpoint(path):
+    # type: (str) -> None
+    with open(path, 'w') as f:
+        f.write('{} {}\n'.format(owner_name(), time.time()))
+
+
+def mark_done(work_dir, name):
+    # type: (str, str) -> None
+    """
+Checkpoint a finished image (name is its id in the manifest)
+    """
+    _write_checkpoint(_done_path(work_dir, name))
+
+
+def is_done(work_dir, name):
+    # type: (str, str) -> bool
+    return os.path.exists(_done_path(work_dir, name))
+
+
+def mark_shard_done(work_dir, shard):
+    # type: (str, int) -> None
+    """
+Checkpoint a finished shard (in done/shards, work directories created before it existed get it here)
+    """
+    path = _shard_done_path(work_dir, shard)
+    if not os.path.isdir(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            # created by another process
+            pass
+    _write_checkpoint(path)
+
+
+def is_shard_done(work_dir, shard):
+    # type: (str, int) -> bool
+    return os.path.exists(_shard_done_path(work_dir, shard))
+
+
+def all_done(work_dir, manifest):
+    # type: (str, dict) -> bool
+    return all(is_shard_done(work_dir, k) for k in range(manifest['n_shards']))
+
+
+def run_worker(work_dir, process_func, lease_timeout=3600.):
+    # type: (str, callable, float) -> int
+    """
+Claim shards of the manifest until none is left and process their images, skipping those already checkpointed.
+Any number of processes (on the same or on different machines sharing work_dir) can run this concurrently, and
+a process restarted after a crash resumes from the last checkpointed image (on the same host at once, see
+claim_shard).
+
+    :param work_dir: Directory containing the manifest (see build_manifest)
+
+    :param process_func: Function (img entry of the manifest, results path) -> None, measuring an image and
+    writing its results
+
+    :param lease_timeout: Seconds after which the lease of a silent process expires (must be longer than the
+    time needed by the slowest image)
+
+    :return: Number of images processed by this worker
+    """
+    manifest = load_manifest(work_dir)
+    owner = owner_name()
+    n_processed = 0
+
+    for shard in range(manifest['n_shards']):
+        if is_shard_done(work_dir, shard) or not claim_shard(work_dir, shard, owner, lease_timeout):
+            continue
+
+        IJ.log('{} working on shard {}'.format(owner, shard))
+        try:
+            for entry in manifest['images']:
+                if entry['shard'] != shard or is_done(work_dir, entry['id']):
+                    continue
+
+                results_path = os.path.join(work_dir, 'results', entry['id'] + '.csv')
+                process_func(entry, results_path)
+                mark_done(work_dir, entry['id'])
+                n_processed += 1
+                if not renew_lease(work_dir, shard, owner):
+                    IJ.log('{} lost the lease of shard {}, leaving it to the new owner'.format(owner, shard))
+                    break
+            else:
+                mark_shard_done(work_dir, shard)
+        finally:
+            release_shard(work_dir, shard, owner)
+
+    return n_processed
+
+
+def merge_results(work_dir, results_path):
+    # type: (str, str) -> None
+    """
+Concatenate the results of every image of the manifest (in manifest order) in a single csv file
+    """
+    manifest = load_manifest(work_dir)
+    with open(results_path, 'w') as out:
+        header_written = False
+        for entry in manifest['images']:
+            path = os.path.join(work_dir, 'results', entry['id'] + '.csv')
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                header = f.readline()
+                if not header_written:
+                    out.write(header)
+                    header_written = True
+                for line in f:
+                    out.write(line)
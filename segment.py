@@ -0,0 +1,120 @@
+"""
+Whole-image segmentation, alternative to the pipeline around every seed (see pipeline.py) for dense regions
+
+The threshold of every seed is its local mean (as in the first radius stage of the pipeline, one radial profile up to
+r2 around the local maximum), then a single seeded watershed of the whole image splits the voxels above the lowest
+threshold among the seeds. The region of a seed keeps only the voxels above its own threshold and gives the
+equivalent radius (sphere of the same volume) and the centroid. Touching cells are separated by the watershed line
+instead of the mean shift, and no voxel is visited by more than one cell after the thresholds
+"""
+
+from __future__ import with_statement
+import math
+
+from instrument import ImageMetrics
+from roi import absolute_position
+from shells import profile_local_mean
+
+
+def equivalent_radius(n_voxels, scaleZ):
+    # type: (int, float) -> float
+    """
+Radius (xy voxels) of the sphere with the volume of n_voxels voxels, each one 1/scaleZ xy voxels deep
+    """
+    return (3. * n_voxels / (4. * math.pi * scaleZ)) ** (1. / 3.)
+
+
+def seed_thresholds(backend, image, markers, params, cube_dim, scaleZ, order='file'):
+    # type: (Backend, object, list, dict, int, float, str) -> list
+    """
+Local mean of every marker, computed in its cube (no per-cell filter: filter the image with prefilter)
+
+    :param params: Parameters of the pipeline (recenter, r0, r1, r2, meanw)
+
+    :return: One dict per marker (seed in image coordinates, local mean, border flag, number of neighbors),
+    in marker order
+    """
+    r0, r1, r2, meanw = params['r0'], params['r1'], params['r2'], params['meanw']
+    cells = [None] * len(markers)
+    for cell in backend.cells(image, markers, cube_dim, scaleZ, order):
+        backend.prepare(cell)
+        if params['recenter']:
+            cell.center = backend.local_max(cell, cell.center)
+        profile = backend.radial_profile(cell, max(r0, r2))
+        cells[cell.marker] = {
+            'seed': absolute_position(cell.center, cell.roi3D),
+            'loc_mean': profile_local_mean(profile, r0, r1, r2, meanw),
+            'on_border': cell.onBorder,
+            'n_neighbors': len(cell.neighbors)
+        }
+        backend.close_cell(cell)
+    return cells
+
+
+def watershed_seeds(cells, markers):
+    # type: (list, list) -> tuple
+    """
+Seeds of the watershed. The recentering can move several markers onto the same local maximum: those go back to their
+own marker, and the markers still on the same voxel share one seed (threshold of the first one) and its region
+
+    :param cells: Records of seed_thresholds, in marker order
+
+    :return: (seeds, thresholds, index of the seed of every marker, collision flag of every marker)
+    """
+    counts = {}
+    for cell in cells:
+        pos = tuple(cell['seed'])
+        counts[pos] = counts.get(pos, 0) + 1
+    seeds, thresholds, slots = [], [], []
+    collisions = [False] * len(cells)
+    owners = {}  # type: dict
+    for i, cell in enumerate(cells):
+        pos = tuple(cell['seed'])
+        if counts[pos] > 1:
+            pos = tuple(markers[i])
+            collisions[i] = True
+        if pos in owners:
+            collisions[i] = collisions[owners[pos]] = True
+            slots.append(slots[owners[pos]])
+            continue
+        owners[pos] = i
+        slots.append(len(seeds))
+        seeds.append(list(pos))
+        thresholds.append(cell['loc_mean'])
+    return seeds, thresholds, slots, collisions
+
+
+def segment_image(image, backend, markers, params, cube_dim, scaleZ, order='file', metrics=None):
+    # type: (object, Backend, list, dict, int, float, str, ImageMetrics) -> list
+    """
+Measure every marker of an opened image with one seeded watershed
+
+    :param image: Image opened by the backend (see Backend.open_image)
+
+    :param metrics: If given, the time of the thresholds and of the watershed are added to its image stages
+
+    :return: Cell records in marker order, with the equivalent radius as radius and fine_radius, the centroid of the
+    region as center (the seed if the region is empty), the threshold as loc_mean and seed_collision set if the seed
+    of the marker was not its local maximum or its region is shared (see watershed_seeds)
+    """
+    if metrics is None:
+        metrics = ImageMetrics('image')
+    with metrics.image.stage('thresholds'):
+        cells = seed_thresholds(backend, image, markers, params, cube_dim, scaleZ, order)
+    seeds, thresholds, slots, collisions = watershed_seeds(cells, markers)
+    with metrics.image.stage('watershed'):
+        regions = backend.watershed(image, seeds, thresholds)
+
+    records = []
+    for i, cell in enumerate(cells):
+        n_voxels, centroid = regions[slots[i]]
+        center = centroid if n_voxels else seeds[slots[i]]
+        radius = equivalent_radius(n_voxels, scaleZ)
+        records.append({
+            'seed_x': markers[i][0], 'seed_y': markers[i][1], 'seed_z': markers[i][2],
+            'center_x': center[0], 'center_y': center[1], 'center_z': center[2],
+            'radius': radius, 'fine_radius': radius, 'n_voxels': n_voxels,
+            'loc_mean': cell['loc_mean'],
+            'on_border': cell['on_border'], 'n_neighbors': cell['n_neighbors'], 'seed_collision': collisions[i]
+        })
+    return records
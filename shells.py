@@ -0,0 +1,156 @@
+import math
+
+
+def _mean(s, n):
+    # type: (float, int) -> float
+    return s / n if n > 0 else float('nan')
+
+
+class ShellSums(object):
+    def __init__(self, max_rad, center):
+        # type: (int, list) -> ShellSums
+        """
+    Sums and counts of the voxel values in every spherical shell around a center, filled by a backend (see
+    rad3d.RadialProfile and npbackend). The shell r contains the voxels at (anisotropic) distance r <= d < r+1, the
+    same layers used by ImageHandler.getNeighborhoodLayer(x, y, z, r, r+1)
+
+        :param max_rad: Last shell of the profile (shells from 0 to max_rad)
+
+        :param center: Center of the shells
+        """
+        self.center = list(center)
+        self.max_rad = max_rad
+
+        self.sums = [0.] * (max_rad + 1)
+        self.counts = [0] * (max_rad + 1)
+        # voxels exactly at distance r, needed to include the boundary in sphere_mean
+        self.edge_sums = [0.] * (max_rad + 2)
+        self.edge_counts = [0] * (max_rad + 2)
+
+    def ensure(self, r):
+        # type: (int) -> None
+        """
+    Complete the shells up to r (included) before they are read. No-op here, lazy profiles visit the voxels on
+    demand (see rad3d.RadialProfile)
+        """
+        pass
+
+    def shell_mean(self, r):
+        # type: (int) -> float
+        """
+    Mean of the shell r <= d < r+1 (NaN if the shell is empty, i.e. outside the cell stack)
+        """
+        self.ensure(r)
+        return _mean(self.sums[r], self.counts[r])
+
+    def means(self):
+        # type: () -> list
+        """
+    :return: Mean of every shell in list of length max_rad+1
+        """
+        self.ensure(self.max_rad)
+        return [self.shell_mean(r) for r in range(self.max_rad + 1)]
+
+    def iter_means(self, last=None):
+        """
+    Generate the mean of the shells from 0 to last (max_rad if None) one at a time: a lazy profile computes a shell
+    only when it is requested (see radius_thresh)
+        """
+        if last is None:
+            last = self.max_rad
+        for r in range(min(last, self.max_rad) + 1):
+            yield self.shell_mean(r)
+
+    def layer_mean(self, r0, r1):
+        # type: (int, int) -> float
+        """
+    Mean of the voxels at distance r0 <= d < r1 (as ImageHandler.getNeighborhoodLayer)
+        """
+        r0 = max(int(r0), 0)
+        r1 = int(r1)
+        if r1 > self.max_rad + 1:
+            raise ValueError('Layer radius {} out of the profile (max {})'.format(r1, self.max_rad + 1))
+        self.ensure(r1 - 1)
+        return _mean(sum(self.sums[r0:r1]), sum(self.counts[r0:r1]))
+
+    def sphere_mean(self, r):
+        # type: (int) -> float
+        """
+    Mean of the voxels at distance d <= r (as ImageHandler.getNeighborhoodSphere)
+        """
+        r = abs(int(r))
+        if r > self.max_rad + 1:
+            raise ValueError('Sphere radius {} out of the profile (max {})'.format(r, self.max_rad + 1))
+        self.ensure(r)
+        return _mean(sum(self.sums[:r]) + self.edge_sums[r], sum(self.counts[:r]) + self.edge_counts[r])
+
+
+def profile_local_mean(profile, r0, r1, r2, weight=0.5):
+    # type: (ShellSums, int, int, int, float) -> float
+    """
+Same as utils.local_mean, only arithmetic on the shell sums of the profile (no voxel access, no logging)
+    """
+    return profile.sphere_mean(r0) * weight + (1 - weight) * profile.layer_mean(r1, r2)
+
+
+def radius_thresh(rad3d, thresh, confirm=0):
+    # type: (list, float, int) -> int
+    """
+Find the radius of the cell from the 3D radial distribution counting the values above the given threshold.
+The distribution is consumed one shell at a time and no shell after the crossing (plus the confirmation window) is
+requested, so a lazy profile stops computing there
+
+    :param rad3d: Radial distribution obtained with radial_distribution_3D, any iterable of shell means (e.g.
+    ShellSums.iter_means) or directly the profile
+
+    :param thresh: Threshold value
+
+    :param confirm: Number of shells after the first one below thresh that must stay below it too (0 accepts the
+    first crossing). A shell above thresh inside the window cancels the crossing, empty shells (NaN) are ignored
+
+    :return: Radius (the last shell if the distribution never goes below thresh)
+    """
+    if isinstance(rad3d, ShellSums):
+        rad3d = rad3d.iter_means()
+
+    r = 0
+    crossing = None
+    below = 0
+    for r, v in enumerate(rad3d):
+        if v < thresh:
+            if crossing is None:
+                crossing, below = r, 0
+            else:
+                below += 1
+            if below >= confirm:
+                return crossing
+        elif v >= thresh:
+            crossing = None
+
+    # window cut by the end of the distribution
+    return crossing if crossing is not None else r
+
+
+def interpolate_radius(rad3d, radius, thresh):
+    # type: (list, int, float) -> float
+    """
+Sub-voxel radius: linear interpolation of the shell means between the last shell above thresh (radius - 1) and the
+first one below it (radius)
+
+    :param rad3d: Radial distribution (list of shell means) or the profile
+
+    :param radius: Integer radius found by radius_thresh
+
+    :return: Radius in [radius - 1, radius), radius itself if there is nothing to interpolate
+    """
+    if radius <= 0:
+        return float(radius)
+    if isinstance(rad3d, ShellSums):
+        inner, outer = rad3d.shell_mean(radius - 1), rad3d.shell_mean(radius)
+    else:
+        if radius >= len(rad3d):
+            return float(radius)
+        inner, outer = rad3d[radius - 1], rad3d[radius]
+    if math.isnan(inner) or math.isnan(outer) or not outer < thresh <= inner:
+        return float(radius)
+    return radius - 1 + (inner - thresh) / (inner - outer)
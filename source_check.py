@@ -0,0 +1,102 @@
+"""
+Check of the lazy image sources on signed 16-bit TIFFs (sources.open_source)
+
+Run it in Fiji (Jython): a small signed 16-bit TIFF with negative values is written to a temporary file and read back
+in every source mode. ImageJ shifts signed 16-bit values by 32768 when it opens them, every source must return the
+same shifted values (-32768 reads 0, 0 reads 32768, 32767 reads 65535). The exit status is 1 if any voxel differs
+"""
+
+from __future__ import print_function, with_statement
+import os
+import struct
+import sys
+import tempfile
+
+from sources import MappedTiffSource, open_source
+
+width, height, depth = 7, 5, 3
+modes = ['full', 'virtual', 'mmap']
+
+
+def signed_values(w, h, d):
+    # type: (int, int, int) -> list
+    """
+    :return: One list of signed 16-bit values per slice, covering both ends of the range and the sign change
+    """
+    n = w * h * d
+    values = [-32768 + (65535 * i) // (n - 1) for i in range(n)]
+    values[1], values[2], values[3] = -1, 0, 1
+    return [values[z * w * h:(z + 1) * w * h] for z in range(d)]
+
+
+def write_signed_tiff(path, slices, w, h):
+    # type: (str, list, int, int) -> None
+    """
+Write the slices as an uncompressed little-endian TIFF, one page per slice, with SampleFormat signed integer
+    """
+    slice_bytes = w * h * 2
+    n_tags = 10
+    ifd_bytes = 2 + 12 * n_tags + 4
+    with open(path, 'wb') as f:
+        # header, then the data of every slice followed by its IFD
+        f.write(struct.pack('<2sHI', b'II', 42, 8 + slice_bytes))
+        for z, values in enumerate(slices):
+            data_offset = 8 + z * (slice_bytes + ifd_bytes)
+            ifd_offset = data_offset + slice_bytes
+            next_ifd = ifd_offset + ifd_bytes + slice_bytes if z < len(slices) - 1 else 0
+            f.write(struct.pack('<{}h'.format(w * h), *values))
+            f.write(struct.pack('<H', n_tags))
+            # tag, type (3 SHORT, 4 LONG), count, value
+            for tag, kind, value in [(256, 4, w), (257, 4, h), (258, 3, 16), (259, 3, 1), (262, 3, 1),
+                                     (273, 4, data_offset), (277, 3, 1), (278, 4, h), (279, 4, slice_bytes),
+                                     (339, 3, 2)]:
+                if kind == 3:
+                    f.write(struct.pack('<HHIHH', tag, kind, 1, value, 0))
+                else:
+                    f.write(struct.pack('<HHII', tag, kind, 1, value))
+            f.write(struct.pack('<I', next_ifd))
+
+
+def check_mode(path, mode, slices):
+    # type: (str, str, list) -> list
+    """
+    :return: Messages about the voxels of the source that are not the signed values shifted by 32768
+    """
+    # no silent fall back to the virtual stack for mmap
+    source = MappedTiffSource(path) if mode == 'mmap' else open_source(path, mode)
+    messages = []
+    try:
+        if source.getDimensions() != [width, height, 1, depth, 1]:
+            return ['dimensions {}'.format(source.getDimensions())]
+        for z, values in enumerate(slices):
+            ip = source.read_slice_window(z, 0, 0, width, height)
+            for i, v in enumerate(values):
+                read = ip.get(i % width, i // width)
+                if read != v + 32768:
+                    messages.append('slice {} voxel {}: {} instead of {}'.format(z, i, read, v + 32768))
+    finally:
+        source.close()
+    return messages
+
+
+def main():
+    slices = signed_values(width, height, depth)
+    fd, path = tempfile.mkstemp(suffix='.tif')
+    os.close(fd)
+    all_ok = True
+    try:
+        write_signed_tiff(path, slices, width, height)
+        for mode in modes:
+            messages = check_mode(path, mode, slices)
+            all_ok = all_ok and not messages
+            print('{}: {}'.format(mode, 'OK' if not messages else 'FAILED'))
+            for m in messages[:10]:
+                print('  ' + m)
+    finally:
+        os.remove(path)
+    print('Signed 16-bit: ' + ('OK' if all_ok else 'FAILED'))
+    return all_ok
+
+
+if __name__ in ['__builtin__', '__main__']:
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,248 @@
+import os
+
+from ij import IJ, ImagePlus, ImageStack
+from ij.io import FileInfo, TiffDecoder
+from ij.plugin import Binner, FileInfoVirtualStack
+from ij.process import ByteProcessor, ShortProcessor, FloatProcessor
+from java.io import RandomAccessFile
+from java.lang import System
+from java.nio import ByteOrder
+from java.nio.channels import FileChannel
+from jarray import zeros
+
+from geometry import LRUCache
+from voxels import VoxelBuffer
+
+
+class ImageSource(object):
+    """
+Read-only access to a 3D image that hands out sub-volumes (what a CellStack needs) without requiring the whole
+volume in memory. Subclasses implement read_slice_window
+    """
+    def __init__(self, title, width, height, depth):
+        # type: (str, int, int, int) -> ImageSource
+        self.title = title
+        self.width = width
+        self.height = height
+        self.depth = depth
+
+    def getDimensions(self):
+        # type: () -> list
+        """
+    Same layout of ImagePlus.getDimensions() (width, height, nChannels, nSlices, nFrames)
+        """
+        return [self.width, self.height, 1, self.depth, 1]
+
+    def read_slice_window(self, z, x0, y0, w, h):
+        # type: (int, int, int, int, int) -> ImageProcessor
+        raise NotImplementedError
+
+    def buffer(self):
+        # type: () -> VoxelBuffer
+        """
+    VoxelBuffer over the whole volume if it is in memory (the cells can be views on it), None otherwise
+        """
+        return None
+
+    def crop(self, x0, y0, z0, w, h, d):
+        # type: (int, int, int, int, int, int) -> ImageStack
+        """
+    Same as ImageStack.crop, reading only the slices z0 <= z < z0+d and the given XY window
+        """
+        stack = ImageStack(w, h)
+        for z in range(z0, z0 + d):
+            stack.addSlice(self.read_slice_window(z, x0, y0, w, h))
+        return stack
+
+    def close(self):
+        pass
+
+
+class ImagePlusSource(ImageSource):
+    def __init__(self, imp):
+        # type: (ImagePlus) -> ImagePlusSource
+        """
+    Source over an image already loaded in memory (e.g. with IJ.openImage)
+        """
+        ImageSource.__init__(self, imp.title, imp.getWidth(), imp.getHeight(), imp.getNSlices())
+        self.imp = imp
+        self._buffer = None
+
+    def crop(self, x0, y0, z0, w, h, d):
+        return self.imp.getImageStack().crop(x0, y0, z0, w, h, d)
+
+    def buffer(self):
+        if self._buffer is None and self.imp.getBitDepth() != 24:
+            self._buffer = VoxelBuffer.from_stack(self.imp.getImageStack())
+        return self._buffer
+
+    def read_slice_window(self, z, x0, y0, w, h):
+        return _crop(self.imp.getImageStack().getProcessor(z + 1), x0, y0, w, h)
+
+    def close(self):
+        self.imp.close()
+
+
+class VirtualStackSource(ImageSource):
+    def __init__(self, img_path, cache_slices=64):
+        # type: (str, int) -> VirtualStackSource
+        """
+    Source over an ImageJ virtual stack: a slice is read from disk only when a cell needs it and the last
+    cache_slices slices are kept in memory, shared by the neighboring cells
+        """
+        imp = FileInfoVirtualStack.openVirtual(img_path)
+        ImageSource.__init__(self, imp.title, imp.getWidth(), imp.getHeight(), imp.getNSlices())
+        self.imp = imp
+        self.cache = LRUCache(max_size=cache_slices)
+
+    def read_slice_window(self, z, x0, y0, w, h):
+        stack = self.imp.getImageStack()
+        ip = self.cache.get(z, lambda: stack.getProcessor(z + 1))
+        return _crop(ip, x0, y0, w, h)
+
+    def close(self):
+        self.cache.clear()
+        self.imp.close()
+
+
+def _crop(ip, x0, y0, w, h):
+    # type: (ImageProcessor, int, int, int, int) -> ImageProcessor
+    """
+Copy of the XY window of a processor. Unlike setRoi + crop it does not change the processor, so the cached
+slices can be cropped by several threads at the same time
+    """
+    pixels = ip.getPixels()
+    width = ip.getWidth()
+    window = ip.createProcessor(w, h)
+    window_pixels = window.getPixels()
+    for y in range(h):
+        System.arraycopy(pixels, (y0 + y) * width + x0, window_pixels, y * w, w)
+    return window
+
+
+class MappedTiffSource(ImageSource):
+    def __init__(self, img_path, cache_slices=64):
+        # type: (str, int) -> MappedTiffSource
+        """
+    Source over an uncompressed TIFF read through memory mapping: only the rows of the requested XY window are
+    copied out of the file (the OS page cache is shared by the neighboring cells)
+
+        :raise: ValueError if the TIFF is compressed or has an unsupported pixel type
+        """
+        directory, name = os.path.split(img_path)
+        info = TiffDecoder(directory, name).getTiffInfo()
+        fi = info[0]
+        if fi.compression != FileInfo.COMPRESSION_NONE:
+            raise ValueError('Compressed TIFF cannot be memory mapped: ' + img_path)
+        if fi.fileType == FileInfo.GRAY8:
+            self.bytes_per_pixel = 1
+        elif fi.fileType in (FileInfo.GRAY16_UNSIGNED, FileInfo.GRAY16_SIGNED):
+            self.bytes_per_pixel = 2
+        elif fi.fileType == FileInfo.GRAY32_FLOAT:
+            self.bytes_per_pixel = 4
+        else:
+            raise ValueError('Unsupported pixel type for memory mapping: ' + img_path)
+
+        slice_bytes = fi.width * fi.height * self.bytes_per_pixel
+        if len(info) == 1:
+            # ImageJ stacks: one IFD, slices one after the other
+            self.offsets = [fi.getOffset() + z * (slice_bytes + fi.getGap()) for z in range(fi.nImages)]
+        else:
+            self.offsets = [f.getOffset() for f in info]
+
+        ImageSource.__init__(self, name, fi.width, fi.height, len(self.offsets))
+        self.file_type = fi.fileType
+        self.order = ByteOrder.LITTLE_ENDIAN if fi.intelByteOrder else ByteOrder.BIG_ENDIAN
+        self.slice_bytes = slice_bytes
+        self.raf = RandomAccessFile(img_path, 'r')
+        self.channel = self.raf.getChannel()
+        # one mapping per slice: a single one is limited to 2GB
+        self.maps = LRUCache(max_size=cache_slices)
+
+    def _map(self, z):
+        return self.maps.get(z, lambda: self.channel.map(FileChannel.MapMode.READ_ONLY,
+                                                          self.offsets[z], self.slice_bytes))
+
+    def read_slice_window(self, z, x0, y0, w, h):
+        # duplicate: independent position for every thread, same content
+        buf = self._map(z).duplicate().order(self.order)
+        bpp = self.bytes_per_pixel
+        if bpp == 1:
+            pixels = zeros(w * h, 'b')
+        elif bpp == 2:
+            pixels = zeros(w * h, 'h')
+        else:
+            pixels = zeros(w * h, 'f')
+
+        for y in range(h):
+            buf.position(((y0 + y) * self.width + x0) * bpp)
+            if bpp == 1:
+                buf.get(pixels, y * w, w)
+            elif bpp == 2:
+                buf.asShortBuffer().get(pixels, y * w, w)
+            else:
+                buf.asFloatBuffer().get(pixels, y * w, w)
+
+        if bpp == 1:
+            return ByteProcessor(w, h, pixels, None)
+        elif bpp == 2:
+            if self.file_type == FileInfo.GRAY16_SIGNED:
+                # shift by 32768 flipping the sign bit of the raw values, as ImageJ ImageReader does for signed
+                # 16-bit images (ShortProcessor.add would clamp the negative ones, read as unsigned, at 65535).
+                # v ^ -0x8000 is v ^ 0x8000 as a signed short
+                for i in range(w * h):
+                    pixels[i] ^= -0x8000
+            return ShortProcessor(w, h, pixels, None)
+        else:
+            return FloatProcessor(w, h, pixels, None)
+
+    def close(self):
+        self.maps.clear()
+        self.channel.close()
+        self.raf.close()
+
+
+def open_source(img_path, mode='full', cache_slices=64):
+    # type: (str, str, int) -> ImageSource
+    """
+Open an image as ImageSource
+
+    :param mode: 'full' loads the whole volume (IJ.openImage), 'virtual' reads slices on demand through a virtual
+    stack, 'mmap' memory maps an uncompressed TIFF (falls back to 'virtual' if not possible)
+
+    :param cache_slices: Number of slices (or slice mappings) kept in memory by the lazy sources
+    """
+    if mode == 'full':
+        return ImagePlusSource(IJ.openImage(img_path))
+    elif mode == 'mmap':
+        try:
+            return MappedTiffSource(img_path, cache_slices)
+        except ValueError as e:
+            IJ.log(str(e) + ', using virtual stack')
+            return VirtualStackSource(img_path, cache_slices)
+    elif mode == 'virtual':
+        return VirtualStackSource(img_path, cache_slices)
+    else:
+        raise ValueError('Invalid image source mode: ' + mode)
+
+
+def as_source(imp):
+    # type: (ImagePlus) -> ImageSource
+    """
+Wrap an ImagePlus in an ImageSource (sources are returned as they are)
+    """
+    if isinstance(imp, ImageSource):
+        return imp
+    return ImagePlusSource(imp)
+
+
+def binned_source(source, factor, z_factor):
+    # type: (ImageSource, int, int) -> ImageSource
+    """
+Smaller copy of the image in memory, averaging bins of factor x factor x z_factor voxels (ImageJ Binner)
+    """
+    imp = ImagePlus(source.title, source.crop(0, 0, 0, source.width, source.height, source.depth))
+    binned = Binner().shrink(imp, factor, factor, z_factor, Binner.AVERAGE)
+    imp.close()
+    binned.setTitle(source.title)
+    return ImagePlusSource(binned)
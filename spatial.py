@@ -0,0 +1,227 @@
+import math
+from collections import defaultdict
+
+from geometry import gather, neighborhood_offsets, sphere_offsets, stack_shape
+from roi import absolute_position, relative_center
+
+
+class GridIndex(object):
+    def __init__(self, cell_size, scaleZ=1.):
+        # type: (float, float) -> GridIndex
+        """
+    Uniform grid of 3D points for range queries. Distances are the anisotropic ones used everywhere in this code
+    (d^2 = dx^2 + dy^2 + (dz/scaleZ)^2), so the grid cells are cubes of cell_size in xy units
+
+        :param cell_size: Side of the grid cells, best close to the typical query radius
+
+        :param scaleZ: Depth of a voxel (1 if image is isotropic, less otherwise)
+        """
+        self.cell_size = float(cell_size)
+        self.scaleZ = scaleZ
+        self.cells = defaultdict(list)
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def _key(self, x, y, z):
+        s = self.cell_size
+        return int(math.floor(x / s)), int(math.floor(y / s)), int(math.floor(z / self.scaleZ / s))
+
+    def insert(self, pos, item=None):
+        # type: (list, object) -> None
+        """
+    Add a point with any payload (e.g. its intensity)
+        """
+        self.cells[self._key(*pos)].append((tuple(pos), item))
+        self.n += 1
+
+    def query_radius(self, pos, radius):
+        # type: (list, float) -> list
+        """
+    Points within radius of pos
+
+        :return: List of (distance, position, item), closest first
+        """
+        x, y, z = pos
+        kx0, ky0, kz0 = self._key(x - radius, y - radius, z - radius * self.scaleZ)
+        kx1, ky1, kz1 = self._key(x + radius, y + radius, z + radius * self.scaleZ)
+        r2 = radius * radius
+        z2 = self.scaleZ * self.scaleZ
+        found = []
+        for kz in range(kz0, kz1 + 1):
+            for ky in range(ky0, ky1 + 1):
+                for kx in range(kx0, kx1 + 1):
+                    cell = self.cells.get((kx, ky, kz))
+                    if not cell:
+                        continue
+                    for p, item in cell:
+                        d2 = (p[0] - x) ** 2 + (p[1] - y) ** 2 + (p[2] - z) ** 2 / z2
+                        if d2 <= r2:
+                            found.append((math.sqrt(d2), p, item))
+        found.sort(key=lambda f: f[0])
+        return found
+
+    def query_knn(self, pos, k):
+        # type: (list, int) -> list
+        """
+    The k points closest to pos (fewer if the index has less than k points)
+
+        :return: List of (distance, position, item), closest first
+        """
+        if self.n == 0 or k <= 0:
+            return []
+        x, y, z = pos
+        cx, cy, cz = self._key(x, y, z)
+        keys = list(self.cells.keys())
+        max_ring = max(max(abs(kx - cx), abs(ky - cy), abs(kz - cz)) for kx, ky, kz in keys)
+        z2 = self.scaleZ * self.scaleZ
+        found = []
+        for ring in range(max_ring + 1):
+            # grid cells at Chebyshev distance ring from the cell of pos
+            for kz in range(cz - ring, cz + ring + 1):
+                for ky in range(cy - ring, cy + ring + 1):
+                    for kx in range(cx - ring, cx + ring + 1):
+                        if max(abs(kx - cx), abs(ky - cy), abs(kz - cz)) != ring:
+                            continue
+                        for p, item in self.cells.get((kx, ky, kz), ()):
+                            d2 = (p[0] - x) ** 2 + (p[1] - y) ** 2 + (p[2] - z) ** 2 / z2
+                            found.append((math.sqrt(d2), p, item))
+            found.sort(key=lambda f: f[0])
+            # points not seen yet are at least ring * cell_size away
+            if len(found) >= k and found[k - 1][0] <= ring * self.cell_size:
+                break
+        return found[:k]
+
+    def query_box(self, pos, half_xy, half_z):
+        # type: (list, float, float) -> list
+        """
+    Points p with |p - pos| < half_xy along x and y and < half_z along z (z in slices)
+
+        :return: List of (position, item)
+        """
+        x, y, z = pos
+        kx0, ky0, kz0 = self._key(x - half_xy, y - half_xy, z - half_z)
+        kx1, ky1, kz1 = self._key(x + half_xy, y + half_xy, z + half_z)
+        found = []
+        for kz in range(kz0, kz1 + 1):
+            for ky in range(ky0, ky1 + 1):
+                for kx in range(kx0, kx1 + 1):
+                    for p, item in self.cells.get((kx, ky, kz), ()):
+                        if abs(p[0] - x) < half_xy and abs(p[1] - y) < half_xy and abs(p[2] - z) < half_z:
+                            found.append((p, item))
+        return found
+
+
+def morton_key(pos, cell_size, scaleZ=1., bits=16):
+    # type: (list, float, float, int) -> int
+    """
+Position of a point along the Z-order (Morton) curve over a grid of cell_size: points close in the curve are close
+in space, so the cells visited in this order share slices and tiles
+    """
+    coords = [int(pos[0] // cell_size), int(pos[1] // cell_size), int(pos[2] / scaleZ // cell_size)]
+    key = 0
+    for b in range(bits):
+        for axis, c in enumerate(coords):
+            key |= ((c >> b) & 1) << (3 * b + axis)
+    return key
+
+
+def seed_index(seeds, cell_size, scaleZ=1.):
+    # type: (list, float, float) -> GridIndex
+    """
+GridIndex of the marker seeds, the item of every seed is its position in seeds
+    """
+    index = GridIndex(cell_size, scaleZ)
+    for i, seed in enumerate(seeds):
+        index.insert(seed[:3], i)
+    return index
+
+
+def plan_cells(seeds, cube_dim, scaleZ=1., order='file'):
+    # type: (list, int, float, str) -> list
+    """
+Processing plan of the cells of an image
+
+    :param seeds: Coordinates of the cells
+
+    :param cube_dim: Dimension of the cube roi around every cell
+
+    :param order: 'file' keeps the marker order, 'morton' visits the cells along a Z-order curve (cache locality)
+
+    :return: List of (marker index, indexes of the markers whose cubes overlap this one), in processing order
+    """
+    if order not in ('file', 'morton'):
+        raise ValueError('Invalid cell order: ' + order)
+    index = seed_index(seeds, cube_dim, scaleZ)
+    # two cubes overlap if their centers are closer than a cube side (see stacks.dump_3DRoi)
+    span_xy = int(cube_dim / 2) * 2
+    span_z = int(cube_dim * scaleZ / 2) * 2
+
+    indexes = list(range(len(seeds)))
+    if order == 'morton':
+        indexes.sort(key=lambda i: morton_key(seeds[i], cube_dim, scaleZ))
+
+    plan = []
+    for i in indexes:
+        neighbors = sorted(item for p, item in index.query_box(seeds[i][:3], span_xy, span_z) if item != i)
+        plan.append((i, neighbors))
+    return plan
+
+
+def cell_peaks(cs, index, radius, thresh):
+    # type: (CellStack, GridIndex, float, float) -> list
+    """
+Same output of utils.find_maxima(cs, radius // 2, thresh), from the maxima of the whole image (see
+utils.image_maxima, searched with a smaller radius and no noise tolerance). The peaks of the image inside the cell
+stack go through the same two steps of MaximaFinder on the voxels of the cell: a peak must be the maximum of the
+ellipsoid of radius radius // 2 around it, then, brightest first, every peak kept floods the 26-connected voxels down
+to its value minus thresh (the noise tolerance) and the peaks in the flooded region are dropped. Only peaks made by
+the edge of the cube (a brighter voxel just outside it) and cells with radius // 2 below the search radius of the
+image can differ
+
+    :param cs: CellStack
+
+    :param index: Maxima of the image containing the cell
+
+    :param radius: Radius of the cell
+
+    :param thresh: Intensity threshold and noise tolerance
+
+    :return: List of maxima 3D coordinates (relative to the cell stack), brightest first, and the cell center
+    """
+    shape = stack_shape(cs)
+    buf = cs.voxels()
+    r = cs.roi3D
+    candidates = []
+    for p, item in index.query_box(absolute_position(cs.center, r), max(r['width'], r['height']), r['depth']):
+        pos = relative_center(p[0], p[1], p[2], r)
+        if cs.contains(pos):
+            value = cs.get_voxel(pos)
+            if value >= thresh:
+                candidates.append((value, pos))
+    candidates.sort(key=lambda c: -c[0])
+
+    ball = sphere_offsets(radius // 2, cs.scaleZ, shape)
+    neigh = neighborhood_offsets(cs.scaleZ)
+    dx, dy, dz = neigh.dx, neigh.dy, neigh.dz
+    flooded = set()
+    peaks = []
+    for value, pos in candidates:
+        # whole neighborhood read (no early stop), so that gather counts its voxels
+        if tuple(pos) in flooded or max(v for i, v in gather(buf, ball, pos, shape)) > value:
+            continue
+        peaks.append(pos)
+        limit = max(1, int(value - thresh))
+        flooded.add(tuple(pos))
+        front = [pos]
+        while front:
+            q = front.pop()
+            for i, v in gather(buf, neigh, q, shape):
+                n = (q[0] + dx[i], q[1] + dy[i], q[2] + dz[i])
+                if v >= limit and n not in flooded:
+                    flooded.add(n)
+                    front.append(n)
+
+    peaks.append(cs.center)
+    return peaks
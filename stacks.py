@@ -1,79 +1,40 @@
-from ij import ImagePlus
-
-
-def gen_cell_stacks(imp, seeds, cube_dim, scaleZ=1.0):
-    """
-Generate all the cells stacks in the given image at the given coordinates (seeds)
-    """
-    for pos in seeds:
-        yield CellStack(imp, pos[0], pos[1], pos[2], cube_dim, scaleZ)
+import time
 
+from ij import ImagePlus
 
-def relative_center(xc, yc, zc, roi_3D):
-    # type: (int, int, int, dict) -> list
-    """
-Calculate the center of the cell relatively to its roi
+from roi import relative_center, dump_3DRoi, is_on_border
+from sources import as_source
+from spatial import plan_cells
+from voxels import VoxelBuffer
 
-    :param roi_3D: region of interest of the cell obtained with dump_3DRoi()
 
-    :return: 3D coordinates
+def gen_cell_stacks(imp, seeds, cube_dim, scaleZ=1.0, view=False, order='file', dims=None):
     """
-    return [xc - roi_3D['x0'], yc - roi_3D['y0'], zc - roi_3D['z0']]
-
+Generate all the cells stacks in the given image at the given coordinates (seeds)
 
-def dump_3DRoi(imp, xc, yc, zc, dim, scaleZ=1.):
-    # type: (ImagePlus, int, int, int, int, float) -> dict
-    """
-Create a dict for rapid access to stack dimensions
+    :param view: Create the cell stacks as views of imp (see CellStack)
 
-    :param scaleZ: Depth of a voxel (1 if image is isotropic, less otherwise)
+    :param order: 'file' (marker order) or 'morton' (neighbor cells one after the other, see spatial.plan_cells).
+    Every CellStack knows its marker index and the markers whose cubes overlap its own (crowded cells)
 
-    :return: dict, Key values are: x0, y0, z0, width, height, depth
+    :param dims: Cube dimension of every seed (adaptive crops, see pipeline.crop_dims), cube_dim for all if None.
+    The neighbors are still those of the cube_dim cubes
     """
-    x0 = max(xc - int(dim / 2), 0)
-    y0 = max(yc - int(dim / 2), 0)
-    z0 = max(zc - int(dim * scaleZ / 2), 0)
-
-    # Returns the dimensions of this image (width, height, nChannels, nSlices, nFrames) as a 5 element int array
-    dimensions = imp.getDimensions()
-    imp_width = dimensions[0]
-    imp_height = dimensions[1]
-    imp_depth = dimensions[3]
-
-    x1 = min(xc + int(dim / 2), imp_width)
-    y1 = min(yc + int(dim / 2), imp_height)
-    z1 = min(zc + int(dim * scaleZ / 2), imp_depth)
-
-    w = x1 - x0
-    h = y1 - y0
-    d = z1 - z0
-    # z0 is the z coordinate, NOT the slice (slices go from 1 to stack size)
-
-    roi = {
-        'x0': x0,
-        'y0': y0,
-        'z0': z0,
-        'width': w,
-        'height': h,
-        'depth': d
-    }
-    return roi
-
-
-def is_on_border(roi3D, dim, scaleZ):
-    if dim == roi3D['width'] and dim == roi3D['height'] and dim*scaleZ == roi3D['depth']:
-        return False
-    else:
-        return True
+    for i, neighbors in plan_cells(seeds, cube_dim, scaleZ, order):
+        pos = seeds[i]
+        dim = cube_dim if dims is None else dims[i]
+        cs = CellStack(imp, pos[0], pos[1], pos[2], dim, scaleZ, view=view)
+        cs.set_neighbors(i, neighbors)
+        yield cs
 
 
 class CellStack(ImagePlus):
-    def __init__(self, imp, xc, yc, zc, dim, scaleZ=1.):
-        # type: (ImagePlus, int, int, int, int, float) -> CellStack
+    def __init__(self, imp, xc, yc, zc, dim, scaleZ=1., view=False):
+        # type: (ImagePlus, int, int, int, int, float, bool) -> CellStack
         """
     ImagePlus containing one cell as stack
 
-        :param imp: Original ImageJ ImagePlus
+        :param imp: Original ImageJ ImagePlus (or ImageSource, reading only the needed slices)
 
         :param xc: X coord of the cell center
 
@@ -84,22 +45,109 @@ class CellStack(ImagePlus):
         :param dim: Dimension of the cube roi around the cell
 
         :param scaleZ: Depth of a voxel (1 if image is isotropic)
+
+        :param view: If True (and the source keeps its voxels in memory) the cell reads the voxels directly from
+        the original image at offset roi3D, the cube is copied only when an ImageJ stack is needed (see materialize)
         """
+        t_start = time.time()
         self.dim = dim
         self.seed = [xc, yc, zc]
         self.roi3D = dump_3DRoi(imp, xc, yc, zc, dim, scaleZ)
         self.center = relative_center(xc, yc, zc, self.roi3D)
         self.scaleZ = scaleZ
         self.onBorder = is_on_border(self.roi3D, dim, scaleZ)
+        self.marker = None
+        self.neighbors = []
+        self.crowded = False
+
+        self.source = as_source(imp)
+        self.view = view
+        title = str(self.seed) + ' in ' + self.source.title
+        parent = self.source.buffer() if view else None
+        if parent is not None:
+            self.view_buffer = parent.view(self.roi3D['x0'], self.roi3D['y0'], self.roi3D['z0'],
+                                           self.roi3D['width'], self.roi3D['height'], self.roi3D['depth'])
+            super(ImagePlus, self).__init__()
+            self.setTitle(title)
+        else:
+            self.view_buffer = None
+            super(ImagePlus, self).__init__(title, self.crop_stack())
+        # time taken to get the voxels of the cell (see instrument)
+        self.t_crop = time.time() - t_start
+
+    def set_neighbors(self, marker, neighbors):
+        # type: (int, list) -> None
+        """
+    Position of the cell among the markers of the image and markers whose cubes overlap its own
+        """
+        self.marker = marker
+        self.neighbors = neighbors
+        self.crowded = len(neighbors) > 0
 
-        title = str(self.seed) + ' in ' + imp.title
-        stack = imp.getImageStack().crop(self.roi3D['x0'],
-                                         self.roi3D['y0'],
-                                         self.roi3D['z0'],
-                                         self.roi3D['width'],
-                                         self.roi3D['height'],
-                                         self.roi3D['depth'])
-        super(ImagePlus, self).__init__(title, stack)
+    def grow(self, dim):
+        # type: (int) -> None
+        """
+    Crop again the cell with a cube of side dim around the seed (adaptive crops, when the radius is close to the
+    edge of the cube), as if it was created with dim: center back on the seed, original voxels (filters must be
+    applied again)
+        """
+        t_start = time.time()
+        self.dim = dim
+        self.roi3D = dump_3DRoi(self.source, self.seed[0], self.seed[1], self.seed[2], dim, self.scaleZ)
+        self.center = relative_center(self.seed[0], self.seed[1], self.seed[2], self.roi3D)
+        self.onBorder = is_on_border(self.roi3D, dim, self.scaleZ)
+
+        parent = self.source.buffer() if self.view else None
+        if parent is not None:
+            self.view_buffer = parent.view(self.roi3D['x0'], self.roi3D['y0'], self.roi3D['z0'],
+                                           self.roi3D['width'], self.roi3D['height'], self.roi3D['depth'])
+        else:
+            cal = self.getCalibration().copy()
+            self.view_buffer = None
+            self.setStack(self.crop_stack())
+            self.setCalibration(cal)
+        self.t_crop += time.time() - t_start
+
+    def crop_stack(self):
+        # type: () -> ImageStack
+        """
+    Copy of the cube of the cell from the original image
+        """
+        return self.source.crop(self.roi3D['x0'],
+                                self.roi3D['y0'],
+                                self.roi3D['z0'],
+                                self.roi3D['width'],
+                                self.roi3D['height'],
+                                self.roi3D['depth'])
+
+    def is_view(self):
+        # type: () -> bool
+        """
+    True if the cell has no stack of its own yet and reads the voxels of the original image
+        """
+        return self.view_buffer is not None
+
+    def materialize(self):
+        """
+    Copy the cube in a stack owned by the cell. It must be called before handing the CellStack to ImageJ or
+    mcib3d (filters, maxima finder, display) and before modifying its voxels: the original image is shared with
+    the other cells. No-op if the cell already has its stack
+        """
+        if self.view_buffer is None:
+            return
+        cal = self.getCalibration().copy()
+        self.setStack(self.crop_stack())
+        self.setCalibration(cal)
+        self.view_buffer = None
+
+    def voxels(self):
+        # type: () -> VoxelBuffer
+        """
+    Direct access to the voxels of the cell (the original image for views, the stack of the cell otherwise)
+        """
+        if self.view_buffer is not None:
+            return self.view_buffer
+        return VoxelBuffer.from_stack(self.getImageStack())
 
     def contains(self, pos):
         # type: (list) -> bool
@@ -130,11 +178,10 @@ class CellStack(ImagePlus):
 
         :raise: IndexError if coordinates out of cell stack
         """
-        if self.contains(pos):
-            self.setPosition(pos[2] + 1)
-            return self.getPixel(pos[0], pos[1])[0]
-        else:
+        v = self.voxels().get_or(pos[0], pos[1], pos[2])
+        if v is None:
             raise IndexError("3D coordinates out of bounds")
+        return v
 
     def set_calibration(self):
         """
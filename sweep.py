@@ -0,0 +1,134 @@
+import math
+import os
+
+from results import write_results
+from shells import profile_local_mean, radius_thresh
+
+# columns of the results file of every combination, one row per marker
+SWEEP_FIELDS = ['image', 'marker',
+                'seed_x', 'seed_y', 'seed_z',
+                'center_x', 'center_y', 'center_z',
+                'loc_mean', 'radius']
+
+# columns of the summary, one row per combination
+SUMMARY_FIELDS = ['combination', 'r0', 'r1', 'r2', 'meanw',
+                  'n_cells', 'mean_radius', 'n_zero_radius', 'n_max_radius', 'n_nan']
+
+
+def param_grid(r0s, r1s, r2s, meanws):
+    # type: (list, list, list, list) -> list
+    """
+Every combination of the local mean parameters with a non-empty background layer (r1 < r2)
+
+    :return: List of dict with keys r0, r1, r2, meanw
+    """
+    grid = []
+    for r0 in r0s:
+        for r1 in r1s:
+            for r2 in r2s:
+                if r1 >= r2:
+                    continue
+                for meanw in meanws:
+                    grid.append({'r0': r0, 'r1': r1, 'r2': r2, 'meanw': meanw})
+    return grid
+
+
+def profile_radius(profile, means, max_rad, params, confirm=0):
+    # type: (ShellSums, list, int, dict, int) -> tuple
+    """
+Local mean and radius of a cell for one combination (as main.measure_cell before the mean shift)
+
+    :param means: profile.means(), computed once per cell
+
+    :param confirm: Confirmation window of the crossing (radius_confirm of the pipeline, see shells.radius_thresh)
+
+    :return: (loc_mean, radius)
+    """
+    loc_mean = profile_local_mean(profile, params['r0'], params['r1'], params['r2'], params['meanw'])
+    return loc_mean, radius_thresh(means[:max_rad + 1], loc_mean, confirm)
+
+
+def score(cells, grid, max_rad, confirm=0):
+    # type: (list, list, int, int) -> iter
+    """
+Score every combination of the grid on the same cells: only arithmetic on the shell sums, no voxel is read
+
+    :param cells: Cell records with the RadialProfile around the (recentered) cell center in 'profile'
+
+    :param grid: Combinations as returned by param_grid
+
+    :param max_rad: Last radius of the radial distribution
+
+    :param confirm: Confirmation window of the crossing, the radius_confirm used by the pipeline
+
+    :return: Generator of (combination, generator of records with fields in SWEEP_FIELDS): the records of a
+    combination are computed while they are consumed, so only one row is held in memory at a time
+    """
+    means = [cell['profile'].means() for cell in cells]
+
+    def rows(params):
+        for cell, cell_means in zip(cells, means):
+            loc_mean, radius = profile_radius(cell['profile'], cell_means, max_rad, params, confirm)
+            record = dict((k, v) for k, v in cell.items() if k != 'profile')
+            record.update({'loc_mean': loc_mean, 'radius': radius})
+            yield record
+
+    for params in grid:
+        yield params, rows(params)
+
+
+def summarize(params, radii, loc_means, max_rad):
+    # type: (dict, list, list, int) -> dict
+    """
+    :param radii: Radius of every cell for the combination params
+
+    :param loc_means: Local mean of every cell for the combination params
+    """
+    summary = dict(params)
+    summary.update({
+        'n_cells': len(radii),
+        'mean_radius': float(sum(radii)) / len(radii) if radii else float('nan'),
+        'n_zero_radius': sum(1 for r in radii if r == 0),
+        # the distribution never falls below the threshold
+        'n_max_radius': sum(1 for r in radii if r == max_rad),
+        'n_nan': sum(1 for m in loc_means if math.isnan(m))
+    })
+    return summary
+
+
+def combination_name(k, params):
+    # type: (int, dict) -> str
+    return '{:03d}_r0-{}_r1-{}_r2-{}_w-{}'.format(k, params['r0'], params['r1'], params['r2'], params['meanw'])
+
+
+def write_sweep(sweep_dir, grid, cells, max_rad, confirm=0):
+    # type: (str, list, list, int, int) -> str
+    """
+Score the grid and write one results table per combination in sweep_dir (streamed row by row), plus summary.csv
+
+    :param confirm: Confirmation window of the crossing (see score)
+
+    :return: Path of the summary
+    """
+    if not os.path.isdir(sweep_dir):
+        os.makedirs(sweep_dir)
+
+    def tracked(rows, radii, loc_means):
+        # the rows go to the file as they are scored, only the columns of the summary are kept
+        for record in rows:
+            radii.append(record['radius'])
+            loc_means.append(record['loc_mean'])
+            yield record
+
+    summaries = []
+    for k, (params, rows) in enumerate(score(cells, grid, max_rad, confirm)):
+        name = combination_name(k, params)
+        radii, loc_means = [], []
+        write_results(os.path.join(sweep_dir, name + '.csv'), tracked(rows, radii, loc_means), SWEEP_FIELDS)
+        summary = summarize(params, radii, loc_means, max_rad)
+        summary['combination'] = name
+        summaries.append(summary)
+
+    summary_path = os.path.join(sweep_dir, 'summary.csv')
+    write_results(summary_path, summaries, SUMMARY_FIELDS)
+    return summary_path
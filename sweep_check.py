@@ -0,0 +1,93 @@
+"""
+Check of the parameter sweep against the radius of the pipeline (sweep.write_sweep, shells.radius_thresh)
+
+Run it in CPython or Fiji (python sweep_check.py): synthetic profiles with a noisy dip below the local mean before
+the real edge of the cell are swept with and without a confirmation window. Every radius written by the sweep must
+be the one radius_thresh gives with the same window, as the pipeline does, and the window must move the radius past
+the dip. The exit status is 1 if anything differs
+"""
+
+from __future__ import print_function, with_statement
+import csv
+import os
+import shutil
+import sys
+import tempfile
+
+from shells import ShellSums, profile_local_mean, radius_thresh
+from sweep import combination_name, param_grid, write_sweep
+
+max_rad = 20
+dip = 4  # shell below the local mean, the next one is above it again
+edge = 9  # first shell of the background
+confirms = [0, 2]
+grid = param_grid([2], [12], [18], [0.5])
+
+
+def dip_profile(contrast):
+    # type: (float) -> ShellSums
+    """
+Profile of a bright cell of radius edge over a background of 100 with a one shell dip at shell dip (8 voxels per
+shell)
+    """
+    profile = ShellSums(max_rad, [0, 0, 0])
+    for r in range(max_rad + 1):
+        v = 100. + contrast if r < edge else 100.
+        if r == dip:
+            v = 100.
+        profile.sums[r] = 8 * v
+        profile.counts[r] = 8
+        profile.edge_sums[r] = v
+        profile.edge_counts[r] = 1
+    return profile
+
+
+def read_radii(path):
+    # type: (str) -> list
+    with open(path, 'r') as f:
+        return [int(row['radius']) for row in csv.DictReader(f)]
+
+
+def check_confirm(sweep_dir, cells, confirm):
+    # type: (str, list, int) -> tuple
+    """
+    :return: (radii written by the sweep, messages about those that differ from radius_thresh)
+    """
+    write_sweep(sweep_dir, grid, cells, max_rad, confirm)
+    params = grid[0]
+    radii = read_radii(os.path.join(sweep_dir, combination_name(0, params) + '.csv'))
+    messages = []
+    for cell, radius in zip(cells, radii):
+        profile = cell['profile']
+        loc_mean = profile_local_mean(profile, params['r0'], params['r1'], params['r2'], params['meanw'])
+        expected = radius_thresh(profile.iter_means(max_rad), loc_mean, confirm)
+        if radius != expected:
+            messages.append('marker {}: {} instead of {}'.format(cell['marker'], radius, expected))
+    return radii, messages
+
+
+def main():
+    cells = [{'image': 'synthetic', 'marker': i, 'seed_x': 0, 'seed_y': 0, 'seed_z': 0,
+              'center_x': 0, 'center_y': 0, 'center_z': 0, 'profile': dip_profile(contrast)}
+             for i, contrast in enumerate([200., 500., 1000.])]
+    sweep_dir = tempfile.mkdtemp()
+    all_ok = True
+    radii = {}
+    try:
+        for confirm in confirms:
+            radii[confirm], messages = check_confirm(sweep_dir, cells, confirm)
+            all_ok = all_ok and not messages
+            print('confirm {}: radii {} {}'.format(confirm, radii[confirm], 'OK' if not messages else 'FAILED'))
+            for m in messages:
+                print('  ' + m)
+    finally:
+        shutil.rmtree(sweep_dir)
+    if radii[0] != [dip] * len(cells) or radii[2] != [edge] * len(cells):
+        print('the confirmation window does not skip the dip')
+        all_ok = False
+    print('Sweep: ' + ('OK' if all_ok else 'FAILED'))
+    return all_ok
+
+
+if __name__ in ['__builtin__', '__main__']:
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,219 @@
+"""
+Synthetic datasets with known cells (center and radius), to measure speed and accuracy of bcmeasure offline
+
+Every volume is anisotropic like the real ones (a voxel is 1/scaleZ times deeper than wide) and contains isolated
+cells, touching pairs and cells cut by the border of the image, over a noisy background. The cells are written as
+.marker files (y inverted as in the real dataset, see markers.invert_y) and the ground truth in a .truth.csv file
+"""
+
+from __future__ import with_statement
+import csv
+import math
+import os
+import random
+
+from ij import ImagePlus, ImageStack
+from ij.io import FileSaver
+from ij.process import ShortProcessor
+from jarray import zeros
+
+TRUTH_FIELDS = ['x', 'y', 'z', 'radius', 'kind']
+
+
+class Blob(object):
+    def __init__(self, x, y, z, radius, intensity, kind='isolated'):
+        # type: (int, int, int, float, float, str) -> Blob
+        """
+    Synthetic cell: sphere of the given radius (xy units, radius * scaleZ slices along z) centered in (x, y, z)
+
+        :param kind: 'isolated', 'touching' (in contact with another cell) or 'border' (cut by the image border)
+        """
+        self.x, self.y, self.z = x, y, z
+        self.radius = radius
+        self.intensity = intensity
+        self.kind = kind
+
+
+def distance(a, b, scaleZ):
+    # type: (Blob, Blob, float) -> float
+    return math.sqrt((a.x - b.x) ** 2 + (a.y - b.y) ** 2 + ((a.z - b.z) / scaleZ) ** 2)
+
+
+def random_layout(width, height, depth, scaleZ, n_cells=20, radius_range=(5, 10), n_touching=3, n_border=3,
+                  intensity_range=(800, 1500), seed=0):
+    # type: (int, int, int, float, int, tuple, int, int, tuple, int) -> list
+    """
+Random cells: n_cells isolated (at least 3 voxels between the surfaces), n_touching pairs (surfaces in contact)
+and n_border cells with the center closer to the image border than the radius
+
+    :return: List of Blob
+    """
+    rnd = random.Random(seed)
+    blobs = []
+
+    def new_radius():
+        return rnd.uniform(*radius_range)
+
+    def free(b, gap):
+        return all(distance(b, o, scaleZ) >= b.radius + o.radius + gap for o in blobs)
+
+    def inside(r):
+        # center far enough from the border to contain the whole cell
+        z_margin = int(math.ceil(r * scaleZ))
+        return (rnd.randint(int(r) + 1, width - int(r) - 2), rnd.randint(int(r) + 1, height - int(r) - 2),
+                rnd.randint(z_margin, max(depth - z_margin - 1, z_margin)))
+
+    for attempt in range(200 * (n_cells + n_touching + n_border)):
+        if len(blobs) >= n_cells:
+            break
+        r = new_radius()
+        x, y, z = inside(r)
+        b = Blob(x, y, z, r, rnd.uniform(*intensity_range))
+        if free(b, 3):
+            blobs.append(b)
+
+    n_pairs = 0
+    for attempt in range(200 * n_touching):
+        if n_pairs >= n_touching:
+            break
+        r1, r2 = new_radius(), new_radius()
+        x, y, z = inside(r1)
+        a = Blob(x, y, z, r1, rnd.uniform(*intensity_range), 'touching')
+        # second cell in contact along a random xy direction
+        angle = rnd.uniform(0, 2 * math.pi)
+        b = Blob(int(round(x + (r1 + r2) * math.cos(angle))), int(round(y + (r1 + r2) * math.sin(angle))), z, r2,
+                 rnd.uniform(*intensity_range), 'touching')
+        if not (r2 < b.x < width - r2 - 1 and r2 < b.y < height - r2 - 1):
+            continue
+        if free(a, 3) and free(b, 3):
+            blobs.extend([a, b])
+            n_pairs += 1
+
+    n_cut = 0
+    for attempt in range(200 * n_border):
+        if n_cut >= n_border:
+            break
+        r = new_radius()
+        x, y, z = inside(r)
+        # move the center next to one of the four xy sides
+        side = rnd.randint(0, 3)
+        offset = rnd.randint(0, int(r) - 1)
+        if side == 0:
+            x = offset
+        elif side == 1:
+            x = width - 1 - offset
+        elif side == 2:
+            y = offset
+        else:
+            y = height - 1 - offset
+        b = Blob(x, y, z, r, rnd.uniform(*intensity_range), 'border')
+        if free(b, 3):
+            blobs.append(b)
+            n_cut += 1
+
+    return blobs
+
+
+def make_volume(width, height, depth, blobs, scaleZ, shape='ellipsoid', background=200., noise=30., seed=0,
+                title='synthetic'):
+    # type: (int, int, int, list, float, str, float, float, int, str) -> ImagePlus
+    """
+16-bit volume with the given cells over a background with gaussian noise
+
+    :param shape: 'ellipsoid' (uniform intensity inside the radius, sharp border) or 'gauss' (gaussian profile
+    with half maximum at the radius)
+
+    :param noise: Standard deviation of the noise
+    """
+    rnd = random.Random(seed)
+    volume = [[background + rnd.gauss(0, noise) for _ in range(width * height)] for _ in range(depth)]
+
+    for b in blobs:
+        # half maximum at the radius
+        s2 = b.radius * b.radius / (2 * math.log(2))
+        extent = b.radius if shape == 'ellipsoid' else 3 * b.radius
+        for z in range(max(int(b.z - extent * scaleZ), 0), min(int(b.z + extent * scaleZ) + 1, depth)):
+            for y in range(max(int(b.y - extent), 0), min(int(b.y + extent) + 1, height)):
+                row = volume[z]
+                for x in range(max(int(b.x - extent), 0), min(int(b.x + extent) + 1, width)):
+                    d2 = (x - b.x) ** 2 + (y - b.y) ** 2 + ((z - b.z) / scaleZ) ** 2
+                    if shape == 'ellipsoid':
+                        if d2 <= b.radius * b.radius:
+                            row[y * width + x] += b.intensity
+                    else:
+                        row[y * width + x] += b.intensity * math.exp(-d2 / (2 * s2))
+
+    stack = ImageStack(width, height)
+    for values in volume:
+        pixels = zeros(width * height, 'h')
+        for i, v in enumerate(values):
+            v = min(max(int(round(v)), 0), 65535)
+            # unsigned value in the signed java short
+            pixels[i] = v - 65536 if v > 32767 else v
+        stack.addSlice(ShortProcessor(width, height, pixels, None))
+    return ImagePlus(title, stack)
+
+
+def write_markers(marker_path, blobs, height):
+    # type: (str, list, int) -> None
+    """
+Vaa3D marker file of the cells, y inverted as in the real annotations (markers_to_csv inverts it back)
+    """
+    with open(marker_path, 'w') as f:
+        f.write('##x,y,z,radius,shape,name,comment, color_r,color_g,color_b\n')
+        for b in blobs:
+            f.write('{},{},{},0,1,,,255,0,0\n'.format(b.x, height - b.y, b.z))
+
+
+def write_truth(truth_path, blobs):
+    # type: (str, list) -> None
+    with open(truth_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(TRUTH_FIELDS)
+        for b in blobs:
+            writer.writerow([b.x, b.y, b.z, '{:.3f}'.format(b.radius), b.kind])
+
+
+def read_truth(truth_path):
+    # type: (str) -> list
+    """
+    :return: List of Blob (intensity unknown)
+    """
+    blobs = []
+    with open(truth_path, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for row in reader:
+            blobs.append(Blob(int(row[0]), int(row[1]), int(row[2]), float(row[3]), None, row[4]))
+    return blobs
+
+
+def truth_path_of(img_path):
+    # type: (str) -> str
+    return os.path.splitext(img_path)[0] + '.truth.csv'
+
+
+def make_dataset(out_dir, n_images=2, width=200, height=200, depth=40, scaleZ=0.4, shape='ellipsoid', seed=0,
+                 **layout):
+    # type: (str, int, int, int, int, float, str, int, dict) -> list
+    """
+Write n_images synthetic volumes (tif), their .marker files and ground truth in out_dir, in the same layout of the
+real dataset (so main.batch_process can run on it)
+
+    :param layout: Extra arguments of random_layout (n_cells, radius_range, n_touching, n_border, ...)
+
+    :return: Paths of the images
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    paths = []
+    for k in range(n_images):
+        name = 'synth_{:02d}'.format(k)
+        img_path = os.path.join(out_dir, name + '.tif')
+        blobs = random_layout(width, height, depth, scaleZ, seed=seed + k, **layout)
+        imp = make_volume(width, height, depth, blobs, scaleZ, shape=shape, seed=seed + k, title=name + '.tif')
+        FileSaver(imp).saveAsTiffStack(img_path)
+        write_markers(img_path + '.marker', blobs, height)
+        write_truth(truth_path_of(img_path), blobs)
+        paths.append(img_path)
+    return paths
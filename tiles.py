@@ -0,0 +1,132 @@
+from sources import ImageSource
+from spatial import plan_cells, morton_key
+from stacks import CellStack, dump_3DRoi
+from voxels import VoxelBuffer
+
+
+class TileSource(ImageSource):
+    def __init__(self, source, x0, y0, z0, w, h, d):
+        # type: (ImageSource, int, int, int, int, int, int) -> TileSource
+        """
+    Region of a source read once (a single crop) and kept in memory, seen with the coordinates and dimensions of
+    the whole image: the CellStacks created on a tile are sub-regions of it (views if requested) and never touch
+    the parent source
+        """
+        ImageSource.__init__(self, source.title, source.width, source.height, source.depth)
+        self.x0, self.y0, self.z0 = x0, y0, z0
+        self.w, self.h, self.d = w, h, d
+        self.stack = source.crop(x0, y0, z0, w, h, d)
+        self._buffer = None
+
+    def buffer(self):
+        if self._buffer is None and self.stack.getBitDepth() != 24:
+            tile = VoxelBuffer.from_stack(self.stack)
+            # origin in image coordinates, so that views are taken with the roi of the cells
+            self._buffer = VoxelBuffer(tile.slices, tile.stride, tile.bit_depth, (-self.x0, -self.y0, -self.z0),
+                                       (self.width, self.height, self.depth))
+        return self._buffer
+
+    def crop(self, x0, y0, z0, w, h, d):
+        # type: (int, int, int, int, int, int) -> ImageStack
+        return self.stack.crop(x0 - self.x0, y0 - self.y0, z0 - self.z0, w, h, d)
+
+    def read_slice_window(self, z, x0, y0, w, h):
+        return self.crop(x0, y0, z, w, h, 1).getProcessor(1)
+
+    def close(self):
+        self.stack = None
+        self._buffer = None
+
+
+def _bounding_roi(source, seeds, group, cube_dim, scaleZ):
+    # type: (ImageSource, list, list, int, float) -> tuple
+    """
+    :return: (x0, y0, z0, w, h, d) of the smallest region containing the cubes of the seeds in group
+    """
+    rois = [dump_3DRoi(source, seeds[i][0], seeds[i][1], seeds[i][2], cube_dim, scaleZ) for i in group]
+    x0 = min(r['x0'] for r in rois)
+    y0 = min(r['y0'] for r in rois)
+    z0 = min(r['z0'] for r in rois)
+    x1 = max(r['x0'] + r['width'] for r in rois)
+    y1 = max(r['y0'] + r['height'] for r in rois)
+    z1 = max(r['z0'] + r['depth'] for r in rois)
+    return x0, y0, z0, x1 - x0, y1 - y0, z1 - z0
+
+
+def _split(source, seeds, group, cube_dim, scaleZ, max_voxels):
+    # type: (ImageSource, list, list, int, float, int) -> list
+    """
+Split a group of seeds in halves (along the longest side of its region) until every region fits in max_voxels.
+A single cube is always accepted. The seeds of every part keep their order in group (the order of the plan)
+    """
+    roi = _bounding_roi(source, seeds, group, cube_dim, scaleZ)
+    if len(group) == 1 or roi[3] * roi[4] * roi[5] <= max_voxels:
+        return [(group, roi)]
+    sides = [roi[3], roi[4], roi[5] / scaleZ]
+    axis = sides.index(max(sides))
+    ordered = sorted(group, key=lambda i: seeds[i][axis])
+    first = set(ordered[:len(ordered) // 2])
+    return (_split(source, seeds, [i for i in group if i in first], cube_dim, scaleZ, max_voxels) +
+            _split(source, seeds, [i for i in group if i not in first], cube_dim, scaleZ, max_voxels))
+
+
+def plan_tiles(source, seeds, cube_dim, scaleZ, tile_dim, max_tile_bytes, order='morton'):
+    # type: (ImageSource, list, int, float, int, int, str) -> list
+    """
+Group the seeds that fall in the same tile_dim x tile_dim x tile_dim*scaleZ block of the image: each group is
+read with one crop of the region enclosing all the cubes of its cells
+
+    :param source: Image the cells belong to
+
+    :param seeds: Coordinates of the cells
+
+    :param tile_dim: Side (in xy voxels) of the blocks grouping the seeds
+
+    :param max_tile_bytes: Memory budget of a tile, larger groups are split
+
+    :param order: Order of the cells inside a tile (see spatial.plan_cells), tiles are always in Z-order
+
+    :return: List of ((x0, y0, z0, w, h, d), plan) with plan as in spatial.plan_cells, restricted to the tile
+    """
+    plan = plan_cells(seeds, cube_dim, scaleZ, order)
+    bytes_per_voxel = max(source.read_slice_window(0, 0, 0, 1, 1).getBitDepth() // 8, 1)
+    max_voxels = max_tile_bytes // bytes_per_voxel
+
+    groups = {}
+    for i, neighbors in plan:
+        key = morton_key(seeds[i], tile_dim, scaleZ)
+        groups.setdefault(key, []).append(i)
+    neighbors_of = dict(plan)
+
+    tiles = []
+    for key in sorted(groups):
+        for group, roi in _split(source, seeds, groups[key], cube_dim, scaleZ, max_voxels):
+            tiles.append((roi, [(i, neighbors_of[i]) for i in group]))
+    return tiles
+
+
+def gen_tiles(source, seeds, cube_dim, scaleZ, tile_dim, max_tile_bytes, order='morton'):
+    """
+Generate (TileSource, plan) for every tile of plan_tiles, one tile in memory at a time
+    """
+    for roi, plan in plan_tiles(source, seeds, cube_dim, scaleZ, tile_dim, max_tile_bytes, order):
+        tile = TileSource(source, *roi)
+        try:
+            yield tile, plan
+        finally:
+            tile.close()
+
+
+def gen_tiled_cell_stacks(source, seeds, cube_dim, scaleZ, tile_dim, max_tile_bytes, view=False, order='morton',
+                          dims=None):
+    """
+Same as stacks.gen_cell_stacks, but the cells are cropped (or viewed) from the tile of their group instead of the
+whole image (the tiles contain the cube_dim cubes, so adaptive dims up to cube_dim fit in them)
+    """
+    for tile, plan in gen_tiles(source, seeds, cube_dim, scaleZ, tile_dim, max_tile_bytes, order):
+        for i, neighbors in plan:
+            pos = seeds[i]
+            dim = cube_dim if dims is None else dims[i]
+            cs = CellStack(tile, pos[0], pos[1], pos[2], dim, scaleZ, view=view)
+            cs.set_neighbors(i, neighbors)
+            yield cs
@@ -1,14 +1,22 @@
-from mcib3d.image3d import ImageHandler
+import math
+
+from ij import ImagePlus
+from mcib3d.geom import Objects3DPopulation
+from mcib3d.image3d import ImageHandler, ImageShort
 from mcib3d.image3d.processing import MaximaFinder
+from mcib3d.image3d.regionGrowing import Watershed3D
 
 from stacks import CellStack
-from neigh import nearest_neighborhood, neighborhood_mean
+from spatial import GridIndex
+from geometry import neighborhood_offsets, gather, stack_shape
+from rad3d import RadialProfile
 
 
 def local_max(cs, seed):
     # type: (CellStack, list) -> list
     """
-Search for the local maximum around the seed
+Search for the local maximum around the seed (steepest ascent over the 26 neighbors, the neighborhood is
+clipped at the borders of the stack)
 
     :param cs: CellStack in which to search
 
@@ -16,27 +24,37 @@ Search for the local maximum around the seed
 
     :return: 3D coordinates of the local max in stack
     """
+    buf = cs.voxels()
+    shape = stack_shape(cs)
+    table = neighborhood_offsets()
+    dx, dy, dz = table.dx, table.dy, table.dz
 
     max_v = cs.get_voxel(seed)
-    max_pos = seed
-    new_max_found = True
-    while new_max_found:
-        new_max_found = False
-        for pos in nearest_neighborhood(max_pos):
-            try:
-                v = cs.get_voxel(pos)
-                if v > max_v:
-                    max_pos = pos
-                    max_v = v
-                    new_max_found = True
-            except IndexError as e:
-                pass
+    max_pos = list(seed)
+    visited = set()
+    while True:
+        visited.add(tuple(max_pos))
+        best_i = -1
+        best_v = max_v
+        # largest neighbor above the current value, the first one in scan order on ties (as the exhaustive search)
+        for i, v in gather(buf, table, max_pos, shape):
+            if v > best_v:
+                best_i = i
+                best_v = v
+
+        if best_i < 0:
+            break
+        new_pos = [max_pos[0] + dx[best_i], max_pos[1] + dy[best_i], max_pos[2] + dz[best_i]]
+        if tuple(new_pos) in visited:
+            break
+        max_pos = new_pos
+        max_v = best_v
 
     return max_pos
 
 
-def local_mean(cellstack, r0, r1, r2, weight=0.5):
-    # type: (CellStack, int, int, int, float) -> float
+def local_mean(cellstack, r0, r1, r2, weight=0.5, profile=None, log=None):
+    # type: (CellStack, int, int, int, float, RadialProfile, callable) -> float
     """
 Calculate a threshold value computing the center/background mean and weighting the sum
 Reference at: https://github.com/mcib3d/mcib3d-core/blob/master/src/main/java/mcib3d/image3d/Segment3DSpots.java
@@ -49,12 +67,19 @@ Reference at: https://github.com/mcib3d/mcib3d-core/blob/master/src/main/java/mc
 
     :param weight: Weight of the center mean
 
+    :param profile: RadialProfile around cellstack.center covering r2 (a new one is computed if None)
+
+    :param log: Logger of the two means (e.g. IJ.log), nothing is logged if None (batch mode, worker threads)
+
     :return: Wighted mean
     """
-    mspot = neighborhood_mean(cellstack, r0)
-    print('Mean spot: ' + str(mspot))
-    mback = neighborhood_mean(cellstack, r2, r1)
-    print('Mean back: ' + str(mback))
+    if profile is None:
+        profile = RadialProfile(cellstack, max(abs(r0), r2))
+    mspot = profile.sphere_mean(r0)
+    mback = profile.layer_mean(r1, r2)
+    if log is not None:
+        log('Mean spot: ' + str(mspot))
+        log('Mean back: ' + str(mback))
     return mspot * weight + (1 - weight) * mback
 
 
@@ -72,7 +97,9 @@ Find maxima in the entire stack with given radius. Exclude peaks below thresh
     :return: List of maxima 3D coordinates
     """
 
-    imh = ImageHandler.wrap(cs.duplicate())
+    # MaximaFinder writes its results in new images, the cell stack is only read
+    cs.materialize()
+    imh = ImageHandler.wrap(cs)
     radXY = rad
     radZ = rad * cs.scaleZ
 
@@ -90,3 +117,83 @@ Find maxima in the entire stack with given radius. Exclude peaks below thresh
     peaks_list.append(cs.center)
     return peaks_list
 
+
+def image_maxima(source, rad, noise, scaleZ, slab_depth=None):
+    # type: (ImageSource, float, float, float, int) -> GridIndex
+    """
+Find the maxima of the whole image once (instead of once per cell cube) and index them by position
+
+    :param source: Image (raw or prefiltered)
+
+    :param rad: Maxima search radius along xy (rad * scaleZ along z)
+
+    :param noise: Noise tolerance of MaximaFinder, 0 to keep every maximum (each cell applies its own tolerance,
+    see spatial.cell_peaks)
+
+    :param slab_depth: If given, the image is read in slabs of slab_depth slices plus a halo as deep as the search
+    radius, otherwise at once
+
+    :return: GridIndex of the peaks (image coordinates), with their intensity as item
+    """
+    index = GridIndex(cell_size=max(2 * rad, 8), scaleZ=scaleZ)
+    if slab_depth is None:
+        slab_depth = source.depth
+    halo = int(math.ceil(rad * scaleZ)) + 1
+
+    for z0 in range(0, source.depth, slab_depth):
+        top = max(z0 - halo, 0)
+        bottom = min(z0 + slab_depth + halo, source.depth)
+        imp = ImagePlus('slab', source.crop(0, 0, top, source.width, source.height, bottom - top))
+        mf = MaximaFinder(ImageHandler.wrap(imp), rad, rad * scaleZ, noise)
+        for p in mf.getListPeaks().toArray():
+            x, y, z = [int(i) for i in p.getPosition().getArray()]
+            # peaks in the halo belong to the neighboring slabs
+            if z0 <= z + top < z0 + slab_depth:
+                index.insert([x, y, z + top], p.getValue())
+        imp.close()
+    return index
+
+
+def image_watershed(source, seeds, thresholds):
+    # type: (ImageSource, list, list) -> list
+    """
+Seeded 3D watershed (mcib3d Watershed3D) of the whole image, flooded down to the lowest threshold. The region of
+every seed keeps only its voxels above the threshold of the seed
+
+    :param source: Image (raw or prefiltered), read at once
+
+    :param seeds: Seeds in image coordinates, seed i is the label i + 1 of the watershed
+
+    :param thresholds: Threshold of every seed
+
+    :return: (number of voxels, centroid [x, y, z]) of every seed, centroid None if the region is empty
+    """
+    imp = ImagePlus('image', source.crop(0, 0, 0, source.width, source.height, source.depth))
+    raw = ImageHandler.wrap(imp)
+    seeds_image = ImageShort('seeds', source.width, source.height, source.depth)
+    for i, seed in enumerate(seeds):
+        # a voxel holding more than one seed is flooded from the first one, as the NumPy backend
+        if seeds_image.getPixel(seed[0], seed[1], seed[2]) == 0:
+            seeds_image.setPixel(seed[0], seed[1], seed[2], i + 1)
+
+    # seeds labelled with their own value (not relabelled by connected components), none discarded
+    ws = Watershed3D(raw, seeds_image, min(thresholds), 0)
+    ws.setLabelSeeds(False)
+    population = Objects3DPopulation(ws.getWatershedImage3D())
+
+    regions = []
+    for i, thresh in enumerate(thresholds):
+        obj = population.getObjectByValue(i + 1)
+        n = 0
+        sx = sy = sz = 0.
+        if obj is not None:
+            for v in obj.getVoxels():
+                x, y, z = v.getRoundX(), v.getRoundY(), v.getRoundZ()
+                if raw.getPixel(x, y, z) >= thresh:
+                    n += 1
+                    sx += x
+                    sy += y
+                    sz += z
+        regions.append((n, [sx / n, sy / n, sz / n] if n else None))
+    imp.close()
+    return regions
@@ -0,0 +1,77 @@
+# masks turning the signed values of java byte/short arrays in unsigned pixel values
+_MASKS = {8: 0xff, 16: 0xffff, 32: None}
+
+
+class VoxelBuffer(object):
+    def __init__(self, slices, stride, bit_depth, origin=(0, 0, 0), shape=None):
+        # type: (list, int, int, tuple, tuple) -> VoxelBuffer
+        """
+    Direct access to the pixel arrays of a stack, without copies.
+    The voxel (x, y, z) is slices[z + z0][(y + y0) * stride + x + x0], so the same arrays can be shared by the
+    views of many cells, each one with its own origin
+
+        :param slices: Pixel arrays (byte[], short[] or float[]), one per slice
+
+        :param stride: Width of the arrays (width of the parent stack)
+
+        :param bit_depth: 8, 16 or 32
+
+        :param origin: (x0, y0, z0) of the buffer in the arrays
+
+        :param shape: (width, height, depth) of the region that can be accessed from the origin
+        (the whole arrays if None)
+        """
+        if bit_depth not in _MASKS:
+            raise ValueError('Unsupported bit depth: ' + str(bit_depth))
+        self.slices = slices
+        self.stride = stride
+        self.bit_depth = bit_depth
+        self.mask = _MASKS[bit_depth]
+        self.x0, self.y0, self.z0 = origin
+        if shape is None:
+            height = len(slices[0]) // stride if slices else 0
+            shape = (stride - self.x0, height - self.y0, len(slices) - self.z0)
+        self.width, self.height, self.depth = shape
+
+    @staticmethod
+    def from_stack(stack):
+        # type: (ImageStack) -> VoxelBuffer
+        """
+    Buffer over the arrays of an ImageStack (getImageArray does not copy the pixels)
+        """
+        slices = list(stack.getImageArray())[:stack.getSize()]
+        return VoxelBuffer(slices, stack.getWidth(), stack.getBitDepth())
+
+    def view(self, x0, y0, z0, width, height, depth):
+        # type: (int, int, int, int, int, int) -> VoxelBuffer
+        """
+    Buffer sharing the same arrays with origin moved by (x0, y0, z0) and the given shape
+        """
+        return VoxelBuffer(self.slices, self.stride, self.bit_depth, (self.x0 + x0, self.y0 + y0, self.z0 + z0),
+                           (width, height, depth))
+
+    def contains(self, x, y, z):
+        # type: (int, int, int) -> bool
+        return 0 <= x < self.width and 0 <= y < self.height and 0 <= z < self.depth
+
+    def get(self, x, y, z):
+        # type: (int, int, int) -> float
+        """
+    Value of the voxel (x, y, z) relative to the origin, no bounds check
+        """
+        v = self.slices[z + self.z0][(y + self.y0) * self.stride + x + self.x0]
+        if self.mask is not None:
+            v &= self.mask
+        return v
+
+    def get_or(self, x, y, z, default=None):
+        # type: (int, int, int, float) -> float
+        """
+    Value of the voxel (x, y, z) relative to the origin, default if it is outside the shape
+        """
+        if 0 <= x < self.width and 0 <= y < self.height and 0 <= z < self.depth:
+            v = self.slices[z + self.z0][(y + self.y0) * self.stride + x + self.x0]
+            if self.mask is not None:
+                v &= self.mask
+            return v
+        return default